@@ -0,0 +1,131 @@
+import heapq
+
+import numpy as np
+from utils import top_n_indices
+
+# leaves visited per approximate query, see benchmark_ann.py for the tradeoff
+DEFAULT_MAX_LEAVES = 32
+
+
+class KDTree:
+    # Pure NumPy KD-tree. Leaves hold a contiguous slice of the reordered
+    # points so a leaf is scored with one vectorized distance computation.
+    # With max_leaves=None a query is exact, otherwise the search stops after
+    # visiting max_leaves leaves (best bin first) and the result is approximate.
+
+    def __init__(
+        self, points: np.ndarray, weights: np.ndarray | None = None, leaf_size=64
+    ):
+        points = np.asarray(points, dtype=np.float64)
+        self.leaf_size = leaf_size
+        # per dimension weights of the squared euclidean distance
+        self.weights = (
+            np.ones(points.shape[1])
+            if weights is None
+            else np.asarray(weights, dtype=np.float64)
+        )
+
+        order = np.arange(len(points))
+        split_dim, split_val, children, bounds, lower = [], [], [], [], []
+
+        stack = [(0, len(points), -1, 0)]
+        while stack:
+            start, end, parent, side = stack.pop()
+            node = len(split_dim)
+            if parent >= 0:
+                children[parent][side] = node
+
+            idx = order[start:end]
+            bounds.append((start, end))
+            children.append([-1, -1])
+            # smallest value per dimension under this node, used by upper limits
+            lower.append(points[idx].min(axis=0))
+            if end - start <= leaf_size:
+                split_dim.append(-1)
+                split_val.append(0.0)
+                continue
+
+            dim = int(np.argmax(np.ptp(points[idx], axis=0)))
+            mid = (end - start) // 2
+            part = np.argpartition(points[idx, dim], mid)
+            order[start:end] = idx[part]
+
+            split_dim.append(dim)
+            split_val.append(float(points[order[start + mid], dim]))
+            stack.append((start + mid, end, node, 1))
+            stack.append((start, start + mid, node, 0))
+
+        self.order = order
+        self.points = np.ascontiguousarray(points[order])
+        self.split_dim = np.array(split_dim)
+        self.split_val = np.array(split_val)
+        self.children = np.array(children)
+        self.bounds = np.array(bounds)
+        self.lower = np.array(lower)
+
+    def __len__(self) -> int:
+        return len(self.points)
+
+    def query(
+        self,
+        x: np.ndarray,
+        k=10,
+        max_leaves: int | None = None,
+        upper: np.ndarray | None = None,
+    ):
+        # Returns (indices into the original points, distances), closest first.
+        # If upper is given only points strictly below it in every dimension
+        # are returned, whole subtrees above it are skipped.
+        x = np.asarray(x, dtype=np.float64)
+        k = min(k, len(self.points))
+        if k <= 0:
+            return np.empty(0, dtype=np.intp), np.empty(0, dtype=np.float64)
+
+        best_idx = np.empty(0, dtype=np.intp)
+        best_sq = np.empty(0, dtype=np.float64)
+        kth_sq = np.inf
+
+        leaves = 0
+        heap = [(0.0, 0)]
+        while heap:
+            bound, node = heapq.heappop(heap)
+            if bound > kth_sq:
+                break
+            if upper is not None and (self.lower[node] >= upper).any():
+                continue
+
+            dim = self.split_dim[node]
+            if dim < 0:
+                start, end = self.bounds[node]
+                points = self.points[start:end]
+                positions = np.arange(start, end)
+                if upper is not None:
+                    eligible = (points < upper).all(axis=1)
+                    points, positions = points[eligible], positions[eligible]
+
+                diff = points - x
+                sq = (diff * diff) @ self.weights
+                best_idx = np.concatenate((best_idx, positions))
+                best_sq = np.concatenate((best_sq, sq))
+                if len(best_sq) >= k:
+                    # keep ties on the kth distance so index order decides them
+                    kth_sq = np.partition(best_sq, k - 1)[k - 1]
+                    keep = best_sq <= kth_sq
+                    best_idx, best_sq = best_idx[keep], best_sq[keep]
+
+                leaves += 1
+                if max_leaves is not None and leaves >= max_leaves:
+                    break
+                continue
+
+            # the far side is at least the distance to the splitting plane away
+            delta = x[dim] - self.split_val[node]
+            near, far = self.children[node] if delta < 0 else self.children[node][::-1]
+            heapq.heappush(heap, (bound, near))
+            heapq.heappush(heap, (max(bound, self.weights[dim] * delta * delta), far))
+
+        found = self.order[best_idx]
+        by_index = np.argsort(found)
+        found, dist = found[by_index], np.sqrt(best_sq[by_index])
+        top = top_n_indices(dist, k)[0]
+        return found[top], dist[top]
@@ -1,65 +1,93 @@
+import math
+import os
+import threading
+import time
+
 from flask import Flask, request, jsonify, send_from_directory
-import pandas as pd
-import numpy as np
-import csv
 from flask_cors import CORS
-from update_sentiments import update_support_history, update_social_media_history
-from main import main
+from customer_store import PENDING, get_store
+from enrichment import EnrichmentWorker, enrichment_table
+from main import PIPELINES, main
 from image_upload import UPLOAD_FOLDER, upload_image
-from image_describe import image_transcribe
+from jobs import JobQueue
 
 app = Flask(__name__)
 CORS(app)
 
 app.config["UPLOAD_FOLDER"] = UPLOAD_FOLDER
 
-
-def get_last_id_from_csv(file_path: str, id_column: str) -> int:
-    last_id = 0
-    with open(file_path, "r") as file:
-        reader = csv.DictReader(file)
-        for row in reader:
-            last_id = max(last_id, int(row[id_column].split("_")[1]))
-
-    return last_id
+store = get_store(cached=True)
+# default LLM pipeline of /customer_run_ai, see main.PIPELINES
+RUN_AI_PIPELINE = os.getenv("RUN_AI_PIPELINE", "multi")
+# longest /enrichment/<record_id>?wait= a request is held for, in seconds
+ENRICHMENT_MAX_WAIT = 30
+
+_job_queue: JobQueue | None = None
+_enrichment: EnrichmentWorker | None = None
+_workers_lock = threading.Lock()
+
+
+def get_job_queue() -> JobQueue:
+    # recommendation runs take several LLM round trips, they run in the
+    # background. Created on first use, so only a process serving requests
+    # starts worker threads
+    global _job_queue
+    with _workers_lock:
+        if _job_queue is None:
+            _job_queue = JobQueue(max_workers=4)
+        return _job_queue
+
+
+def get_enrichment_worker() -> EnrichmentWorker:
+    # posted support queries and posts are saved right away, their sentiment
+    # (and image transcript) is filled in by the worker afterwards
+    global _enrichment
+    with _workers_lock:
+        if _enrichment is None:
+            _enrichment = EnrichmentWorker(store)
+        return _enrichment
+
+
+def typed_row(row: dict) -> dict:
+    # the store keeps csv text, give the client numbers and booleans back
+    typed = {}
+    for key, value in row.items():
+        if value is None or value in ("True", "False"):
+            typed[key] = "" if value is None else value == "True"
+            continue
+        try:
+            typed[key] = int(value)
+            continue
+        except ValueError:
+            pass
+        try:
+            number = float(value)
+            typed[key] = number if math.isfinite(number) else value
+        except ValueError:
+            typed[key] = value
+    return typed
 
 
 @app.route("/customer_ids", methods=["GET"])
 def get_customer_ids():
-    df = pd.read_csv("./data/customer_profile.csv")
-    return jsonify(df["customer_id"].tolist())
+    return jsonify(store.get_customer_ids())
 
 
 @app.route("/customer_profile", methods=["GET"])
 def get_customer_profile():
     customer_id = request.args.get("customer_id")
-    df = pd.read_csv("./data/customer_profile.csv")
-
-    for _, row in df.iterrows():
-        if row["customer_id"] == customer_id:
-            try:
-                if np.isnan(row["top_n_products"]):
-                    row["top_n_products"] = ""
-                if np.isnan(row["top_n_passive_products"]):
-                    row["top_n_passive_products"] = ""
-            except Exception:
-                pass
-
-            return jsonify(row.to_dict())
-    return {"error": "Customer not found"}
+    row = store.get_profile(customer_id)
+    if row is None:
+        return {"error": "Customer not found"}
+    return jsonify(typed_row(row))
 
 
 @app.route("/customer_purchase_history", methods=["GET"])
 def get_customer_purchase_history():
     customer_id = request.args.get("customer_id")
-    matching_rows = []
-
-    with open("./data/customer_purchase.csv", mode="r", encoding="utf-8") as file:
-        reader = csv.DictReader(file)
-        for row in reader:
-            if row.get("customer_id") == customer_id:
-                row["amt"] = float(row["amt"])
-                matching_rows.append(row)
+    matching_rows = store.get_transactions(customer_id)
+    for row in matching_rows:
+        row["amt"] = float(row["amt"])
 
     return jsonify(matching_rows)
 
@@ -68,38 +96,19 @@ def get_customer_purchase_history():
 def add_customer_purchase_history():
     data = request.get_json()
     data["customer_id"] = request.args.get("customer_id")
-    next_id = get_last_id_from_csv("./data/customer_purchase.csv", "transaction_id") + 1
-    data["transaction_id"] = "TXN_" + str(next_id)
-    with open("./data/customer_purchase.csv", mode="a", newline="") as file:
-        cols = [
-            "transaction_id",
-            "customer_id",
-            "date",
-            "platform",
-            "payment_method",
-            "amt",
-            "location",
-            "item_category",
-            "item_sub_category",
-            "item_brand",
-        ]
-        writer = csv.DictWriter(file, fieldnames=cols)
-        writer.writerow(data)
+    data["transaction_id"] = store.next_id("customer_purchase")
+    store.add_transaction(data)
     return {"customer_id": data["customer_id"]}
 
 
 @app.route("/customer_social_media_history", methods=["GET"])
 def get_customer_social_history():
     customer_id = request.args.get("customer_id")
-    matching_rows = []
-
-    with open("./data/social_media_record.csv", mode="r", encoding="utf-8") as file:
-        reader = csv.DictReader(file)
-        for row in reader:
-            if row.get("customer_id") == customer_id:
-                row["sentiment_score"] = float(row["sentiment_score"])
-                row["engagement_level"] = float(row["engagement_level"])
-                matching_rows.append(row)
+    matching_rows = store.get_posts(customer_id)
+    for row in matching_rows:
+        # null while the post is still being enriched (or enriching failed)
+        for key in ("sentiment_score", "engagement_level"):
+            row[key] = float(row[key]) if row[key] not in (None, "") else None
 
     return jsonify(matching_rows)
 
@@ -115,87 +124,96 @@ def add_customer_social_history():
         if "error" in upload_result:
             return upload_result
         data["image_url"] = upload_result["url"]
-        transcribed = image_transcribe(base64str)
-        data["text_content"] = (
-            data["text_content"].strip()
-            + "\nUploaded image transcript: "
-            + transcribed.strip()
-        ).strip()
-
-    next_id = get_last_id_from_csv("./data/social_media_record.csv", "post_id") + 1
-    data["post_id"] = "POST_" + str(next_id)
+
+    data["post_id"] = store.next_id("social_media_record")
     data["customer_id"] = request.args.get("customer_id")
-    data.pop("sentiment_score", None)
-    data.pop("engagement_level", None)
-    data.pop("brands_liked", None)
-    vals = update_social_media_history(data)
-    data["sentiment_score"] = vals["sentiment_score"]
-    data["engagement_level"] = vals["engagement_level"]
-    data["brands_liked"] = vals["brands_liked"]
-    with open("./data/social_media_record.csv", mode="a", newline="") as file:
-        cols = [
-            "post_id",
-            "customer_id",
-            "date",
-            "platform",
-            "image_url",
-            "text_content",
-            "topics_of_interest",
-            "feedback_on_financial_products",
-            "sentiment_score",
-            "engagement_level",
-            "brands_liked",
-        ]
-        writer = csv.DictWriter(file, fieldnames=cols)
-        writer.writerow(data)
-    return {"customer_id": data["customer_id"]}
+    # scored by the enrichment worker, whatever the client sent is dropped
+    for key in ("sentiment_score", "engagement_level", "brands_liked"):
+        data.pop(key, None)
+    data["enrichment_status"] = PENDING
+    store.add_post(data)
+    get_enrichment_worker().submit("social_media_record", data["post_id"])
+    return {
+        "customer_id": data["customer_id"],
+        "post_id": data["post_id"],
+        "enrichment_status": PENDING,
+    }
 
 
 @app.route("/customer_support_history", methods=["GET"])
 def get_customer_support_history():
     customer_id = request.args.get("customer_id")
-    matching_rows = []
-    cust_sup_hist_df = pd.read_csv("./data/customer_support_record.csv")
-    for index, row in cust_sup_hist_df.iterrows():
-        if row[1] == customer_id:
-            cust_sup_hist_dict = {}
-            for cols in cust_sup_hist_df.columns:
-                cust_sup_hist_dict[cols] = row[cols]
-            matching_rows.append(cust_sup_hist_dict)
+    matching_rows = [typed_row(row) for row in store.get_supports(customer_id)]
+    for row in matching_rows:
+        # null while the query is still being enriched (or enriching failed)
+        if row["sentiment"] == "":
+            row["sentiment"] = None
     return jsonify(matching_rows)
 
 
 @app.route("/customer_support_history", methods=["POST"])
 def add_customer_support_history():
     data = request.get_json()
-    next_id = (
-        get_last_id_from_csv("./data/customer_support_record.csv", "complaint_id") + 1
-    )
-    data["complaint_id"] = "SPRT_" + str(next_id)
+    data["complaint_id"] = store.next_id("customer_support_record")
     data.pop("sentiment", None)
-    data["sentiment"] = update_support_history(data)
-    with open("./data/customer_support_record.csv", mode="a", newline="") as file:
-        cols = [
-            "complaint_id",
-            "customer_id",
-            "date",
-            "transcript",
-            "main_concerns",
-            "is_repeating_issue",
-            "was_issue_resolved",
-            "sentiment",
-        ]
-        writer = csv.DictWriter(file, fieldnames=cols)
-        writer.writerow(data)
-    return {"customer_id": data["customer_id"]}
+    data["enrichment_status"] = PENDING
+    store.add_support(data)
+    get_enrichment_worker().submit("customer_support_record", data["complaint_id"])
+    return {
+        "customer_id": data["customer_id"],
+        "complaint_id": data["complaint_id"],
+        "enrichment_status": PENDING,
+    }
+
+
+@app.route("/enrichment/<record_id>", methods=["GET"])
+def get_enrichment(record_id):
+    # a posted support query or post with its enrichment_status, with
+    # ?wait=<seconds> the request is held until it is no longer pending
+    table = enrichment_table(record_id)
+    if table is None:
+        return {"error": "Unknown record id"}
+    wait = min(request.args.get("wait", 0, type=float), ENRICHMENT_MAX_WAIT)
+    deadline = time.monotonic() + wait
+
+    row = store.get_record(table, record_id)
+    while row and row["enrichment_status"] == PENDING and time.monotonic() < deadline:
+        time.sleep(0.2)
+        row = store.get_record(table, record_id)
+    if row is None:
+        return {"error": "Record not found"}
+    return jsonify(typed_row(row))
 
 
 @app.route("/customer_run_ai", methods=["POST"])
 def customer_run_ai():
     data = request.get_json()
     customer_id = data.get("customer_id", "CUST_1")
-    main(customer_id)
-    return {"customer_id": customer_id}
+    pipeline = data.get("pipeline", RUN_AI_PIPELINE)
+    if pipeline not in PIPELINES:
+        return {"error": f"Unknown pipeline {pipeline}"}
+    if store.get_profile(customer_id) is None:
+        return {"error": "Customer not found"}
+    # customers unchanged since their last results are skipped (the finished
+    # job's result says so), force (body or ?force=1) runs them anyway
+    force = bool(data.get("force")) or request.args.get("force") in ("1", "true")
+    # a run already queued or running for this customer is reused
+    job = get_job_queue().submit(
+        f"run_ai:{customer_id}", main, customer_id, force=force, pipeline=pipeline
+    )
+    return {
+        "customer_id": customer_id,
+        "job_id": job["job_id"],
+        "status": job["status"],
+    }
+
+
+@app.route("/jobs/<job_id>", methods=["GET"])
+def get_job(job_id):
+    job = get_job_queue().get(job_id)
+    if job is None:
+        return {"error": "Job not found"}
+    return job
 
 
 @app.route("/uploads/images/<name>")
@@ -204,5 +222,8 @@ def view_image(name):
 
 
 if __name__ == "__main__":
+    # the debug reloader runs this file in a watcher process and again in the
+    # process serving requests, only the latter picks up pending records
+    if os.environ.get("WERKZEUG_RUN_MAIN") == "true":
+        get_enrichment_worker()
     app.run(debug=True, port=5003)
-
@@ -0,0 +1,135 @@
+import argparse
+import time
+
+import numpy as np
+from generator.banking_products import generate_financial_products
+from param_mapper import cust_map
+from product_index import PRODUCT_PARAMS, ProductIndex
+
+PASSIVE_WEIGHTS = {
+    "risk_customer": 0.0,
+    "value_customer": 0.2,
+    "profit_margin": 0.2,
+    "risk_bank": 0.0,
+    "retention_value": 0.6,
+}
+
+
+def generate_variant_catalog(variants: int, seed=0) -> list[dict]:
+    # regionally priced copies of every base product, attributes jittered a bit
+    rng = np.random.default_rng(seed)
+    base_products = generate_financial_products()
+
+    products = []
+    for region in range(variants):
+        for base in base_products:
+            product = {**base, "product_id": f"PROD_{len(products) + 1}"}
+            for k in PRODUCT_PARAMS:
+                product[k] = float(np.clip(base[k] + rng.normal(0, 0.3), 1, 10))
+            products.append(product)
+    return products
+
+
+def random_customers(count: int, seed=1) -> np.ndarray:
+    rng = np.random.default_rng(seed)
+    input_keys = ["churn_rate", "profit_generated", "risk_appetite", "financial_acumen"]
+    vectors = [
+        cust_map({k: rng.uniform(0, 10) for k in input_keys}) for _ in range(count)
+    ]
+    return np.array([[v[k] for k in PRODUCT_PARAMS] for v in vectors])
+
+
+def recall(exact: list[list[dict]], approx: list[list[dict]]) -> float:
+    hits, total = 0, 0
+    for e, a in zip(exact, approx):
+        expected = {p["index"] for p in e}
+        hits += len(expected & {p["index"] for p in a})
+        total += len(expected)
+    return hits / total if total else 1.0
+
+
+def timed(fn, *args, **kwargs):
+    start = time.perf_counter()
+    result = fn(*args, **kwargs)
+    return result, time.perf_counter() - start
+
+
+def main(args):
+    products = generate_variant_catalog(args.variants)
+    customers = random_customers(args.customers)
+    print(f"Catalog: {len(products)} products, {len(customers)} customers")
+
+    index, build_time = timed(ProductIndex, products)
+    print(f"Index build: {build_time:.2f}s")
+
+    _, tree_time = timed(index.kdtree, index.whitening)
+    print(f"KD-tree build: {tree_time:.2f}s")
+
+    exact, exact_time = timed(index.mahalanobis_dist_batch, customers, args.top_n)
+    exact_passive, exact_passive_time = timed(
+        index.weighted_vector_dist_passive_batch, customers, PASSIVE_WEIGHTS, 8
+    )
+    per_customer = 1000 / len(customers)
+    print(
+        f"{'ranking':<16}{'mahal ms':>10}{'recall':>8}{'passive ms':>12}{'recall':>8}"
+    )
+    print(
+        f"{'exact':<16}{exact_time * per_customer:>10.3f}{1.0:>8.3f}"
+        f"{exact_passive_time * per_customer:>12.3f}{1.0:>8.3f}"
+    )
+
+    for leaves in args.leaves:
+        approx, approx_time = timed(
+            index.mahalanobis_dist_batch, customers, args.top_n, "kdtree", leaves
+        )
+        approx_passive, approx_passive_time = timed(
+            index.weighted_vector_dist_passive_batch,
+            customers,
+            PASSIVE_WEIGHTS,
+            8,
+            "kdtree",
+            leaves,
+        )
+        print(
+            f"{f'kdtree/{leaves}':<16}{approx_time * per_customer:>10.3f}"
+            f"{recall(exact, approx):>8.3f}"
+            f"{approx_passive_time * per_customer:>12.3f}"
+            f"{recall(exact_passive, approx_passive):>8.3f}"
+        )
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(
+        description="Recall vs latency of the KD-tree ranking against the exact one"
+    )
+    parser.add_argument(
+        "--variants",
+        type=int,
+        default=1000,
+        required=False,
+        help="Number of regional variants of every base product",
+    )
+    parser.add_argument(
+        "--customers",
+        type=int,
+        default=200,
+        required=False,
+        help="Number of random customers to rank",
+    )
+    parser.add_argument(
+        "--top_n",
+        type=int,
+        default=12,
+        required=False,
+        help="Number of products to rank per customer",
+    )
+    parser.add_argument(
+        "--leaves",
+        type=int,
+        nargs="+",
+        default=[1, 2, 4, 8, 16, 32],
+        required=False,
+        help="max_leaves values to benchmark for the KD-tree",
+    )
+    args = parser.parse_args()
+    main(args)
@@ -0,0 +1,91 @@
+import argparse
+import time
+
+import numpy as np
+from customer_store import get_store
+from llm_client import get_cache
+from main import PIPELINES, run_customers
+from utils import StageTimer
+
+
+def percentile(values: list[float], q: float) -> float:
+    return float(np.percentile(values, q)) if values else 0.0
+
+
+def benchmark(customer_ids: list[str], pipeline: str, ranking: str) -> dict:
+    # one customer at a time like /customer_run_ai, results are not saved
+    cache = get_cache()
+    timer = StageTimer()
+    latencies = []
+    requests_before = cache.misses
+    for customer_id in customer_ids:
+        start = time.perf_counter()
+        run_customers(
+            [customer_id],
+            ranking,
+            timer=timer,
+            force=True,
+            pipeline=pipeline,
+            save=False,
+        )
+        latencies.append(time.perf_counter() - start)
+
+    return {
+        "requests": (cache.misses - requests_before) / len(customer_ids),
+        "p50": percentile(latencies, 50),
+        "p95": percentile(latencies, 95),
+        "max": max(latencies),
+        "stages": timer.report(),
+    }
+
+
+def main(args):
+    # every request goes to the model, cached answers would hide the latency
+    get_cache().bypass = True
+    customer_ids = get_store().get_customer_ids()[: args.customers]
+    print(f"Benchmarking {len(customer_ids)} customers")
+
+    results = {
+        pipeline: benchmark(customer_ids, pipeline, args.ranking)
+        for pipeline in args.pipelines
+    }
+
+    print(f"{'pipeline':<12}{'requests':>10}{'p50 s':>10}{'p95 s':>10}{'max s':>10}")
+    for pipeline, result in results.items():
+        print(
+            f"{pipeline:<12}{result['requests']:>10.2f}{result['p50']:>10.2f}"
+            f"{result['p95']:>10.2f}{result['max']:>10.2f}"
+        )
+    for pipeline, result in results.items():
+        print(f"{pipeline} stage timings: {result['stages']}")
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(
+        description="Per customer latency of the multi and combined LLM pipelines"
+    )
+    parser.add_argument(
+        "--customers",
+        type=int,
+        default=10,
+        required=False,
+        help="Number of customers to run, taken from the start of the store",
+    )
+    parser.add_argument(
+        "--pipelines",
+        type=str,
+        nargs="+",
+        default=PIPELINES,
+        choices=PIPELINES,
+        required=False,
+        help="Pipelines to benchmark",
+    )
+    parser.add_argument(
+        "--ranking",
+        type=str,
+        default="exact",
+        required=False,
+        help="Product ranking backend",
+    )
+    args = parser.parse_args()
+    main(args)
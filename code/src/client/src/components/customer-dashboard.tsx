@@ -38,7 +38,11 @@ export default function CustomerDashboard() {
     const { data: customerInfo, isLoading: isCustomerLoading } = useCustomerInfo(
         selectedCustomerId || ""
     );
-    const { mutate: runAi, isPending: isRunningAi } = useCustomerRunAi();
+    const {
+        mutate: runAi,
+        isPending: isRunningAi,
+        data: runAiResult,
+    } = useCustomerRunAi();
 
     return (
         <div className="container mx-auto py-6">
@@ -90,6 +94,25 @@ export default function CustomerDashboard() {
                             </Button>
                         )}
                     </div>
+                    {!isRunningAi &&
+                        runAiResult?.status === "skipped" &&
+                        runAiResult.customer_id === selectedCustomerId && (
+                            <p className="mt-2 text-sm text-muted-foreground">
+                                Nothing changed since the last run, skipped.{" "}
+                                <Button
+                                    variant="link"
+                                    className="h-auto p-0"
+                                    onClick={() => {
+                                        runAi({
+                                            customerId: selectedCustomerId!,
+                                            force: true,
+                                        });
+                                    }}
+                                >
+                                    Run anyway
+                                </Button>
+                            </p>
+                        )}
                 </CardContent>
             </Card>
 
@@ -124,7 +124,10 @@ export default function CustomerSocialMedia({
                       {formatDate(social.date)}
                     </div>
                   </div>
-                  <Sentiment sentiment={social.sentiment_score} />
+                  <Sentiment
+                    sentiment={social.sentiment_score}
+                    enrichmentStatus={social.enrichment_status}
+                  />
                 </div>
 
                 <div className="mb-3">
@@ -156,7 +156,10 @@ export default function CustomerSupportHistory({
                         </>
                       )}
                     </div>
-                    <Sentiment sentiment={support.sentiment} />
+                    <Sentiment
+                      sentiment={support.sentiment}
+                      enrichmentStatus={support.enrichment_status}
+                    />
                   </div>
                 </div>
 
@@ -18,10 +18,19 @@ const getSentimentLabel = (sentiment: number) => {
 };
 
 interface SentimentProps {
-    sentiment: number
+    // null until the backend has scored the record
+    sentiment: number | null
+    enrichmentStatus?: string
 }
 
-const Sentiment = ({ sentiment }: SentimentProps) => {
+const Sentiment = ({ sentiment, enrichmentStatus }: SentimentProps) => {
+    if (sentiment === null) {
+        return (
+            <div className="flex items-center text-xs text-muted-foreground">
+                Sentiment: {enrichmentStatus === "failed" ? "Not scored" : "Scoring..."}
+            </div>
+        )
+    }
     return (
         <div
             className={`flex items-center text-xs group ${getSentimentColor(
@@ -46,9 +46,11 @@ const CustomerSupportHistorySchema = z.object({
   date: z.string(),
   is_repeating_issue: z.boolean(),
   main_concerns: z.array(z.string()),
-  sentiment: z.number(),
+  // null until the backend has scored the query
+  sentiment: z.number().nullable(),
   transcript: z.string(),
   was_issue_resolved: z.boolean(),
+  enrichment_status: z.string().optional(),
 });
 
 const CustomerPurchaseHistorySchema = z.object({
@@ -68,14 +70,16 @@ const CustomerSocialMediaHistorySchema = z.object({
   brands_liked: z.array(z.string()),
   customer_id: z.string(),
   date: z.string(),
-  engagement_level: z.number(),
+  // null until the backend has scored the post
+  engagement_level: z.number().nullable(),
   feedback_on_financial_products: z.string(),
   image_url: z.string(),
   platform: z.string(),
   post_id: z.string(),
-  sentiment_score: z.number(),
+  sentiment_score: z.number().nullable(),
   text_content: z.string(),
   topics_of_interest: z.array(z.string()),
+  enrichment_status: z.string().optional(),
 });
 
 export type CustomerInfo = z.infer<typeof CustomerInfoSchema>;
@@ -189,6 +193,20 @@ export const useUpdateCustomerInfo = () => {
   });
 };
 
+// Wait until the backend has scored a posted support query or post, the
+// request is held by the backend while it is pending
+const waitForEnrichment = async (recordId: string) => {
+  for (let attempt = 0; attempt < 10; attempt++) {
+    const { data } = await axios.get(
+      `${API_BASE_URL}/enrichment/${recordId}`,
+      { params: { wait: 25 } }
+    );
+    if (data.error || data.enrichment_status !== "pending") {
+      return;
+    }
+  }
+};
+
 // Fetch customer support history
 export const useCustomerSupportHistory = (customerId: string) => {
   return useQuery({
@@ -217,7 +235,7 @@ export const addCustomerSupportHistory = async ({
 }: {
   customerId: string;
   data: any;
-}): Promise<{ customer_id: string }> => {
+}): Promise<{ customer_id: string; complaint_id: string }> => {
   return axios
     .post(`${API_BASE_URL}/customer_support_history`, data, {
       params: { customer_id: customerId },
@@ -229,10 +247,13 @@ export const useAddCustomerSupportHistory = () => {
   const queryClient = useQueryClient();
   return useMutation({
     mutationFn: addCustomerSupportHistory,
-    onSuccess: ({ customer_id }: { customer_id: string }) => {
-      queryClient.invalidateQueries({
-        queryKey: ["customer-support-history", customer_id],
-      });
+    onSuccess: ({ customer_id, complaint_id }) => {
+      const queryKey = ["customer-support-history", customer_id];
+      queryClient.invalidateQueries({ queryKey });
+      // shown unscored first, refreshed once the sentiment is in
+      waitForEnrichment(complaint_id)
+        .catch((err) => console.log(err))
+        .finally(() => queryClient.invalidateQueries({ queryKey }));
     },
   });
 };
@@ -313,7 +334,7 @@ export const addCustomerSocialMediaHistory = async ({
 }: {
   customerId: string;
   data: any;
-}): Promise<{ customer_id: string }> => {
+}): Promise<{ customer_id: string; post_id: string }> => {
   return axios
     .post(`${API_BASE_URL}/customer_social_media_history`, data, {
       params: { customer_id: customerId },
@@ -325,24 +346,55 @@ export const useAddCustomerSocialMediaHistory = () => {
   const queryClient = useQueryClient();
   return useMutation({
     mutationFn: addCustomerSocialMediaHistory,
-    onSuccess: ({ customer_id }: { customer_id: string }) => {
-      queryClient.invalidateQueries({
-        queryKey: ["customer-social-media-history", customer_id],
-      });
+    onSuccess: ({ customer_id, post_id }) => {
+      const queryKey = ["customer-social-media-history", customer_id];
+      queryClient.invalidateQueries({ queryKey });
+      // shown unscored first, refreshed once the sentiment is in
+      waitForEnrichment(post_id)
+        .catch((err) => console.log(err))
+        .finally(() => queryClient.invalidateQueries({ queryKey }));
     },
   });
 };
 
+const waitForJob = async (jobId: string) => {
+  for (;;) {
+    const { data } = await axios.get(`${API_BASE_URL}/jobs/${jobId}`);
+    if (data.error) {
+      throw new Error(data.error);
+    }
+    if (data.status === "done") {
+      return data;
+    }
+    if (data.status === "failed") {
+      throw new Error(`Run AI job ${jobId} failed`);
+    }
+    await new Promise((resolve) => setTimeout(resolve, 1000));
+  }
+};
+
 export const customerRunAi = async ({
   customerId,
+  force = false,
 }: {
   customerId: string;
-}): Promise<{ customer_id: string }> => {
-  return axios
-    .post(`${API_BASE_URL}/customer_run_ai`, {
-      params: { customer_id: customerId },
-    })
-    .then((res) => res.data);
+  force?: boolean;
+}): Promise<{ customer_id: string; status: string; reason?: string }> => {
+  // the backend queues the run and returns a job id, poll it until done.
+  // Customers unchanged since their last run are skipped unless forced
+  const { data } = await axios.post(`${API_BASE_URL}/customer_run_ai`, {
+    customer_id: customerId,
+    force,
+  });
+  if (data.error) {
+    throw new Error(data.error);
+  }
+  const job = await waitForJob(data.job_id);
+  return {
+    customer_id: data.customer_id,
+    status: job.result?.status ?? "scored",
+    reason: job.result?.reason,
+  };
 };
 
 export const useCustomerRunAi = () => {
@@ -0,0 +1,142 @@
+import os
+from collections import Counter
+
+# approximate prompt tokens the customer history may take, the oldest rows
+# beyond it are summarized instead of listed
+CONTEXT_TOKENS = int(os.getenv("LLM_CONTEXT_TOKENS", "4000"))
+# longest value (transcripts, post texts) put into the prompt, in characters
+MAX_VALUE_CHARS = int(os.getenv("LLM_CONTEXT_MAX_VALUE_CHARS", "400"))
+# room kept per section for the line summarizing the omitted rows
+SUMMARY_TOKENS = 60
+
+# ids mean nothing to the model, the image link can't be opened and the
+# enrichment status is bookkeeping of the backend
+DROP_COLUMNS = {
+    "customer_id",
+    "transaction_id",
+    "post_id",
+    "complaint_id",
+    "image_url",
+    "enrichment_status",
+}
+
+SECTIONS = {
+    "transactions": {"label": "transactions", "total": "amt", "top": "item_category"},
+    "posts": {
+        "label": "posts",
+        "average": "sentiment_score",
+        "top": "topics_of_interest",
+    },
+    "supports": {
+        "label": "support queries",
+        "average": "sentiment",
+        "top": "main_concerns",
+    },
+}
+
+
+def count_tokens(text: str) -> int:
+    # rough count (~4 characters per token), same as llm_client.estimate_tokens
+    return len(text) // 4 + 1
+
+
+def clip(value) -> str:
+    text = " ".join(str(value).split())
+    if len(text) > MAX_VALUE_CHARS:
+        text = text[: MAX_VALUE_CHARS - 3] + "..."
+    return text
+
+
+def date_key(row: dict) -> str:
+    # dates are DD/MM/YYYY, YYYYMMDD sorts chronologically
+    parts = str(row.get("date", "")).split("/")
+    if len(parts) != 3:
+        return ""
+    return parts[2] + parts[1].zfill(2) + parts[0].zfill(2)
+
+
+def to_float(value) -> float | None:
+    try:
+        return float(value)
+    except (TypeError, ValueError):
+        return None
+
+
+def summarize(rows: list[dict], spec: dict) -> str:
+    dates = sorted((date_key(row), row.get("date", "")) for row in rows)
+    summary = (
+        f"({len(rows)} older {spec['label']} from {dates[0][1]} "
+        f"to {dates[-1][1]} not listed"
+    )
+
+    if "total" in spec:
+        values = [to_float(row.get(spec["total"])) for row in rows]
+        values = [v for v in values if v is not None]
+        summary += f", total {spec['total']} {sum(values):.2f}"
+    if "average" in spec:
+        values = [to_float(row.get(spec["average"])) for row in rows]
+        values = [v for v in values if v is not None]
+        if values:
+            summary += f", average {spec['average']} {sum(values) / len(values):.2f}"
+
+    counts = Counter(
+        item.strip()
+        for row in rows
+        for item in str(row.get(spec["top"], "")).split(",")
+        if item.strip()
+    )
+    if counts:
+        top = ", ".join(item for item, _ in counts.most_common(3))
+        summary += f", mostly {spec['top']}: {top}"
+    return summary + ")"
+
+
+def build_context(cust_info: dict, budget: int = CONTEXT_TOKENS) -> dict:
+    # Customer history as compact text for the prompts: persona as key: value
+    # lines, every history section as a " | " separated table without the ids.
+    # When the tables don't fit the budget the newest rows (across all
+    # sections) are kept and the older ones summarized in one line each.
+    persona = "\n".join(
+        f"{key}: {clip(value)}"
+        for key, value in cust_info["persona"].items()
+        if key not in DROP_COLUMNS
+    )
+    remaining = budget - count_tokens(persona)
+
+    tables, candidates = {}, []
+    for section in SECTIONS:
+        rows = cust_info[section]
+        columns = [c for c in (rows[0] if rows else {}) if c not in DROP_COLUMNS]
+        lines = [" | ".join(clip(row.get(c, "")) for c in columns) for row in rows]
+        tables[section] = (" | ".join(columns), lines)
+        remaining -= count_tokens(tables[section][0]) + SUMMARY_TOKENS
+        candidates.extend((date_key(row), i, section) for i, row in enumerate(rows))
+
+    kept = {section: set() for section in SECTIONS}
+    for _, i, section in sorted(candidates, reverse=True):
+        cost = count_tokens(tables[section][1][i])
+        if cost > remaining:
+            break
+        kept[section].add(i)
+        remaining -= cost
+
+    context = {"persona": persona}
+    for section, spec in SECTIONS.items():
+        rows = cust_info[section]
+        if not rows:
+            context[section] = "none"
+            continue
+
+        # listed in chronological order, like the persona's lists
+        order = sorted(range(len(rows)), key=lambda i: (date_key(rows[i]), i))
+        header, lines = tables[section]
+        listed = [lines[i] for i in order if i in kept[section]]
+        omitted = [rows[i] for i in order if i not in kept[section]]
+        if omitted:
+            listed.insert(0, summarize(omitted, spec))
+        context[section] = "\n".join([header, *listed])
+
+    context["tokens"] = sum(
+        count_tokens(context[key]) for key in ["persona", *SECTIONS]
+    )
+    return context
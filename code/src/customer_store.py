@@ -0,0 +1,583 @@
+import argparse
+import csv
+import os
+import sqlite3
+import threading
+import time
+from contextlib import contextmanager
+
+DATA_DIR = "./data"
+DB_PATH = os.path.join(DATA_DIR, "customers.db")
+
+TABLES = {
+    "customer_profile": {
+        "id_prefix": "CUST_",
+        "file": "customer_profile.csv",
+        "id_column": "customer_id",
+        "columns": [
+            "customer_id",
+            "age",
+            "gender",
+            "education",
+            "is_married",
+            "num_of_children",
+            "location",
+            "income",
+            "job",
+            "goals",
+            "credit_score",
+            "preferred_payment_method",
+            "balance",
+            "loan_amts",
+            "monthly_spending",
+            "main_purchase_cat",
+            "support_interaction_count",
+            "satisfaction",
+            "input_params",
+            "output_params",
+            "top_n_products",
+            "top_n_passive_products",
+        ],
+    },
+    "customer_purchase": {
+        "id_prefix": "TXN_",
+        "file": "customer_purchase.csv",
+        "id_column": "transaction_id",
+        "columns": [
+            "transaction_id",
+            "customer_id",
+            "date",
+            "platform",
+            "payment_method",
+            "amt",
+            "location",
+            "item_category",
+            "item_sub_category",
+            "item_brand",
+        ],
+    },
+    "social_media_record": {
+        "id_prefix": "POST_",
+        "file": "social_media_record.csv",
+        "id_column": "post_id",
+        "columns": [
+            "post_id",
+            "customer_id",
+            "date",
+            "platform",
+            "image_url",
+            "text_content",
+            "topics_of_interest",
+            "feedback_on_financial_products",
+            "sentiment_score",
+            "engagement_level",
+            "brands_liked",
+            "enrichment_status",
+        ],
+    },
+    "customer_support_record": {
+        "id_prefix": "SPRT_",
+        "file": "customer_support_record.csv",
+        "id_column": "complaint_id",
+        "columns": [
+            "complaint_id",
+            "customer_id",
+            "date",
+            "transcript",
+            "main_concerns",
+            "is_repeating_issue",
+            "was_issue_resolved",
+            "sentiment",
+            "enrichment_status",
+        ],
+    },
+}
+
+
+# enrichment_status of records saved before their sentiment is filled in,
+# see enrichment.py. Empty for records that never needed enriching.
+PENDING = "pending"
+
+RESULT_COLUMNS = [
+    "input_params",
+    "output_params",
+    "top_n_products",
+    "top_n_passive_products",
+]
+
+
+class CustomerStore:
+    # All customer data lives in one SQLite file, every table is indexed on
+    # customer_id so loading a customer only touches that customer's rows.
+    # Values are stored as text, exactly as they appear in the csv files.
+
+    def __init__(self, db_path: str = DB_PATH, data_dir: str = DATA_DIR):
+        self.db_path = db_path
+        self.data_dir = data_dir
+        self._local = threading.local()
+
+        self.create_tables()
+        if not self.get_customer_ids():
+            # first start, seed from the csv files
+            self.import_csvs(data_dir)
+
+    @property
+    def conn(self) -> sqlite3.Connection:
+        # sqlite connections can't be shared across threads (flask is threaded)
+        conn = getattr(self._local, "conn", None)
+        if conn is None:
+            conn = sqlite3.connect(self.db_path, timeout=30)
+            conn.row_factory = sqlite3.Row
+            conn.execute("PRAGMA journal_mode=WAL")
+            self._local.conn = conn
+        return conn
+
+    def create_tables(self):
+        with self.conn:
+            for table, spec in TABLES.items():
+                columns = ", ".join(
+                    f"{c} TEXT PRIMARY KEY" if c == spec["id_column"] else f"{c} TEXT"
+                    for c in spec["columns"]
+                )
+                self.conn.execute(f"CREATE TABLE IF NOT EXISTS {table} ({columns})")
+                # databases created before a column was added to TABLES
+                existing = {
+                    row[1] for row in self.conn.execute(f"PRAGMA table_info({table})")
+                }
+                for column in spec["columns"]:
+                    if column not in existing:
+                        self.conn.execute(
+                            f"ALTER TABLE {table} ADD COLUMN {column} TEXT"
+                        )
+                if table != "customer_profile":
+                    self.conn.execute(
+                        f"CREATE INDEX IF NOT EXISTS {table}_customer_id "
+                        f"ON {table} (customer_id)"
+                    )
+            # high-water mark of the numeric id suffix handed out per table
+            self.conn.execute(
+                "CREATE TABLE IF NOT EXISTS id_sequences "
+                "(table_name TEXT PRIMARY KEY, last_id INTEGER NOT NULL)"
+            )
+            self._seed_id_sequences()
+
+            # recommendation results are kept apart from the profile, one row
+            # per customer plus every earlier version in the history table
+            result_columns = ", ".join(f"{c} TEXT" for c in RESULT_COLUMNS)
+            self.conn.execute(
+                "CREATE TABLE IF NOT EXISTS recommendation_results "
+                "(customer_id TEXT PRIMARY KEY, version INTEGER NOT NULL, "
+                f"{result_columns}, updated_at TEXT NOT NULL)"
+            )
+            self.conn.execute(
+                "CREATE TABLE IF NOT EXISTS recommendation_history "
+                "(customer_id TEXT NOT NULL, version INTEGER NOT NULL, "
+                f"{result_columns}, updated_at TEXT NOT NULL, "
+                "PRIMARY KEY (customer_id, version))"
+            )
+            # what the latest results were computed from, see main.run_customers
+            self.conn.execute(
+                "CREATE TABLE IF NOT EXISTS result_fingerprints "
+                "(customer_id TEXT PRIMARY KEY, input_fingerprint TEXT NOT NULL, "
+                "catalog_version TEXT NOT NULL)"
+            )
+            self._seed_results()
+
+    def import_csvs(self, data_dir: str = DATA_DIR, replace=False):
+        # adds the csv rows whose id isn't in the store yet, rows created or
+        # updated through the store are kept. replace=True empties the tables
+        # first, dropping everything that isn't in the csv files.
+        with self.conn:
+            for table, spec in TABLES.items():
+                file_path = os.path.join(data_dir, spec["file"])
+                if not os.path.exists(file_path):
+                    continue
+                if replace:
+                    self.conn.execute(f"DELETE FROM {table}")
+
+                with open(file_path, "r", newline="", encoding="utf-8") as file:
+                    rows = csv.DictReader(file)
+                    self.conn.executemany(
+                        self._insert_sql(table, "INSERT OR IGNORE"),
+                        ([row.get(c, "") for c in spec["columns"]] for row in rows),
+                    )
+            self._seed_id_sequences()
+            self._seed_results()
+
+    def _insert_sql(self, table: str, verb="INSERT") -> str:
+        columns = TABLES[table]["columns"]
+        return (
+            f"{verb} INTO {table} ({', '.join(columns)}) "
+            f"VALUES ({', '.join('?' for _ in columns)})"
+        )
+
+    def _select(self, table: str, where: str, *args) -> list[dict]:
+        rows = self.conn.execute(
+            f"SELECT {', '.join(TABLES[table]['columns'])} FROM {table} "
+            f"WHERE {where} ORDER BY rowid",
+            args,
+        )
+        return [dict(row) for row in rows]
+
+    def _insert(self, table: str, row: dict):
+        with self.conn:
+            self.conn.execute(
+                self._insert_sql(table),
+                [row.get(c, "") for c in TABLES[table]["columns"]],
+            )
+
+    def get_customer_ids(self) -> list[str]:
+        rows = self.conn.execute(
+            "SELECT customer_id FROM customer_profile ORDER BY rowid"
+        )
+        return [row[0] for row in rows]
+
+    def get_profile(self, customer_id: str) -> dict | None:
+        rows = self._select("customer_profile", "customer_id = ?", customer_id)
+        if not rows:
+            return None
+        # latest recommendation results take the place of the seeded columns
+        results = self.get_results(customer_id)
+        if results:
+            rows[0].update({c: results[c] for c in RESULT_COLUMNS})
+        return rows[0]
+
+    def _seed_results(self):
+        # results that came in through the csv files become version 1
+        columns = ", ".join(RESULT_COLUMNS)
+        self.conn.execute(
+            f"INSERT OR IGNORE INTO recommendation_results "
+            f"(customer_id, version, {columns}, updated_at) "
+            f"SELECT customer_id, 1, {columns}, datetime('now') "
+            "FROM customer_profile WHERE COALESCE(top_n_products, '') != ''"
+        )
+        self.conn.execute(
+            f"INSERT OR IGNORE INTO recommendation_history "
+            f"(customer_id, version, {columns}, updated_at) "
+            f"SELECT customer_id, version, {columns}, updated_at "
+            "FROM recommendation_results"
+        )
+
+    def get_results(self, customer_id: str) -> dict | None:
+        row = self.conn.execute(
+            f"SELECT customer_id, version, {', '.join(RESULT_COLUMNS)}, updated_at "
+            "FROM recommendation_results WHERE customer_id = ?",
+            (customer_id,),
+        ).fetchone()
+        return dict(row) if row else None
+
+    def get_result_history(self, customer_id: str) -> list[dict]:
+        rows = self.conn.execute(
+            f"SELECT customer_id, version, {', '.join(RESULT_COLUMNS)}, updated_at "
+            "FROM recommendation_history WHERE customer_id = ? ORDER BY version",
+            (customer_id,),
+        )
+        return [dict(row) for row in rows]
+
+    def get_fingerprints(self, customer_ids: list[str]) -> dict[str, dict]:
+        # customer_id -> {input_fingerprint, catalog_version} of the latest results
+        # looked up in chunks, SQLite limits the number of ? per query
+        fingerprints = {}
+        customer_ids = list(dict.fromkeys(customer_ids))
+        for start in range(0, len(customer_ids), 500):
+            chunk = customer_ids[start : start + 500]
+            rows = self.conn.execute(
+                "SELECT customer_id, input_fingerprint, catalog_version "
+                "FROM result_fingerprints WHERE customer_id IN "
+                f"({', '.join('?' for _ in chunk)})",
+                chunk,
+            )
+            fingerprints.update({row[0]: dict(row) for row in rows})
+        return fingerprints
+
+    def save_results(self, results: dict[str, dict]):
+        # customer_id -> result values, committed together in one transaction.
+        # Each customer's row is upserted with a bumped version, and that
+        # version is appended to the history. Values carrying a catalog_version
+        # also record the fingerprint of the inputs they were computed from.
+        columns = ", ".join(RESULT_COLUMNS)
+        placeholders = ", ".join("?" for _ in RESULT_COLUMNS)
+        updates = ", ".join(f"{c} = excluded.{c}" for c in RESULT_COLUMNS)
+
+        conn = self.conn
+        conn.execute("BEGIN IMMEDIATE")
+        try:
+            for customer_id, values in results.items():
+                params = [customer_id, *(values.get(c, "") for c in RESULT_COLUMNS)]
+                conn.execute(
+                    f"INSERT INTO recommendation_results "
+                    f"(customer_id, version, {columns}, updated_at) "
+                    f"VALUES (?, 1, {placeholders}, datetime('now')) "
+                    f"ON CONFLICT (customer_id) DO UPDATE SET {updates}, "
+                    "version = version + 1, updated_at = excluded.updated_at",
+                    params,
+                )
+                conn.execute(
+                    f"INSERT INTO recommendation_history "
+                    f"(customer_id, version, {columns}, updated_at) "
+                    f"SELECT customer_id, version, {columns}, updated_at "
+                    "FROM recommendation_results WHERE customer_id = ?",
+                    (customer_id,),
+                )
+                if "catalog_version" in values:
+                    conn.execute(
+                        "INSERT OR REPLACE INTO result_fingerprints "
+                        "(customer_id, input_fingerprint, catalog_version) "
+                        "VALUES (?, ?, ?)",
+                        (
+                            customer_id,
+                            values.get("input_fingerprint", ""),
+                            values["catalog_version"],
+                        ),
+                    )
+            conn.commit()
+        except BaseException:
+            conn.rollback()
+            raise
+
+    def get_transactions(self, customer_id: str) -> list[dict]:
+        return self._select("customer_purchase", "customer_id = ?", customer_id)
+
+    def get_posts(self, customer_id: str) -> list[dict]:
+        return self._select("social_media_record", "customer_id = ?", customer_id)
+
+    def get_supports(self, customer_id: str) -> list[dict]:
+        return self._select("customer_support_record", "customer_id = ?", customer_id)
+
+    def get_record(self, table: str, record_id: str) -> dict | None:
+        rows = self._select(table, f"{TABLES[table]['id_column']} = ?", record_id)
+        return rows[0] if rows else None
+
+    def get_pending(self, table: str, status: str = PENDING) -> list[dict]:
+        # rows with this enrichment_status, pending ones by default
+        return self._select(table, "enrichment_status = ?", status)
+
+    def update_record(self, table: str, record_id: str, values: dict):
+        # values of some columns of one record, the id and customer stay
+        columns = [
+            c
+            for c in values
+            if c in TABLES[table]["columns"]
+            and c not in ("customer_id", TABLES[table]["id_column"])
+        ]
+        if not columns:
+            return
+        with self.conn:
+            self.conn.execute(
+                f"UPDATE {table} SET {', '.join(f'{c} = ?' for c in columns)} "
+                f"WHERE {TABLES[table]['id_column']} = ?",
+                [values[c] for c in columns] + [record_id],
+            )
+
+    def get_table(self, table: str) -> list[dict]:
+        # every row of a table, for jobs that work on the whole history
+        return self._select(table, "1 = 1")
+
+    def customers_active_since(self, since: str) -> list[str]:
+        # customers with a transaction, post or support query on or after
+        # since (YYYY-MM-DD); record dates are stored as DD/MM/YYYY
+        iso_date = "SUBSTR(date, 7, 4) || '-' || SUBSTR(date, 4, 2) || '-' || SUBSTR(date, 1, 2)"
+        query = " UNION ".join(
+            f"SELECT customer_id FROM {table} WHERE {iso_date} >= ?"
+            for table in [
+                "customer_purchase",
+                "social_media_record",
+                "customer_support_record",
+            ]
+        )
+        active = {row[0] for row in self.conn.execute(query, (since, since, since))}
+        return [c for c in self.get_customer_ids() if c in active]
+
+    def add_transaction(self, row: dict):
+        self._insert("customer_purchase", row)
+
+    def add_post(self, row: dict):
+        self._insert("social_media_record", row)
+
+    def add_support(self, row: dict):
+        self._insert("customer_support_record", row)
+
+    def _seed_id_sequences(self):
+        # never move a sequence backwards, ids stay unique even after a re-import
+        for table, spec in TABLES.items():
+            id_column = spec["id_column"]
+            self.conn.execute(
+                "INSERT INTO id_sequences (table_name, last_id) "
+                f"SELECT ?, COALESCE(MAX(CAST(SUBSTR({id_column}, "
+                f"INSTR({id_column}, '_') + 1) AS INTEGER)), 0) FROM {table} "
+                "WHERE true ON CONFLICT (table_name) "
+                "DO UPDATE SET last_id = MAX(last_id, excluded.last_id)",
+                (table,),
+            )
+
+    def next_id(self, table: str) -> str:
+        # BEGIN IMMEDIATE takes the database write lock, so concurrent requests
+        # (threads or other processes) can never get the same id
+        conn = self.conn
+        conn.execute("BEGIN IMMEDIATE")
+        try:
+            conn.execute(
+                "UPDATE id_sequences SET last_id = last_id + 1 WHERE table_name = ?",
+                (table,),
+            )
+            row = conn.execute(
+                "SELECT last_id FROM id_sequences WHERE table_name = ?", (table,)
+            ).fetchone()
+            conn.commit()
+        except BaseException:
+            conn.rollback()
+            raise
+        return TABLES[table]["id_prefix"] + str(row[0])
+
+
+class CachedCustomerStore(CustomerStore):
+    # Keeps the history tables in memory as customer_id -> rows, loaded once.
+    # Inserts through this store update the cache in place; writes from other
+    # processes (main.py, the importer) are picked up by watching the database
+    # files and reloading.
+
+    CACHED_TABLES = [
+        "customer_purchase",
+        "social_media_record",
+        "customer_support_record",
+    ]
+
+    def __init__(
+        self, db_path: str = DB_PATH, data_dir: str = DATA_DIR, check_interval=1.0
+    ):
+        self.check_interval = check_interval
+        self._cache: dict[str, dict[str, list[dict]]] = {}
+        self._cache_lock = threading.RLock()
+        self._file_version = None
+        self._checked_at = 0.0
+        super().__init__(db_path, data_dir)
+        if not self._cache:
+            self.reload()
+
+    def _db_file_version(self) -> tuple:
+        version = []
+        for path in (self.db_path, self.db_path + "-wal"):
+            try:
+                stat = os.stat(path)
+                version.append((stat.st_mtime_ns, stat.st_size))
+            except FileNotFoundError:
+                version.append(None)
+        return tuple(version)
+
+    def reload(self):
+        with self._cache_lock:
+            file_version = self._db_file_version()
+            cache = {}
+            for table in self.CACHED_TABLES:
+                rows_by_customer = {}
+                for row in self._select(table, "1 = 1"):
+                    rows_by_customer.setdefault(row["customer_id"], []).append(row)
+                cache[table] = rows_by_customer
+            self._cache = cache
+            self._file_version = file_version
+            self._checked_at = time.monotonic()
+
+    def _rows(self, table: str, customer_id: str) -> list[dict]:
+        with self._cache_lock:
+            if time.monotonic() - self._checked_at >= self.check_interval:
+                self._checked_at = time.monotonic()
+                if self._db_file_version() != self._file_version:
+                    self.reload()
+            # copies, callers convert values in place before returning them
+            return [dict(row) for row in self._cache[table].get(customer_id, [])]
+
+    @contextmanager
+    def _own_write(self):
+        # a write through this store changes the database files too. The
+        # version only moves past it when nothing else wrote since the last
+        # check, otherwise the next read still sees the external change.
+        with self._cache_lock:
+            before = self._db_file_version()
+            yield
+            if before == self._file_version:
+                self._file_version = self._db_file_version()
+
+    def _insert(self, table: str, row: dict):
+        with self._own_write():
+            super()._insert(table, row)
+            if table in self._cache:
+                cached_row = {c: row.get(c, "") for c in TABLES[table]["columns"]}
+                self._cache[table].setdefault(row["customer_id"], []).append(cached_row)
+
+    def update_record(self, table: str, record_id: str, values: dict):
+        with self._own_write():
+            super().update_record(table, record_id, values)
+            if table in self._cache:
+                row = self.get_record(table, record_id)
+                cached = self._cache[table].get(row["customer_id"], []) if row else []
+                id_column = TABLES[table]["id_column"]
+                for i, cached_row in enumerate(cached):
+                    if cached_row[id_column] == record_id:
+                        cached[i] = row
+
+    def save_results(self, results: dict[str, dict]):
+        with self._own_write():
+            super().save_results(results)
+
+    def next_id(self, table: str) -> str:
+        with self._own_write():
+            return super().next_id(table)
+
+    def import_csvs(self, data_dir: str = DATA_DIR, replace=False):
+        super().import_csvs(data_dir, replace)
+        self.reload()
+
+    def get_transactions(self, customer_id: str) -> list[dict]:
+        return self._rows("customer_purchase", customer_id)
+
+    def get_posts(self, customer_id: str) -> list[dict]:
+        return self._rows("social_media_record", customer_id)
+
+    def get_supports(self, customer_id: str) -> list[dict]:
+        return self._rows("customer_support_record", customer_id)
+
+
+_store: CustomerStore | None = None
+_store_lock = threading.Lock()
+
+
+def get_store(cached=False) -> CustomerStore:
+    # One store per process. The backend asks for the cached store at startup,
+    # so main.main running inside the flask process shares its cache.
+    global _store
+    with _store_lock:
+        if _store is None or (cached and not isinstance(_store, CachedCustomerStore)):
+            _store = CachedCustomerStore() if cached else CustomerStore()
+        return _store
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(
+        description="Import the customer csv files into the customer store"
+    )
+    parser.add_argument(
+        "--data_dir",
+        type=str,
+        default=DATA_DIR,
+        required=False,
+        help="Directory with the csv files",
+    )
+    parser.add_argument(
+        "--db",
+        type=str,
+        default=DB_PATH,
+        required=False,
+        help="Path of the SQLite database",
+    )
+    parser.add_argument(
+        "--replace",
+        action="store_true",
+        help="Empty the tables before importing, deletes every record added through the backend",
+    )
+    args = parser.parse_args()
+
+    store = CustomerStore(args.db, args.data_dir)
+    store.import_csvs(args.data_dir, replace=args.replace)
+    for table in TABLES:
+        count = store.conn.execute(f"SELECT COUNT(*) FROM {table}").fetchone()[0]
+        print(f"{table} has {count} rows")
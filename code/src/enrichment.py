@@ -0,0 +1,184 @@
+import base64
+import os
+import queue
+import threading
+import traceback
+from concurrent.futures import ThreadPoolExecutor
+
+from customer_store import PENDING, TABLES, CustomerStore
+from image_describe import image_transcribe
+from image_upload import UPLOAD_FOLDER
+from update_sentiments import (
+    BatchScorer,
+    local_social_media_history,
+    local_support_history,
+)
+
+# most records enriched together, a burst of posts is scored in batches
+ENRICHMENT_BATCH_SIZE = int(os.getenv("ENRICHMENT_BATCH_SIZE", "20"))
+# tries per record before it is marked failed, retries wait
+# ENRICHMENT_RETRY_DELAY seconds, doubling every time
+ENRICHMENT_MAX_ATTEMPTS = int(os.getenv("ENRICHMENT_MAX_ATTEMPTS", "3"))
+ENRICHMENT_RETRY_DELAY = float(os.getenv("ENRICHMENT_RETRY_DELAY", "10"))
+DONE = "done"
+FAILED = "failed"
+
+# enriched table -> kind of update_sentiments.BatchScorer
+KINDS = {"customer_support_record": "support", "social_media_record": "social"}
+UPLOAD_URL = "/uploads/images/"
+TRANSCRIPT_LABEL = "Uploaded image transcript:"
+
+
+def enrichment_table(record_id: str) -> str | None:
+    # the enriched table a record id belongs to, by its prefix
+    for table in KINDS:
+        if record_id.startswith(TABLES[table]["id_prefix"]):
+            return table
+    return None
+
+
+def with_transcript(post: dict) -> str:
+    # text_content of a post with the transcript of its uploaded image, the
+    # image is read back from the upload folder
+    text = post.get("text_content") or ""
+    image_url = post.get("image_url") or ""
+    if not image_url.startswith(UPLOAD_URL) or TRANSCRIPT_LABEL in text:
+        return text
+
+    name = image_url[len(UPLOAD_URL) :]
+    with open(os.path.join(UPLOAD_FOLDER, name), "rb") as f:
+        image = base64.b64encode(f.read()).decode()
+    extension = os.path.splitext(name)[1].lstrip(".")
+    transcribed = image_transcribe(f"data:image/{extension};base64,{image}")
+    return (text.strip() + f"\n{TRANSCRIPT_LABEL} " + transcribed.strip()).strip()
+
+
+class EnrichmentWorker:
+    # Fills in the sentiment of support queries and social media posts (and
+    # engagement, brands and the image transcript of posts) the backend saved
+    # with enrichment_status pending, then marks them done or failed. One
+    # thread takes records in the order they were saved; whatever is waiting
+    # when it gets to them is handled together, so a burst of posts costs a
+    # few batched requests instead of one each. A record that couldn't be
+    # enriched stays pending and is tried again later, up to max_attempts.
+    # Records still pending or failed in a previous run are picked up on
+    # start.
+
+    def __init__(
+        self,
+        store: CustomerStore,
+        batch_size=ENRICHMENT_BATCH_SIZE,
+        workers=4,
+        max_attempts=ENRICHMENT_MAX_ATTEMPTS,
+        retry_delay=ENRICHMENT_RETRY_DELAY,
+    ):
+        self.store = store
+        self.batch_size = batch_size
+        self.workers = workers
+        self.max_attempts = max_attempts
+        self.retry_delay = retry_delay
+        self.queue: queue.Queue[tuple[str, str]] = queue.Queue()
+        # (table, record id) -> failed tries so far, only used by the worker
+        self.attempts: dict[tuple[str, str], int] = {}
+
+        for table in KINDS:
+            for status in (PENDING, FAILED):
+                for row in store.get_pending(table, status):
+                    self.submit(table, row[TABLES[table]["id_column"]])
+        threading.Thread(target=self._run, name="enrichment", daemon=True).start()
+
+    def submit(self, table: str, record_id: str):
+        self.queue.put((table, record_id))
+
+    def _run(self):
+        while True:
+            items = [self.queue.get()]
+            while len(items) < self.batch_size:
+                try:
+                    items.append(self.queue.get_nowait())
+                except queue.Empty:
+                    break
+
+            for table in KINDS:
+                record_ids = [record_id for t, record_id in items if t == table]
+                if not record_ids:
+                    continue
+                try:
+                    failed = self.enrich(table, record_ids)
+                except Exception:
+                    traceback.print_exc()
+                    failed = record_ids
+                for record_id in record_ids:
+                    if record_id in failed:
+                        self.retry(table, record_id)
+                    else:
+                        self.attempts.pop((table, record_id), None)
+
+    def retry(self, table: str, record_id: str):
+        # submitted again after a delay, marked failed after max_attempts
+        key = (table, record_id)
+        self.attempts[key] = self.attempts.get(key, 0) + 1
+        if self.attempts[key] >= self.max_attempts:
+            del self.attempts[key]
+            self.store.update_record(table, record_id, {"enrichment_status": FAILED})
+            print(f"Enriching {record_id} failed {self.max_attempts} times, giving up")
+            return
+
+        delay = self.retry_delay * 2 ** (self.attempts[key] - 1)
+        timer = threading.Timer(delay, self.submit, (table, record_id))
+        timer.daemon = True
+        timer.start()
+
+    def enrich(self, table: str, record_ids: list[str]) -> list[str]:
+        # ids of the records that couldn't be enriched, the rest are done
+        kind = KINDS[table]
+        id_column = TABLES[table]["id_column"]
+        records = [self.store.get_record(table, record_id) for record_id in record_ids]
+        records = [
+            r for r in records if r and r["enrichment_status"] in (PENDING, FAILED)
+        ]
+
+        if kind == "social":
+            # one vision request per image, run side by side
+            with ThreadPoolExecutor(self.workers) as pool:
+                texts = list(pool.map(with_transcript, records))
+            for record, text in zip(records, texts):
+                record["text_content"] = text
+
+        # the local model first, the rest in batches to the LLM. Posts always
+        # go to the LLM for engagement_level and brands_liked, a confident
+        # local sentiment_score is kept over the LLM's
+        values = {}
+        remaining = []
+        local_scores = {}
+        for record in records:
+            if kind == "support":
+                sentiment = local_support_history(record)
+                if sentiment is None:
+                    remaining.append(record)
+                else:
+                    values[record[id_column]] = {"sentiment": sentiment}
+            else:
+                score = local_social_media_history(record)
+                if score is not None:
+                    local_scores[record[id_column]] = score
+                remaining.append(record)
+
+        scorer = BatchScorer(kind, self.batch_size, fill_default=False)
+        for record, scores in zip(remaining, scorer.score(remaining)):
+            if scores is not None and record[id_column] in local_scores:
+                scores["sentiment_score"] = local_scores[record[id_column]]
+            values[record[id_column]] = scores
+
+        failed = []
+        for record in records:
+            scores = values.get(record[id_column])
+            if not scores:
+                failed.append(record[id_column])
+                continue
+            update = {"enrichment_status": DONE, **scores}
+            if kind == "social":
+                update["text_content"] = record["text_content"]
+            self.store.update_record(table, record[id_column], update)
+        print(f"Enriched {len(records) - len(failed)}/{len(records)} {table} records")
+        return failed
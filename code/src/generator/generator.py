@@ -1,67 +1,82 @@
 import argparse
-import csv
-import json
 import os
-import time
+import sys
+from concurrent.futures import ThreadPoolExecutor
 
-import requests
-from dotenv import load_dotenv
+from journal import Journal
 from prompt_list import (
     create_customer_complaint_prompt,
     create_customer_persona_prompt,
     create_social_media_prompt,
     create_transaction_history_prompt,
 )
+from sinks import SINK_FORMATS, open_sink
 
-load_dotenv()
+sys.path.append(os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+from json_stream import JsonArrayParser
+from llm_client import stream_prompt
+from schemas import fix_records
 
-OPEN_ROUTER_KEY = os.getenv("OPEN_ROUTER_KEY")
-OPEN_ROUTER_URL = "https://openrouter.ai/api/v1/chat/completions"
 MODEL = "google/gemini-2.0-pro-exp-02-05:free"
 
-headers = {
-    "Authorization": f"Bearer {OPEN_ROUTER_KEY}",
-    "Content-Type": "application/json",
-}
 
+def request_parse_ret(prompt, count, schema):
+    # records are parsed as the answer streams in, if the stream breaks off
+    # every record that completed before is kept. Records failing the schema
+    # get one follow-up request for just their invalid fields.
+    parser = JsonArrayParser()
+    records = []
+    try:
+        for chunk in stream_prompt(prompt, MODEL):
+            records.extend(parser.feed(chunk))
+    except Exception as e:
+        print(f"Response stream failed after {len(records)} records: {e}")
 
-def request_parse_ret(prompt, count):
-    payload = {"model": MODEL, "messages": [{"role": "user", "content": prompt}]}
-
-    response = requests.post(OPEN_ROUTER_URL, headers=headers, data=json.dumps(payload))
-    final_response = []
-
-    if response.status_code == 200:
-        response_data = response.json()
+    if parser.errors:
+        print(f"Skipped {parser.errors} records that weren't valid JSON")
+    if not records:
+        print("Could not parse JSON from response:", parser.text)
+        return None
+    return fix_records(schema, records, MODEL) or None
 
-        try:
-            response_text = response_data["choices"][0]["message"]["content"]
-            response_text = response_text.strip().lstrip("```json").rstrip("```")
 
-            response_data = json.loads(response_text)
-            response_json = json.dumps(response_data, indent=2)
+def generate_customer_data(customer_id, persona, args, journal):
+    # one customer's complaints -> transactions -> posts, every stage builds
+    # on the previous ones so they stay sequential within a customer. Stages
+    # already in the journal (resumed run) aren't requested again.
+    print(f"Generating Complaint Data {customer_id}/{args.customer_count}")
+    complaints = journal.run_stage(
+        customer_id,
+        "complaints",
+        lambda: request_parse_ret(
+            create_customer_complaint_prompt(
+                persona, persona.get("support_interaction_count", 5)
+            ),
+            persona.get("support_interaction_count", 5),
+            "complaint",
+        ),
+    )
 
-            for i in range(count):
-                try:
-                    start_idx = response_json[i].find("{")
-                    end_idx = response_json[i].rfind("}") + 1
-                    if start_idx != -1 and end_idx != -1:
-                        r = json.loads(response_json[i][start_idx:end_idx])
-                        final_response.append(r)
-                    else:
-                        return json.loads(response_json)
-                except json.JSONDecodeError:
-                    print(f"Could not parse JSON from response[{i}]:", response_json[i])
-                    continue
-        except:
-            print("Could not parse JSON from response:", response_data)
-            return None
-    else:
-        print(f"Error: {response.status_code}")
-        print(response.text)
-        return None
+    print(f"Generating Transaction Data {customer_id}/{args.customer_count}")
+    transactions = journal.run_stage(
+        customer_id,
+        "transactions",
+        lambda: request_parse_ret(
+            create_transaction_history_prompt(persona, args.max_purchase_count, complaints),
+            args.max_purchase_count,
+            "transaction",
+        ),
+    )
 
-    return final_response
+    print(f"Generating Posts Data {customer_id}/{args.customer_count}")
+    posts = journal.run_stage(
+        customer_id,
+        "posts",
+        lambda: request_parse_ret(
+            create_social_media_prompt(persona, args.max_post, complaints, transactions), args.max_post, "post"
+        ),
+    )
+    return complaints, transactions, posts
 
 
 def main(args):
@@ -69,211 +84,234 @@ def main(args):
     if not os.path.exists(output_dir):
         os.makedirs(output_dir)
 
-    customer_file = os.path.join(output_dir, "customer_profile.csv")
-    transactions_file = os.path.join(output_dir, "customer_purchase.csv")
-    social_media_file = os.path.join(output_dir, "social_media_record.csv")
-    support_file = os.path.join(output_dir, "customer_support_record.csv")
+    # progress of the run, --resume continues from its last checkpoint
+    journal = Journal(os.path.join(output_dir, "generator.journal"), args.resume)
+    checkpoint = journal.checkpoint
+    sizes = checkpoint["sizes"] if checkpoint else None
 
-    with open(customer_file, "w", newline="") as f:
-        writer = csv.writer(f)
-        writer.writerow(
-            [
-                "customer_id",
-                "age",
-                "gender",
-                "education",
-                "is_married",
-                "num_of_children",
-                "location",
-                "income",
-                "job",
-                "goals",
-                "credit_score",
-                "preferred_payment_method",
-                "balance",
-                "loan_amts",
-                "monthly_spending",
-                "main_purchase_cat",
-                "support_interaction_count",
-                "satisfaction",
-                "input_params",
-                "output_params",
-                "top_n_products",
-                "top_n_passive_products",
-            ]
-        )
-
-    with open(transactions_file, "w", newline="") as f:
-        writer = csv.writer(f)
-        writer.writerow(
-            [
-                "transaction_id",
-                "customer_id",
-                "date",
-                "platform",
-                "payment_method",
-                "amt",
-                "location",
-                "item_category",
-                "item_sub_category",
-                "item_brand",
-            ]
-        )
-
-    with open(social_media_file, "w", newline="") as f:
-        writer = csv.writer(f)
-        writer.writerow(
-            [
-                "post_id",
-                "customer_id",
-                "date",
-                "platform",
-                "image_url",
-                "text_content",
-                "topics_of_interest",
-                "feedback_on_financial_products",
-                "sentiment_score",
-                "engagement_level",
-                "brands_liked",
-            ]
-        )
+    customer_sink = open_sink(
+        output_dir,
+        "customer_profile",
+        [
+            "customer_id",
+            "age",
+            "gender",
+            "education",
+            "is_married",
+            "num_of_children",
+            "location",
+            "income",
+            "job",
+            "goals",
+            "credit_score",
+            "preferred_payment_method",
+            "balance",
+            "loan_amts",
+            "monthly_spending",
+            "main_purchase_cat",
+            "support_interaction_count",
+            "satisfaction",
+            "input_params",
+            "output_params",
+            "top_n_products",
+            "top_n_passive_products",
+        ],
+        args.format,
+        args.batch_size,
+        sizes,
+    )
 
-    with open(support_file, "w", newline="") as f:
-        writer = csv.writer(f)
-        writer.writerow(
-            [
-                "complaint_id",
-                "customer_id",
-                "date",
-                "transcript",
-                "main_concerns",
-                "is_repeating_issue",
-                "was_issue_resolved",
-                "sentiment",
-            ]
-        )
+    transactions_sink = open_sink(
+        output_dir,
+        "customer_purchase",
+        [
+            "transaction_id",
+            "customer_id",
+            "date",
+            "platform",
+            "payment_method",
+            "amt",
+            "location",
+            "item_category",
+            "item_sub_category",
+            "item_brand",
+        ],
+        args.format,
+        args.batch_size,
+        sizes,
+    )
 
-    # personas = generate_customer_persona(args.customer_count)
-    print("Generating Customer Data")
-    personas = request_parse_ret(
-        create_customer_persona_prompt(args.customer_count, args.max_support_count), args.customer_count
+    social_media_sink = open_sink(
+        output_dir,
+        "social_media_record",
+        [
+            "post_id",
+            "customer_id",
+            "date",
+            "platform",
+            "image_url",
+            "text_content",
+            "topics_of_interest",
+            "feedback_on_financial_products",
+            "sentiment_score",
+            "engagement_level",
+            "brands_liked",
+        ],
+        args.format,
+        args.batch_size,
+        sizes,
     )
-    if not personas:
-        return
 
-    customer_id = 1
-    transaction_id = 1
-    complaint_id = 1
-    post_id = 1
-    for customer_id in range(1, args.customer_count + 1):
-        persona = personas[customer_id - 1]
+    support_sink = open_sink(
+        output_dir,
+        "customer_support_record",
+        [
+            "complaint_id",
+            "customer_id",
+            "date",
+            "transcript",
+            "main_concerns",
+            "is_repeating_issue",
+            "was_issue_resolved",
+            "sentiment",
+        ],
+        args.format,
+        args.batch_size,
+        sizes,
+    )
 
-        with open(customer_file, "a", newline="") as f:
-            writer = csv.writer(f)
-            writer.writerow(
-                [
-                    f"CUST_{customer_id}",
-                    persona.get("age", ""),
-                    persona.get("gender", ""),
-                    persona.get("education", ""),
-                    persona.get("is_married", ""),
-                    persona.get("num_of_children", ""),
-                    persona.get("location", ""),
-                    persona.get("income", ""),
-                    persona.get("job", ""),
-                    persona.get("goals", ""),
-                    persona.get("credit_score", ""),
-                    persona.get("preferred_payment_method", ""),
-                    persona.get("balance", ""),
-                    persona.get("loan_amts", ""),
-                    persona.get("monthly_spending", ""),
-                    persona.get("main_purchase_cat", ""),
-                    persona.get("support_interaction_count", ""),
-                    persona.get("satisfaction", ""),
-                    {},
-                    {},
-                    "",
-                    "",
-                ]
+    sinks = [customer_sink, transactions_sink, social_media_sink, support_sink]
+    try:
+        personas = journal.personas
+        if personas is None:
+            # personas = generate_customer_persona(args.customer_count)
+            print("Generating Customer Data")
+            personas = request_parse_ret(
+                create_customer_persona_prompt(args.customer_count, args.max_support_count), args.customer_count, "persona"
             )
+            if not personas:
+                return
+            journal.save_personas(personas)
+        if len(personas) < args.customer_count:
+            # customers are matched to personas by position
+            print(f"Only {len(personas)} personas, generating {len(personas)} customers")
+            args.customer_count = len(personas)
 
-        print(f"Generating Complaint Data {customer_id}/{args.customer_count}")
-        complaints = request_parse_ret(
-            create_customer_complaint_prompt(
-                persona, persona.get("support_interaction_count", 5)
-            ),
-            persona.get("support_interaction_count", 5),
-        )
-        if complaints:
-            for complaint in complaints:
-                with open(support_file, "a", newline="") as f:
-                    writer = csv.writer(f)
-                    writer.writerow(
-                        [
-                            f"SPRT_{complaint_id}",
-                            f"CUST_{customer_id}",
-                            complaint.get("date", ""),
-                            complaint.get("transcript", ""),
-                            complaint.get("main_concerns", ""),
-                            complaint.get("is_repeating_issue", ""),
-                            complaint.get("was_issue_resolved", ""),
-                            complaint.get("sentiment", ""),
-                        ]
-                    )
-                    complaint_id += 1
+        # customers are generated concurrently, but only this thread writes, in
+        # customer order, so ids are handed out exactly as in a sequential run
+        counters = checkpoint["counters"] if checkpoint else {}
+        transaction_id = counters.get("transaction_id", 1)
+        complaint_id = counters.get("complaint_id", 1)
+        post_id = counters.get("post_id", 1)
+        start = checkpoint["id"] + 1 if checkpoint else 1
+        if start > 1:
+            print(f"Resuming from customer {start}/{args.customer_count}")
 
-        time.sleep(5)
-        print(f"Generating Transaction Data {customer_id}/{args.customer_count}")
-        transactions = request_parse_ret(
-            create_transaction_history_prompt(persona, args.max_purchase_count, complaints),
-            args.max_purchase_count,
-        )
-        if transactions:
-            for transaction in transactions:
-                with open(transactions_file, "a", newline="") as f:
-                    writer = csv.writer(f)
-                    writer.writerow(
-                        [
-                            f"TXN_{transaction_id}",
-                            f"CUST_{customer_id}",
-                            transaction.get("date", ""),
-                            transaction.get("platform", ""),
-                            transaction.get("payment_method", ""),
-                            transaction.get("amt", ""),
-                            transaction.get("location", ""),
-                            transaction.get("item_category", ""),
-                            transaction.get("item_sub_category", ""),
-                            transaction.get("item_brand", ""),
-                        ]
-                    )
-                    transaction_id += 1
+        with ThreadPoolExecutor(args.workers) as pool:
+            futures = [
+                pool.submit(generate_customer_data, customer_id, personas[customer_id - 1], args, journal)
+                for customer_id in range(start, args.customer_count + 1)
+            ]
+            for customer_id, future in enumerate(futures, start=start):
+                persona = personas[customer_id - 1]
+                complaints, transactions, posts = future.result()
+
+                customer_sink.write(
+                    [
+                        f"CUST_{customer_id}",
+                        persona.get("age", ""),
+                        persona.get("gender", ""),
+                        persona.get("education", ""),
+                        persona.get("is_married", ""),
+                        persona.get("num_of_children", ""),
+                        persona.get("location", ""),
+                        persona.get("income", ""),
+                        persona.get("job", ""),
+                        persona.get("goals", ""),
+                        persona.get("credit_score", ""),
+                        persona.get("preferred_payment_method", ""),
+                        persona.get("balance", ""),
+                        persona.get("loan_amts", ""),
+                        persona.get("monthly_spending", ""),
+                        persona.get("main_purchase_cat", ""),
+                        persona.get("support_interaction_count", ""),
+                        persona.get("satisfaction", ""),
+                        {},
+                        {},
+                        "",
+                        "",
+                    ]
+                )
+
+                if complaints:
+                    for complaint in complaints:
+                        support_sink.write(
+                            [
+                                f"SPRT_{complaint_id}",
+                                f"CUST_{customer_id}",
+                                complaint.get("date", ""),
+                                complaint.get("transcript", ""),
+                                complaint.get("main_concerns", ""),
+                                complaint.get("is_repeating_issue", ""),
+                                complaint.get("was_issue_resolved", ""),
+                                complaint.get("sentiment", ""),
+                            ]
+                        )
+                        complaint_id += 1
 
+                if transactions:
+                    for transaction in transactions:
+                        transactions_sink.write(
+                            [
+                                f"TXN_{transaction_id}",
+                                f"CUST_{customer_id}",
+                                transaction.get("date", ""),
+                                transaction.get("platform", ""),
+                                transaction.get("payment_method", ""),
+                                transaction.get("amt", ""),
+                                transaction.get("location", ""),
+                                transaction.get("item_category", ""),
+                                transaction.get("item_sub_category", ""),
+                                transaction.get("item_brand", ""),
+                            ]
+                        )
+                        transaction_id += 1
 
-        time.sleep(5)
-        print(f"Generating Posts Data {customer_id}/{args.customer_count}")
-        posts = request_parse_ret(
-            create_social_media_prompt(persona, args.max_post, complaints, transactions), args.max_post
-        )
-        if posts:
-            for post in posts:
-                with open(social_media_file, "a", newline="") as f:
-                    writer = csv.writer(f)
-                    writer.writerow(
-                        [
-                            f"POST_{post_id}",
-                            f"CUST_{customer_id}",
-                            post.get("date", ""),
-                            post.get("platform", ""),
-                            post.get("image_url", ""),
-                            post.get("text_content", ""),
-                            post.get("topics_of_interest", ""),
-                            post.get("feedback_on_financial_products", ""),
-                            post.get("sentiment_score", ""),
-                            post.get("engagement_level", ""),
-                            post.get("brands_liked", ""),
-                        ]
+                if posts:
+                    for post in posts:
+                        social_media_sink.write(
+                            [
+                                f"POST_{post_id}",
+                                f"CUST_{customer_id}",
+                                post.get("date", ""),
+                                post.get("platform", ""),
+                                post.get("image_url", ""),
+                                post.get("text_content", ""),
+                                post.get("topics_of_interest", ""),
+                                post.get("feedback_on_financial_products", ""),
+                                post.get("sentiment_score", ""),
+                                post.get("engagement_level", ""),
+                                post.get("brands_liked", ""),
+                            ]
+                        )
+                        post_id += 1
+                print(f"Saved Customer Data {customer_id}/{args.customer_count}")
+
+                # parquet files can't be continued, a resumed parquet run
+                # rewrites them from the journaled stages instead
+                last = customer_id == args.customer_count
+                if args.format != "parquet" and (customer_id % args.checkpoint_every == 0 or last):
+                    for sink in sinks:
+                        sink.sync()
+                    journal.save_checkpoint(
+                        customer_id,
+                        {"transaction_id": transaction_id, "complaint_id": complaint_id, "post_id": post_id},
+                        {sink.path: sink.tell() for sink in sinks},
                     )
-                    post_id += 1
+    finally:
+        for sink in sinks:
+            sink.close()
+        journal.close()
 
 
 if __name__ == "__main__":
@@ -308,5 +346,39 @@ if __name__ == "__main__":
         required=False,
         help="Max number of support inquiries per customer",
     )
+    parser.add_argument(
+        "--workers",
+        type=int,
+        default=1,
+        required=False,
+        help="Number of customers generated concurrently (requests stay within LLM_REQUESTS_PER_MINUTE)",
+    )
+    parser.add_argument(
+        "--format",
+        type=str,
+        default="csv",
+        choices=SINK_FORMATS,
+        required=False,
+        help="Output file format, parquet needs pyarrow",
+    )
+    parser.add_argument(
+        "--batch_size",
+        type=int,
+        default=500,
+        required=False,
+        help="Rows buffered per output file before writing",
+    )
+    parser.add_argument(
+        "--checkpoint_every",
+        type=int,
+        default=10,
+        required=False,
+        help="Customers written between checkpoints of the progress journal",
+    )
+    parser.add_argument(
+        "--resume",
+        action="store_true",
+        help="Continue the last run from its latest checkpoint instead of starting over",
+    )
     args = parser.parse_args()
     main(args)
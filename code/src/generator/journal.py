@@ -0,0 +1,91 @@
+import json
+import os
+import threading
+
+
+class Journal:
+    # Append-only progress log of a generator run, one JSON event per line:
+    #   personas    the generated personas
+    #   stage       rows one stage (complaints, transactions, ...) returned
+    #               for one customer/org
+    #   checkpoint  everything up to that customer/org id is in the output
+    #               files, with the id counters and file sizes at that point
+    # A run started with resume=True reads the log back; stages journaled
+    # after the last checkpoint are reused instead of asking the LLM again.
+
+    def __init__(self, path: str, resume=False):
+        self.path = path
+        self.personas: list[dict] | None = None
+        self.stages: dict[tuple[int, str], list] = {}
+        self.checkpoint: dict | None = None
+        self._lock = threading.Lock()
+
+        if resume and os.path.exists(path):
+            self._load()
+        self.file = open(path, "a" if resume else "w", encoding="utf-8")
+
+    def _load(self):
+        # bytes up to the end of the last complete event
+        good = 0
+        with open(self.path, "rb") as f:
+            for line in f:
+                try:
+                    if not line.endswith(b"\n"):
+                        raise ValueError("torn line")
+                    event = json.loads(line)
+                except ValueError:
+                    # the run died mid-write, everything before it is intact
+                    break
+                good += len(line)
+
+                if event["type"] == "personas":
+                    self.personas = event["personas"]
+                elif event["type"] == "stage":
+                    self.stages[(event["id"], event["stage"])] = event["rows"]
+                elif event["type"] == "checkpoint":
+                    self.checkpoint = event
+
+        # the torn tail is cut off, events appended after it would otherwise
+        # be lost on the next resume
+        if good < os.path.getsize(self.path):
+            with open(self.path, "r+b") as f:
+                f.truncate(good)
+
+    def _append(self, event: dict):
+        with self._lock:
+            self.file.write(json.dumps(event, ensure_ascii=False, default=str) + "\n")
+            self.file.flush()
+            os.fsync(self.file.fileno())
+
+    def save_personas(self, personas: list[dict]):
+        self.personas = personas
+        self._append({"type": "personas", "personas": personas})
+
+    def run_stage(self, entity_id: int, stage: str, fn):
+        # journaled rows of this stage, or fn() which is journaled unless it
+        # failed (None), so a failed stage is retried on resume
+        with self._lock:
+            rows = self.stages.get((entity_id, stage))
+        if rows is not None:
+            return rows
+
+        rows = fn()
+        if rows is not None:
+            self._append(
+                {"type": "stage", "id": entity_id, "stage": stage, "rows": rows}
+            )
+        return rows
+
+    def save_checkpoint(self, entity_id: int, counters: dict, sizes: dict):
+        self.checkpoint = {
+            "type": "checkpoint",
+            "id": entity_id,
+            "counters": counters,
+            "sizes": sizes,
+        }
+        self._append(self.checkpoint)
+        with self._lock:
+            self.stages = {k: v for k, v in self.stages.items() if k[0] > entity_id}
+
+    def close(self):
+        self.file.close()
@@ -1,104 +1,54 @@
 import argparse
-import csv
-import json
 import os
 import random
-import requests
-from dotenv import load_dotenv
+import sys
+import time
 from org_prompt_list import (
     create_org_persona_prompt,
     create_org_support_prompt,
     create_org_social_media_prompt,
     create_org_transaction_history_prompt,
 )
+from journal import Journal
+from sinks import SINK_FORMATS, open_sink
 
-load_dotenv(".env.local")
+sys.path.append(os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+from json_stream import JsonArrayParser
+from llm_client import stream_prompt
+from schemas import fix_records
 
-OPEN_ROUTER_KEY = os.getenv("OPEN_ROUTER_KEY")
-OPEN_ROUTER_URL = "https://openrouter.ai/api/v1/chat/completions"
 MODEL = "google/gemini-2.0-pro-exp-02-05:free"
 
 MIN_TRANSACTIONS = 3
 MIN_SUPPORT_TICKETS = 2
 MIN_SOCIAL_POSTS = 2
 
-headers = {
-    "Authorization": f"Bearer {OPEN_ROUTER_KEY}",
-    "Content-Type": "application/json",
-}
 
-
-def request_parse_ret(prompt, count, max_retries=3):
+def request_parse_ret(prompt, count, schema, max_retries=3):
+    # the prompt is sent again while fewer than min(3, count) records came
+    # back, records failing the schema get one follow-up request for just
+    # their invalid fields instead of regenerating everything
     final_response = []
 
     for retry in range(max_retries):
-        payload = {"model": MODEL, "messages": [{"role": "user", "content": prompt}]}
-        response = requests.post(OPEN_ROUTER_URL, headers=headers, json=payload)
-
-        if response.status_code == 200:
-            response_data = response.json()
-            response_text = ""
-
-            try:
-                if "choices" in response_data and len(response_data["choices"]) > 0:
-                    if (
-                        "message" in response_data["choices"][0]
-                        and "content" in response_data["choices"][0]["message"]
-                    ):
-                        response_text = response_data["choices"][0]["message"][
-                            "content"
-                        ].strip()
-
-                        if "```json" in response_text:
-                            json_start = response_text.find("```json") + 7
-                            json_end = response_text.rfind("```")
-                            if json_end > json_start:
-                                response_text = response_text[
-                                    json_start:json_end
-                                ].strip()
-
-                        if not response_text.startswith(
-                            "{"
-                        ) and not response_text.startswith("["):
-                            response_text = "[" + response_text + "]"
-
-                        parsed_data = json.loads(response_text)
-
-                        if isinstance(parsed_data, list):
-                            for item in parsed_data[:count]:
-                                if isinstance(item, dict):
-                                    final_response.append(item)
-                        elif isinstance(parsed_data, dict):
-                            final_response.append(parsed_data)
-                else:
-                    if "text" in response_data:
-                        response_text = response_data["text"].strip()
-                    elif "response" in response_data:
-                        response_text = response_data["response"].strip()
-            except (KeyError, json.JSONDecodeError):
-                if response_text:
-                    try:
-                        fixed_text = response_text.replace("'", '"')
-                        parsed_data = json.loads(fixed_text)
-
-                        if isinstance(parsed_data, list):
-                            for item in parsed_data[:count]:
-                                if isinstance(item, dict):
-                                    final_response.append(item)
-                        elif isinstance(parsed_data, dict):
-                            final_response.append(parsed_data)
-                    except json.JSONDecodeError:
-                        pass
+        # records are parsed as the answer streams in, if the stream breaks
+        # off every record that completed before is kept
+        parser = JsonArrayParser()
+        try:
+            for chunk in stream_prompt(prompt, MODEL):
+                for item in parser.feed(chunk):
+                    if isinstance(item, dict) and len(final_response) < count:
+                        final_response.append(item)
+        except Exception as e:
+            print(f"Response stream failed: {e}")
 
         if len(final_response) >= min(3, count):
             break
 
         if retry < max_retries - 1:
-            import time
-
             time.sleep(1)
 
-    return final_response
+    return fix_records(schema, final_response, MODEL) if final_response else []
 
 
 def generate_fallback_data(data_type, org_id, persona, count):
@@ -187,150 +137,170 @@ def main(args):
     if not os.path.exists(output_dir):
         os.makedirs(output_dir)
 
-    org_file = os.path.join(output_dir, "org_profile.csv")
-    transactions_file = os.path.join(output_dir, "org_purchase.csv")
-    social_media_file = os.path.join(output_dir, "org_social_media_record.csv")
-    support_file = os.path.join(output_dir, "org_support_record.csv")
-
-    with open(org_file, "w", newline="", encoding="utf-8") as f:
-        writer = csv.writer(f)
-        writer.writerow(
-            [
-                "org_id",
-                "company_name",
-                "industry",
-                "size",
-                "annual_revenue",
-                "years_in_business",
-                "location",
-                "business_model",
-                "growth_stage",
-                "risk_tolerance",
-                "credit_rating",
-                "preferred_payment_method",
-                "avg_account_balance",
-                "loan_count",
-                "total_loan_amt",
-                "avg_monthly_spending",
-                "main_expense_categories",
-                "support_interaction_count",
-                "satisfaction",
-            ]
-        )
-
-    with open(transactions_file, "w", newline="", encoding="utf-8") as f:
-        writer = csv.writer(f)
-        writer.writerow(
-            [
-                "transaction_id",
-                "org_id",
-                "date",
-                "platform",
-                "payment_method",
-                "amount",
-                "location",
-                "expense_category",
-                "expense_sub_category",
-                "vendor",
-                "transaction_type",
-            ]
-        )
-
-    with open(social_media_file, "w", newline="", encoding="utf-8") as f:
-        writer = csv.writer(f)
-        writer.writerow(
-            [
-                "post_id",
-                "org_id",
-                "date",
-                "platform",
-                "image_url",
-                "text_content",
-                "topics_of_interest",
-                "feedback_on_financial_services",
-                "sentiment_score",
-                "engagement_level",
-                "partners_mentioned",
-                "post_type",
-            ]
-        )
-
-    with open(support_file, "w", newline="", encoding="utf-8") as f:
-        writer = csv.writer(f)
-        writer.writerow(
-            [
-                "ticket_id",
-                "org_id",
-                "date",
-                "transcript",
-                "issue_type",
-                "priority",
-                "is_repeating_issue",
-                "was_issue_resolved",
-                "resolution_time",
-                "sentiment",
-            ]
-        )
-
-    org_prompt = create_org_persona_prompt(args.org_count)
-    org_personas = request_parse_ret(org_prompt, args.org_count)
-
-    if not org_personas or len(org_personas) < args.org_count:
-        for i in range(len(org_personas) if org_personas else 0, args.org_count):
-            industries = [
-                "Technology",
-                "Finance",
-                "Healthcare",
-                "Retail",
-                "Manufacturing",
-            ]
-            org_personas.append(
-                {
-                    "company_name": f"Company {i + 1}",
-                    "industry": random.choice(industries),
-                    "size": random.choice(["Small", "Medium", "Large"]),
-                    "annual_revenue": f"${random.randint(1, 100)}M",
-                    "years_in_business": str(random.randint(1, 20)),
-                    "location": "United States",
-                    "business_model": random.choice(["B2B", "B2C", "Hybrid"]),
-                    "growth_stage": random.choice(["Startup", "Growth", "Mature"]),
-                    "risk_tolerance": random.choice(["Low", "Medium", "High"]),
-                    "credit_rating": random.choice(["A", "B", "C"]),
-                    "preferred_payment_method": random.choice(
-                        ["Credit Card", "ACH", "Wire"]
-                    ),
-                    "avg_account_balance": f"${random.randint(10000, 1000000)}",
-                    "loan_count": str(random.randint(0, 5)),
-                    "total_loan_amt": f"${random.randint(0, 500000)}",
-                    "avg_monthly_spending": f"${random.randint(5000, 50000)}",
-                    "main_expense_categories": random.choice(
-                        ["Technology", "Marketing", "Operations"]
-                    ),
-                    "support_interaction_count": str(random.randint(1, 10)),
-                }
-            )
+    # progress of the run, --resume continues from its last checkpoint
+    journal = Journal(os.path.join(output_dir, "org_generator.journal"), args.resume)
+    checkpoint = journal.checkpoint
+    sizes = checkpoint["sizes"] if checkpoint else None
+
+    org_sink = open_sink(
+        output_dir,
+        "org_profile",
+        [
+            "org_id",
+            "company_name",
+            "industry",
+            "size",
+            "annual_revenue",
+            "years_in_business",
+            "location",
+            "business_model",
+            "growth_stage",
+            "risk_tolerance",
+            "credit_rating",
+            "preferred_payment_method",
+            "avg_account_balance",
+            "loan_count",
+            "total_loan_amt",
+            "avg_monthly_spending",
+            "main_expense_categories",
+            "support_interaction_count",
+            "satisfaction",
+        ],
+        args.format,
+        args.batch_size,
+        sizes,
+    )
 
-    transaction_id = 1
-    ticket_id = 1
-    post_id = 1
+    transactions_sink = open_sink(
+        output_dir,
+        "org_purchase",
+        [
+            "transaction_id",
+            "org_id",
+            "date",
+            "platform",
+            "payment_method",
+            "amount",
+            "location",
+            "expense_category",
+            "expense_sub_category",
+            "vendor",
+            "transaction_type",
+        ],
+        args.format,
+        args.batch_size,
+        sizes,
+    )
 
-    for org_id in range(1, args.org_count + 1):
-        if org_id > len(org_personas):
-            break
+    social_media_sink = open_sink(
+        output_dir,
+        "org_social_media_record",
+        [
+            "post_id",
+            "org_id",
+            "date",
+            "platform",
+            "image_url",
+            "text_content",
+            "topics_of_interest",
+            "feedback_on_financial_services",
+            "sentiment_score",
+            "engagement_level",
+            "partners_mentioned",
+            "post_type",
+        ],
+        args.format,
+        args.batch_size,
+        sizes,
+    )
+
+    support_sink = open_sink(
+        output_dir,
+        "org_support_record",
+        [
+            "ticket_id",
+            "org_id",
+            "date",
+            "transcript",
+            "issue_type",
+            "priority",
+            "is_repeating_issue",
+            "was_issue_resolved",
+            "resolution_time",
+            "sentiment",
+        ],
+        args.format,
+        args.batch_size,
+        sizes,
+    )
+
+    sinks = [org_sink, transactions_sink, social_media_sink, support_sink]
+    try:
+        org_personas = journal.personas
+        if org_personas is None:
+            org_prompt = create_org_persona_prompt(args.org_count)
+            org_personas = request_parse_ret(org_prompt, args.org_count, "org_persona")
+
+        if not org_personas or len(org_personas) < args.org_count:
+            for i in range(len(org_personas) if org_personas else 0, args.org_count):
+                industries = [
+                    "Technology",
+                    "Finance",
+                    "Healthcare",
+                    "Retail",
+                    "Manufacturing",
+                ]
+                org_personas.append(
+                    {
+                        "company_name": f"Company {i + 1}",
+                        "industry": random.choice(industries),
+                        "size": random.choice(["Small", "Medium", "Large"]),
+                        "annual_revenue": f"${random.randint(1, 100)}M",
+                        "years_in_business": str(random.randint(1, 20)),
+                        "location": "United States",
+                        "business_model": random.choice(["B2B", "B2C", "Hybrid"]),
+                        "growth_stage": random.choice(["Startup", "Growth", "Mature"]),
+                        "risk_tolerance": random.choice(["Low", "Medium", "High"]),
+                        "credit_rating": random.choice(["A", "B", "C"]),
+                        "preferred_payment_method": random.choice(
+                            ["Credit Card", "ACH", "Wire"]
+                        ),
+                        "avg_account_balance": f"${random.randint(10000, 1000000)}",
+                        "loan_count": str(random.randint(0, 5)),
+                        "total_loan_amt": f"${random.randint(0, 500000)}",
+                        "avg_monthly_spending": f"${random.randint(5000, 50000)}",
+                        "main_expense_categories": random.choice(
+                            ["Technology", "Marketing", "Operations"]
+                        ),
+                        "support_interaction_count": str(random.randint(1, 10)),
+                    }
+                )
+        if journal.personas is None:
+            journal.save_personas(org_personas)
 
-        persona = org_personas[org_id - 1]
+        counters = checkpoint["counters"] if checkpoint else {}
+        transaction_id = counters.get("transaction_id", 1)
+        ticket_id = counters.get("ticket_id", 1)
+        post_id = counters.get("post_id", 1)
+        start = checkpoint["id"] + 1 if checkpoint else 1
+        if start > 1:
+            print(f"Resuming from organization {start}/{args.org_count}")
 
-        if not isinstance(persona, dict):
-            continue
+        for org_id in range(start, args.org_count + 1):
+            if org_id > len(org_personas):
+                break
 
-        numbers = [random.random() for _ in range(10)]
-        avg = sum(numbers) / len(numbers)
-        result = 7 + (avg - 0.5) * 6
-        persona["satisfaction"] = max(0, min(10, result))
+            persona = org_personas[org_id - 1]
+
+            if not isinstance(persona, dict):
+                continue
 
-        with open(org_file, "a", newline="", encoding="utf-8") as f:
-            writer = csv.writer(f)
-            writer.writerow(
+            numbers = [random.random() for _ in range(10)]
+            avg = sum(numbers) / len(numbers)
+            result = 7 + (avg - 0.5) * 6
+            persona["satisfaction"] = max(0, min(10, result))
+
+            org_sink.write(
                 [
                     f"ORG_{org_id}",
                     persona.get("company_name", ""),
@@ -354,32 +324,38 @@ def main(args):
                 ]
             )
 
-        transactions = request_parse_ret(
-            create_org_transaction_history_prompt(persona, args.max_purchase_count),
-            args.max_purchase_count,
-        )
-
-        if not transactions or len(transactions) < MIN_TRANSACTIONS:
-            fallback_count = (
-                MIN_TRANSACTIONS
-                if not transactions
-                else (MIN_TRANSACTIONS - len(transactions))
-            )
-            fallback_transactions = generate_fallback_data(
-                "transaction", org_id, persona, fallback_count
+            # stages already in the journal (resumed run) aren't requested again,
+            # empty answers aren't journaled so they are retried
+            transactions = journal.run_stage(
+                org_id,
+                "transactions",
+                lambda: request_parse_ret(
+                    create_org_transaction_history_prompt(persona, args.max_purchase_count),
+                    args.max_purchase_count,
+                    "org_transaction",
+                )
+                or None,
             )
-            if transactions:
-                transactions.extend(fallback_transactions)
-            else:
-                transactions = fallback_transactions
 
-        for transaction in transactions:
-            if not isinstance(transaction, dict):
-                continue
+            if not transactions or len(transactions) < MIN_TRANSACTIONS:
+                fallback_count = (
+                    MIN_TRANSACTIONS
+                    if not transactions
+                    else (MIN_TRANSACTIONS - len(transactions))
+                )
+                fallback_transactions = generate_fallback_data(
+                    "transaction", org_id, persona, fallback_count
+                )
+                if transactions:
+                    transactions.extend(fallback_transactions)
+                else:
+                    transactions = fallback_transactions
+
+            for transaction in transactions:
+                if not isinstance(transaction, dict):
+                    continue
 
-            with open(transactions_file, "a", newline="", encoding="utf-8") as f:
-                writer = csv.writer(f)
-                writer.writerow(
+                transactions_sink.write(
                     [
                         f"TXN_{transaction_id}",
                         f"ORG_{org_id}",
@@ -396,34 +372,37 @@ def main(args):
                 )
                 transaction_id += 1
 
-        support_count = max(
-            MIN_SUPPORT_TICKETS, int(persona.get("support_interaction_count", 5))
-        )
-        support_tickets = request_parse_ret(
-            create_org_support_prompt(persona, support_count), support_count
-        )
-
-        if not support_tickets or len(support_tickets) < MIN_SUPPORT_TICKETS:
-            fallback_count = (
-                MIN_SUPPORT_TICKETS
-                if not support_tickets
-                else (MIN_SUPPORT_TICKETS - len(support_tickets))
+            support_count = max(
+                MIN_SUPPORT_TICKETS, int(persona.get("support_interaction_count", 5))
             )
-            fallback_tickets = generate_fallback_data(
-                "support", org_id, persona, fallback_count
+            support_tickets = journal.run_stage(
+                org_id,
+                "support",
+                lambda: request_parse_ret(
+                    create_org_support_prompt(persona, support_count), support_count, "org_support"
+                )
+                or None,
             )
-            if support_tickets:
-                support_tickets.extend(fallback_tickets)
-            else:
-                support_tickets = fallback_tickets
 
-        for ticket in support_tickets:
-            if not isinstance(ticket, dict):
-                continue
+            if not support_tickets or len(support_tickets) < MIN_SUPPORT_TICKETS:
+                fallback_count = (
+                    MIN_SUPPORT_TICKETS
+                    if not support_tickets
+                    else (MIN_SUPPORT_TICKETS - len(support_tickets))
+                )
+                fallback_tickets = generate_fallback_data(
+                    "support", org_id, persona, fallback_count
+                )
+                if support_tickets:
+                    support_tickets.extend(fallback_tickets)
+                else:
+                    support_tickets = fallback_tickets
+
+            for ticket in support_tickets:
+                if not isinstance(ticket, dict):
+                    continue
 
-            with open(support_file, "a", newline="", encoding="utf-8") as f:
-                writer = csv.writer(f)
-                writer.writerow(
+                support_sink.write(
                     [
                         f"TICK_{ticket_id}",
                         f"ORG_{org_id}",
@@ -439,29 +418,32 @@ def main(args):
                 )
                 ticket_id += 1
 
-        posts = request_parse_ret(
-            create_org_social_media_prompt(persona, args.max_post), args.max_post
-        )
-
-        if not posts or len(posts) < MIN_SOCIAL_POSTS:
-            fallback_count = (
-                MIN_SOCIAL_POSTS if not posts else (MIN_SOCIAL_POSTS - len(posts))
-            )
-            fallback_posts = generate_fallback_data(
-                "social", org_id, persona, fallback_count
+            posts = journal.run_stage(
+                org_id,
+                "posts",
+                lambda: request_parse_ret(
+                    create_org_social_media_prompt(persona, args.max_post), args.max_post, "org_post"
+                )
+                or None,
             )
-            if posts:
-                posts.extend(fallback_posts)
-            else:
-                posts = fallback_posts
 
-        for post in posts:
-            if not isinstance(post, dict):
-                continue
+            if not posts or len(posts) < MIN_SOCIAL_POSTS:
+                fallback_count = (
+                    MIN_SOCIAL_POSTS if not posts else (MIN_SOCIAL_POSTS - len(posts))
+                )
+                fallback_posts = generate_fallback_data(
+                    "social", org_id, persona, fallback_count
+                )
+                if posts:
+                    posts.extend(fallback_posts)
+                else:
+                    posts = fallback_posts
+
+            for post in posts:
+                if not isinstance(post, dict):
+                    continue
 
-            with open(social_media_file, "a", newline="", encoding="utf-8") as f:
-                writer = csv.writer(f)
-                writer.writerow(
+                social_media_sink.write(
                     [
                         f"POST_{post_id}",
                         f"ORG_{org_id}",
@@ -479,6 +461,22 @@ def main(args):
                 )
                 post_id += 1
 
+            # parquet files can't be continued, a resumed parquet run
+            # rewrites them from the journaled stages instead
+            last = org_id == args.org_count
+            if args.format != "parquet" and (org_id % args.checkpoint_every == 0 or last):
+                for sink in sinks:
+                    sink.sync()
+                journal.save_checkpoint(
+                    org_id,
+                    {"transaction_id": transaction_id, "ticket_id": ticket_id, "post_id": post_id},
+                    {sink.path: sink.tell() for sink in sinks},
+                )
+    finally:
+        for sink in sinks:
+            sink.close()
+        journal.close()
+
 
 if __name__ == "__main__":
     parser = argparse.ArgumentParser(
@@ -505,5 +503,32 @@ if __name__ == "__main__":
         required=False,
         help="Max number of purchase/expense records per organization",
     )
+    parser.add_argument(
+        "--format",
+        type=str,
+        default="csv",
+        choices=SINK_FORMATS,
+        required=False,
+        help="Output file format, parquet needs pyarrow",
+    )
+    parser.add_argument(
+        "--batch_size",
+        type=int,
+        default=500,
+        required=False,
+        help="Rows buffered per output file before writing",
+    )
+    parser.add_argument(
+        "--checkpoint_every",
+        type=int,
+        default=10,
+        required=False,
+        help="Organizations written between checkpoints of the progress journal",
+    )
+    parser.add_argument(
+        "--resume",
+        action="store_true",
+        help="Continue the last run from its latest checkpoint instead of starting over",
+    )
     args = parser.parse_args()
     main(args)
@@ -0,0 +1,152 @@
+import csv
+import json
+import os
+
+SINK_FORMATS = ["csv", "jsonl", "parquet"]
+
+
+class Sink:
+    # Output file that stays open for the whole run. Rows are buffered and
+    # written every batch_size rows, on flush() and on close(). A sink opened
+    # with size continues an existing file, cut back to size bytes first.
+
+    def __init__(self, path: str, columns: list[str], batch_size: int = 500):
+        self.path = path
+        self.columns = columns
+        self.batch_size = batch_size
+        self.rows: list[list] = []
+
+    def write(self, row: list):
+        # values in the order of columns
+        self.rows.append(row)
+        if len(self.rows) >= self.batch_size:
+            self.flush()
+
+    def flush(self):
+        if self.rows:
+            self._write_rows(self.rows)
+            self.rows = []
+
+    def tell(self) -> int:
+        # bytes written so far, every buffered row included
+        self.flush()
+        return self.file.tell()
+
+    def sync(self):
+        # every row written so far on disk, before a checkpoint points past it
+        self.flush()
+        os.fsync(self.file.fileno())
+
+    def close(self):
+        self.flush()
+        self._close()
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *exc):
+        self.close()
+
+    def _write_rows(self, rows: list[list]):
+        raise NotImplementedError
+
+    def _close(self):
+        pass
+
+
+def reopen(path: str, size: int | None, **kwargs):
+    if size is None:
+        return open(path, "w", **kwargs)
+    with open(path, "r+b") as f:
+        f.truncate(size)
+    return open(path, "a", **kwargs)
+
+
+class CsvSink(Sink):
+    def __init__(self, path: str, columns: list[str], batch_size: int = 500, size=None):
+        super().__init__(path, columns, batch_size)
+        self.file = reopen(path, size, newline="", encoding="utf-8")
+        self.writer = csv.writer(self.file)
+        if size is None:
+            self.writer.writerow(columns)
+
+    def _write_rows(self, rows: list[list]):
+        self.writer.writerows(rows)
+        self.file.flush()
+
+    def _close(self):
+        self.file.close()
+
+
+class JsonlSink(Sink):
+    def __init__(self, path: str, columns: list[str], batch_size: int = 500, size=None):
+        super().__init__(path, columns, batch_size)
+        self.file = reopen(path, size, encoding="utf-8")
+
+    def _write_rows(self, rows: list[list]):
+        self.file.writelines(
+            json.dumps(dict(zip(self.columns, row)), ensure_ascii=False, default=str)
+            + "\n"
+            for row in rows
+        )
+        self.file.flush()
+
+    def _close(self):
+        self.file.close()
+
+
+class ParquetSink(Sink):
+    # every flush becomes a row group, values are stored as text like in the
+    # csv files. Needs pyarrow, which is not in requirements.txt. A parquet
+    # file can't be appended to, so runs writing parquet can't be resumed.
+
+    def __init__(self, path: str, columns: list[str], batch_size: int = 500, size=None):
+        if size is not None:
+            raise RuntimeError("Parquet output can't be resumed")
+        try:
+            import pyarrow as pa
+            import pyarrow.parquet as pq
+        except ImportError:
+            raise RuntimeError("Parquet output needs pyarrow: pip install pyarrow")
+
+        super().__init__(path, columns, batch_size)
+        self.pa = pa
+        self.schema = pa.schema([(c, pa.string()) for c in columns])
+        self.writer = pq.ParquetWriter(path, self.schema)
+
+    def _write_rows(self, rows: list[list]):
+        table = self.pa.Table.from_pylist(
+            [
+                {c: "" if v is None else str(v) for c, v in zip(self.columns, row)}
+                for row in rows
+            ],
+            schema=self.schema,
+        )
+        self.writer.write_table(table)
+
+    def tell(self) -> int:
+        raise RuntimeError("Parquet output can't be resumed")
+
+    def sync(self):
+        raise RuntimeError("Parquet output can't be resumed")
+
+    def _close(self):
+        self.writer.close()
+
+
+SINKS = {"csv": CsvSink, "jsonl": JsonlSink, "parquet": ParquetSink}
+
+
+def open_sink(
+    output_dir: str,
+    name: str,
+    columns: list[str],
+    fmt="csv",
+    batch_size=500,
+    sizes: dict | None = None,
+) -> Sink:
+    # output_dir/name.<fmt>, the header (csv) is written right away. With
+    # sizes (path -> bytes, see Sink.tell) the file is continued instead.
+    path = os.path.join(output_dir, f"{name}.{fmt}")
+    size = sizes.get(path) if sizes else None
+    return SINKS[fmt](path, columns, batch_size, size)
@@ -1,22 +1,8 @@
-import requests
-import json
-import os
-from dotenv import load_dotenv
+from llm_client import chat
 import base64
 
 
 def image_transcribe(base64: str) -> str:
-    load_dotenv()
-
-    OPEN_ROUTER_KEY = os.getenv("OPEN_ROUTER_KEY")
-    OPEN_ROUTER_URL = "https://openrouter.ai/api/v1/chat/completions"
-    MODEL = os.getenv("MODEL")
-
-    headers = {
-        "Authorization": f"Bearer {OPEN_ROUTER_KEY}",
-        "Content-Type": "application/json",
-    }
-
     base64str = ''
     if base64.startswith("data:image/"):
         base64str = base64
@@ -24,27 +10,24 @@ def image_transcribe(base64: str) -> str:
         # Assume its jpeg
         base64str = f"data:image/jpeg;base64,{base64}"
 
-    payload = {
-        "model": MODEL,
-        "messages": [
-            {
-                "role": "user",
-                "content": [
-                    {
-                        "type": "text",
-                        "text": "Describe in human language what's in the image under 70 words",
-                    },
-                    {
-                        "type": "image_url",
-                        "image_url": {
-                            "url": base64str,
-                        },
+    messages = [
+        {
+            "role": "user",
+            "content": [
+                {
+                    "type": "text",
+                    "text": "Describe in human language what's in the image under 70 words",
+                },
+                {
+                    "type": "image_url",
+                    "image_url": {
+                        "url": base64str,
                     },
-                ],
-            },
-        ],
-    }
-    response = requests.post(OPEN_ROUTER_URL, headers=headers, data=json.dumps(payload))
+                },
+            ],
+        },
+    ]
+    response = chat(messages)
     if response.status_code == 200:
         description = (
             response.json()
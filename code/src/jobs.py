@@ -0,0 +1,71 @@
+import threading
+import time
+import traceback
+import uuid
+from concurrent.futures import ThreadPoolExecutor
+
+
+class JobQueue:
+    # Runs jobs on a local thread pool and keeps their status in memory.
+    # Jobs are submitted with a key; while a job with the same key is queued
+    # or running, submitting again returns that job instead of a new one.
+
+    def __init__(self, max_workers=4, max_finished=1000):
+        self.max_finished = max_finished
+        self._executor = ThreadPoolExecutor(max_workers, thread_name_prefix="job")
+        self._jobs: dict[str, dict] = {}
+        self._in_flight: dict[str, str] = {}
+        self._finished: list[str] = []
+        self._lock = threading.Lock()
+
+    def submit(self, key: str, fn, *args, **kwargs) -> dict:
+        with self._lock:
+            job_id = self._in_flight.get(key)
+            if job_id:
+                return dict(self._jobs[job_id])
+
+            job_id = uuid.uuid4().hex
+            self._jobs[job_id] = {
+                "job_id": job_id,
+                "key": key,
+                "status": "queued",
+                "created_at": time.time(),
+                "started_at": None,
+                "finished_at": None,
+                "error": None,
+                "result": None,
+            }
+            self._in_flight[key] = job_id
+            self._executor.submit(self._run, job_id, fn, args, kwargs)
+            return dict(self._jobs[job_id])
+
+    def get(self, job_id: str) -> dict | None:
+        with self._lock:
+            job = self._jobs.get(job_id)
+            return dict(job) if job else None
+
+    def _update(self, job_id: str, **values):
+        with self._lock:
+            self._jobs[job_id].update(values)
+
+    def _run(self, job_id: str, fn, args, kwargs):
+        self._update(job_id, status="running", started_at=time.time())
+        result = None
+        try:
+            result = fn(*args, **kwargs)
+            status, error = "done", None
+        except Exception as e:
+            traceback.print_exc()
+            status, error = "failed", str(e)
+
+        with self._lock:
+            job = self._jobs[job_id]
+            job.update(
+                status=status, error=error, result=result, finished_at=time.time()
+            )
+            self._in_flight.pop(job["key"], None)
+
+            # only keep the status of the most recent finished jobs
+            self._finished.append(job_id)
+            while len(self._finished) > self.max_finished:
+                self._jobs.pop(self._finished.pop(0), None)
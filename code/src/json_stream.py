@@ -0,0 +1,74 @@
+import json
+
+from schemas import loads
+
+
+class JsonArrayParser:
+    # Incremental parser for LLM answers holding a JSON array of objects.
+    # feed() takes the text as it streams in and returns the elements that
+    # completed since the last call, so a cut off answer still yields every
+    # element before the cut. Text around the array (```json fences, prose)
+    # is skipped and a lone top level object counts as an array of one.
+    # Elements that aren't valid JSON are repaired (schemas.repair_json)
+    # before they count as errors.
+
+    def __init__(self):
+        self.text = ""
+        self.pos = 0
+        self.depth = 0
+        self.top = None
+        self.start = None
+        self.in_string = False
+        self.escape = False
+        self.done = False
+        self.errors = 0
+
+    def feed(self, chunk: str) -> list:
+        self.text += chunk
+        elements = []
+        text = self.text
+
+        for i in range(self.pos, len(text)):
+            c = text[i]
+            if self.in_string:
+                if self.escape:
+                    self.escape = False
+                elif c == "\\":
+                    self.escape = True
+                elif c == '"':
+                    self.in_string = False
+                continue
+            if self.done:
+                break
+
+            if self.depth == 0:
+                if c in "[{":
+                    self.depth, self.top = 1, c
+                    self.start = i if c == "{" else None
+                continue
+
+            if c == '"':
+                self.in_string = True
+            elif c in "[{":
+                if self.depth == 1 and self.top == "[":
+                    self.start = i
+                self.depth += 1
+            elif c in "]}":
+                self.depth -= 1
+                if self.start is not None and (
+                    (self.depth == 1 and self.top == "[")
+                    or (self.depth == 0 and self.top == "{")
+                ):
+                    self._emit(text[self.start : i + 1], elements)
+                    self.start = None
+                if self.depth == 0:
+                    self.done = True
+
+        self.pos = len(text)
+        return elements
+
+    def _emit(self, element: str, elements: list):
+        try:
+            elements.append(loads(element))
+        except json.JSONDecodeError:
+            self.errors += 1
@@ -0,0 +1,145 @@
+import hashlib
+import json
+import os
+import sqlite3
+import threading
+import time
+
+from requests import Response
+
+CACHE_PATH = os.getenv("LLM_CACHE_PATH", "./data/llm_cache.db")
+# seconds a cached response stays valid, and max number of cached responses
+CACHE_TTL = float(os.getenv("LLM_CACHE_TTL", str(7 * 24 * 3600)))
+CACHE_MAX_ENTRIES = int(os.getenv("LLM_CACHE_MAX_ENTRIES", "10000"))
+CACHE_BYPASS = os.getenv("LLM_CACHE_BYPASS", "") not in ("", "0", "false", "False")
+
+
+def cache_key(model: str | None, messages: list[dict], params: dict) -> str:
+    content = json.dumps(
+        {"model": model, "messages": messages, "params": params},
+        sort_keys=True,
+        ensure_ascii=False,
+    )
+    return hashlib.sha256(content.encode("utf-8")).hexdigest()
+
+
+def has_content(response: Response) -> bool:
+    # a 200 with actual completion text, providers also answer 200 with an
+    # error object or an empty message
+    if response.status_code != 200:
+        return False
+    try:
+        content = response.json()["choices"][0]["message"]["content"]
+    except (ValueError, KeyError, IndexError, TypeError):
+        return False
+    return isinstance(content, str) and bool(content.strip())
+
+
+def cached_response(body: bytes) -> Response:
+    # a requests Response rebuilt from the cached body, callers can't tell
+    # the difference except for the X-Cache header
+    response = Response()
+    response.status_code = 200
+    response._content = body
+    response.encoding = "utf-8"
+    response.headers["Content-Type"] = "application/json"
+    response.headers["X-Cache"] = "HIT"
+    return response
+
+
+class LLMCache:
+    # LLM responses with completion text keyed on sha256(model, messages, params) in a
+    # SQLite file. Entries expire after ttl seconds and the least recently
+    # used ones are evicted beyond max_entries. With bypass set every lookup
+    # misses, but fresh responses are still stored.
+
+    def __init__(
+        self,
+        db_path: str = CACHE_PATH,
+        ttl: float = CACHE_TTL,
+        max_entries: int = CACHE_MAX_ENTRIES,
+        bypass: bool = CACHE_BYPASS,
+    ):
+        self.db_path = db_path
+        self.ttl = ttl
+        self.max_entries = max_entries
+        self.bypass = bypass
+        self.hits = 0
+        self.misses = 0
+        self._local = threading.local()
+        self._lock = threading.Lock()
+
+        with self.conn:
+            self.conn.execute(
+                "CREATE TABLE IF NOT EXISTS llm_cache (key TEXT PRIMARY KEY, "
+                "body BLOB NOT NULL, created_at REAL NOT NULL, "
+                "accessed_at REAL NOT NULL)"
+            )
+            self.conn.execute(
+                "CREATE INDEX IF NOT EXISTS llm_cache_accessed_at "
+                "ON llm_cache (accessed_at)"
+            )
+
+    @property
+    def conn(self) -> sqlite3.Connection:
+        conn = getattr(self._local, "conn", None)
+        if conn is None:
+            directory = os.path.dirname(self.db_path)
+            if directory and not os.path.exists(directory):
+                os.makedirs(directory)
+            conn = sqlite3.connect(self.db_path, timeout=30)
+            conn.execute("PRAGMA journal_mode=WAL")
+            self._local.conn = conn
+        return conn
+
+    def _count(self, hit: bool):
+        with self._lock:
+            if hit:
+                self.hits += 1
+            else:
+                self.misses += 1
+
+    def get(self, key: str) -> Response | None:
+        if self.bypass:
+            self._count(False)
+            return None
+
+        now = time.time()
+        row = self.conn.execute(
+            "SELECT body, created_at FROM llm_cache WHERE key = ?", (key,)
+        ).fetchone()
+        if row is None or now - row[1] > self.ttl:
+            self._count(False)
+            return None
+
+        with self.conn:
+            self.conn.execute(
+                "UPDATE llm_cache SET accessed_at = ? WHERE key = ?", (now, key)
+            )
+        self._count(True)
+        return cached_response(row[0])
+
+    def set(self, key: str, response: Response):
+        if not has_content(response):
+            return
+
+        now = time.time()
+        with self.conn:
+            self.conn.execute(
+                "INSERT OR REPLACE INTO llm_cache (key, body, created_at, accessed_at) "
+                "VALUES (?, ?, ?, ?)",
+                (key, response.content, now, now),
+            )
+            self.conn.execute(
+                "DELETE FROM llm_cache WHERE created_at < ?", (now - self.ttl,)
+            )
+            self.conn.execute(
+                "DELETE FROM llm_cache WHERE key IN (SELECT key FROM llm_cache "
+                "ORDER BY accessed_at DESC LIMIT -1 OFFSET ?)",
+                (self.max_entries,),
+            )
+
+    def stats(self) -> dict:
+        entries = self.conn.execute("SELECT COUNT(*) FROM llm_cache").fetchone()[0]
+        with self._lock:
+            return {"hits": self.hits, "misses": self.misses, "entries": entries}
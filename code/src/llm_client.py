@@ -0,0 +1,277 @@
+import asyncio
+import json
+import os
+import random
+import threading
+import time
+from collections.abc import Iterator
+
+import requests
+from dotenv import load_dotenv
+from llm_cache import LLMCache, cache_key
+from requests import Response
+from requests.adapters import HTTPAdapter
+
+load_dotenv()
+
+OPEN_ROUTER_KEY = os.getenv("OPEN_ROUTER_KEY")
+OPEN_ROUTER_URL = "https://openrouter.ai/api/v1/chat/completions"
+MODEL = os.getenv("MODEL")
+
+# seconds to wait for the connection / for the response, a hung upstream
+# fails the request instead of pinning the caller forever
+CONNECT_TIMEOUT = float(os.getenv("LLM_CONNECT_TIMEOUT", "10"))
+READ_TIMEOUT = float(os.getenv("LLM_READ_TIMEOUT", "120"))
+POOL_SIZE = int(os.getenv("LLM_POOL_SIZE", "16"))
+
+# provider limits shared by every request of the process, 0 means no limit
+REQUESTS_PER_MINUTE = float(os.getenv("LLM_REQUESTS_PER_MINUTE", "20"))
+TOKENS_PER_MINUTE = float(os.getenv("LLM_TOKENS_PER_MINUTE", "0"))
+MAX_RETRIES = int(os.getenv("LLM_MAX_RETRIES", "5"))
+MAX_CONCURRENCY = int(os.getenv("LLM_MAX_CONCURRENCY", "8"))
+
+RETRY_STATUS_CODES = {429, 502, 503}
+
+# one keep-alive session for the whole process, connections are reused
+# across requests and threads instead of a new TCP+TLS handshake each call
+session = requests.Session()
+session.headers.update(
+    {
+        "Authorization": f"Bearer {OPEN_ROUTER_KEY}",
+        "Content-Type": "application/json",
+    }
+)
+session.mount("https://", HTTPAdapter(pool_maxsize=POOL_SIZE))
+
+
+class TokenBucket:
+    # Refills at per_minute / 60 per second up to a small burst. Callers
+    # reserve what they need and get back how long to wait before sending;
+    # the balance may go negative so waiting callers queue up fairly.
+
+    def __init__(self, per_minute: float, burst: float | None = None):
+        self.rate = per_minute / 60
+        self.capacity = burst if burst is not None else max(1.0, per_minute / 10)
+        self.tokens = self.capacity
+        self.updated = time.monotonic()
+        self.paused_until = 0.0
+        self._lock = threading.Lock()
+
+    def reserve(self, amount: float = 1.0) -> float:
+        with self._lock:
+            now = time.monotonic()
+            wait = max(0.0, self.paused_until - now)
+            if self.rate <= 0:
+                return wait
+
+            self.tokens = min(
+                self.capacity, self.tokens + (now - self.updated) * self.rate
+            )
+            self.updated = now
+            self.tokens -= amount
+            return max(wait, -self.tokens / self.rate)
+
+    def pause(self, seconds: float):
+        # nobody sends anything for the next seconds (429 / Retry-After)
+        with self._lock:
+            self.paused_until = max(self.paused_until, time.monotonic() + seconds)
+
+
+class RateLimiter:
+    def __init__(self, requests_per_minute: float, tokens_per_minute: float):
+        self.requests = TokenBucket(requests_per_minute)
+        self.tokens = TokenBucket(tokens_per_minute)
+
+    def reserve(self, tokens: int) -> float:
+        return max(self.requests.reserve(1), self.tokens.reserve(tokens))
+
+    def pause(self, seconds: float):
+        self.requests.pause(seconds)
+        self.tokens.pause(seconds)
+
+
+rate_limiter = RateLimiter(REQUESTS_PER_MINUTE, TOKENS_PER_MINUTE)
+
+_cache = None
+_cache_lock = threading.Lock()
+
+
+def get_cache() -> LLMCache:
+    # opened on first use so importing the client doesn't create the file
+    global _cache
+    with _cache_lock:
+        if _cache is None:
+            _cache = LLMCache()
+        return _cache
+
+
+def estimate_tokens(messages: list[dict]) -> int:
+    # rough count (~4 characters per token), only used for rate limiting
+    return len(json.dumps(messages)) // 4 + 1
+
+
+def retry_wait(response: Response, attempt: int) -> float | None:
+    # seconds to wait before retrying, None if the response is final
+    if response.status_code not in RETRY_STATUS_CODES:
+        return None
+
+    retry_after = response.headers.get("Retry-After")
+    if retry_after:
+        try:
+            return float(retry_after)
+        except ValueError:
+            pass
+    return min(60.0, 2**attempt) + random.uniform(0, 1)
+
+
+def _post(
+    messages: list[dict], model: str | None, timeout, params: dict, stream=False
+) -> Response:
+    payload = {"model": model or MODEL, "messages": messages, **params}
+    return session.post(
+        OPEN_ROUTER_URL,
+        json=payload,
+        timeout=timeout or (CONNECT_TIMEOUT, READ_TIMEOUT),
+        stream=stream,
+    )
+
+
+def chat(
+    messages: list[dict],
+    model: str | None = None,
+    timeout: tuple[float, float] | None = None,
+    use_cache: bool = False,
+    **params,
+) -> Response:
+    # with use_cache identical requests are answered from the response cache
+    # (unless LLM_CACHE_BYPASS=1), callers opt in where the same prompt should
+    # get the same answer. Retries and fix requests leave it off, they are
+    # sent because the previous answer wasn't usable.
+    key = cache_key(model or MODEL, messages, params)
+    if use_cache:
+        cached = get_cache().get(key)
+        if cached is not None:
+            return cached
+
+    tokens = estimate_tokens(messages)
+    for attempt in range(MAX_RETRIES + 1):
+        time.sleep(rate_limiter.reserve(tokens))
+        response = _post(messages, model, timeout, params)
+
+        wait = retry_wait(response, attempt)
+        if wait is None or attempt == MAX_RETRIES:
+            break
+        print(f"LLM rate limited ({response.status_code}), retrying in {wait:.1f}s")
+        rate_limiter.pause(wait)
+
+    if use_cache:
+        get_cache().set(key, response)
+    return response
+
+
+def send_prompt(prompt: str, model: str | None = None, **params) -> Response:
+    return chat([{"role": "user", "content": prompt}], model, **params)
+
+
+def stream_chat(
+    messages: list[dict],
+    model: str | None = None,
+    timeout: tuple[float, float] | None = None,
+    **params,
+) -> Iterator[str]:
+    # Content of the completion piece by piece as the provider streams it
+    # (server-sent events). Rate limited and retried like chat until the
+    # stream starts, never cached. A stream cut off midway raises after the
+    # pieces received so far were yielded.
+    tokens = estimate_tokens(messages)
+    for attempt in range(MAX_RETRIES + 1):
+        time.sleep(rate_limiter.reserve(tokens))
+        response = _post(messages, model, timeout, {**params, "stream": True}, True)
+
+        wait = retry_wait(response, attempt)
+        if wait is None or attempt == MAX_RETRIES:
+            break
+        response.close()
+        print(f"LLM rate limited ({response.status_code}), retrying in {wait:.1f}s")
+        rate_limiter.pause(wait)
+
+    with response:
+        response.raise_for_status()
+        response.encoding = "utf-8"
+        for line in response.iter_lines(decode_unicode=True):
+            # blank lines separate events, ": ..." lines are keep-alive comments
+            if not line or not line.startswith("data:"):
+                continue
+            data = line[len("data:") :].strip()
+            if data == "[DONE]":
+                return
+
+            event = json.loads(data)
+            if "error" in event:
+                raise requests.HTTPError(f"LLM stream error: {event['error']}")
+            content = event["choices"][0].get("delta", {}).get("content")
+            if content:
+                yield content
+
+
+def stream_prompt(prompt: str, model: str | None = None, **params) -> Iterator[str]:
+    return stream_chat([{"role": "user", "content": prompt}], model, **params)
+
+
+async def achat(
+    messages: list[dict],
+    model: str | None = None,
+    timeout: tuple[float, float] | None = None,
+    use_cache: bool = False,
+    **params,
+) -> Response:
+    # same as chat, the blocking request runs on a worker thread so many
+    # requests can be in flight from one event loop
+    key = cache_key(model or MODEL, messages, params)
+    if use_cache:
+        cached = await asyncio.to_thread(get_cache().get, key)
+        if cached is not None:
+            return cached
+
+    tokens = estimate_tokens(messages)
+    for attempt in range(MAX_RETRIES + 1):
+        await asyncio.sleep(rate_limiter.reserve(tokens))
+        response = await asyncio.to_thread(_post, messages, model, timeout, params)
+
+        wait = retry_wait(response, attempt)
+        if wait is None or attempt == MAX_RETRIES:
+            break
+        print(f"LLM rate limited ({response.status_code}), retrying in {wait:.1f}s")
+        rate_limiter.pause(wait)
+
+    if use_cache:
+        await asyncio.to_thread(get_cache().set, key, response)
+    return response
+
+
+async def gather_prompts(
+    prompts: list[str],
+    model: str | None = None,
+    max_concurrency: int = MAX_CONCURRENCY,
+    **params,
+) -> list[Response | Exception]:
+    # responses in the order of prompts, a failed request gives its exception
+    semaphore = asyncio.Semaphore(max_concurrency)
+
+    async def send(prompt: str) -> Response:
+        async with semaphore:
+            return await achat([{"role": "user", "content": prompt}], model, **params)
+
+    return await asyncio.gather(
+        *(send(prompt) for prompt in prompts), return_exceptions=True
+    )
+
+
+def send_prompts(
+    prompts: list[str],
+    model: str | None = None,
+    max_concurrency: int = MAX_CONCURRENCY,
+    **params,
+) -> list[Response | Exception]:
+    # blocking wrapper around gather_prompts for synchronous callers
+    return asyncio.run(gather_prompts(prompts, model, max_concurrency, **params))
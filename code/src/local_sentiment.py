@@ -0,0 +1,331 @@
+import argparse
+import os
+import re
+import threading
+import time
+import zlib
+from collections import Counter
+
+import numpy as np
+from customer_store import get_store
+
+# Local sentiment scores for support queries and social media posts, so a
+# new record doesn't have to wait on the LLM. Two estimates are made for
+# every record: a lexicon with negation/intensifier rules and a linear model
+# trained on the sentiment the LLM gave the records already in the store.
+# Where they agree and the text has enough sentiment words the local score
+# is used, otherwise update_sentiments asks the LLM.
+
+MODEL_PATH = os.getenv("SENTIMENT_MODEL_PATH", "./data/sentiment_model.npz")
+# local scores below this confidence go to the LLM
+LOCAL_CONFIDENCE = float(os.getenv("SENTIMENT_LOCAL_CONFIDENCE", "0.5"))
+# hashed token features of the linear model, crc32 rather than hash() which
+# is salted per process
+FEATURES = 2**14
+
+LEXICON = {
+    **dict.fromkeys(
+        "love loved excellent amazing fantastic wonderful perfect outstanding "
+        "grateful impressed".split(),
+        2.0,
+    ),
+    **dict.fromkeys(
+        "good great happy glad pleased thank thanks helpful easy quick fast "
+        "resolved satisfied recommend best awesome appreciate appreciated smooth "
+        "friendly reliable secure convenient excited efficient rewards saved "
+        "saving trust nice enjoy enjoying proud win".split(),
+        1.0,
+    ),
+    **dict.fromkeys(
+        "hate terrible awful worst fraud scam unacceptable ridiculous furious "
+        "stolen".split(),
+        -2.0,
+    ),
+    **dict.fromkeys(
+        "bad angry frustrated frustrating disappointed disappointing annoyed "
+        "annoying slow problem problems issue issues error errors crash crashing "
+        "crashes unauthorized fee fees charged overcharged declined denied locked "
+        "poor rude unhelpful useless broken fail failed failure delay delayed "
+        "complaint leave leaving switch switching confused confusing unexpected "
+        "hidden penalty overdraft late lost wrong urgent worried worry concern "
+        "concerned stress stressed".split(),
+        -1.0,
+    ),
+}
+NEGATIONS = {"not", "no", "never", "without", "nothing", "neither", "nor"}
+INTENSIFIERS = {"very", "extremely", "really", "so", "totally", "completely"}
+
+# fields the text of a record is made of, and the column holding its score
+KINDS = {
+    "support": {
+        "table": "customer_support_record",
+        "fields": ["transcript", "main_concerns"],
+        "label": "sentiment",
+    },
+    "social": {
+        "table": "social_media_record",
+        "fields": ["text_content", "topics_of_interest"],
+        "label": "sentiment_score",
+    },
+}
+FEEDBACK = {"positive": 1.0, "negative": -1.0}
+# social scores are about the bank, posts mentioning none of these (and
+# without positive/negative feedback) are neutral whatever their tone
+FINANCE_TERMS = set(
+    "bank banking banks atm card credit debit account accounts fee fees loan "
+    "loans mortgage transaction transactions transfer deposit overdraft "
+    "interest savings checking portfolio investment investments etf etfs "
+    "finance finances financial payment payments bills statement".split()
+)
+
+
+def tokenize(text: str) -> list[str]:
+    return re.findall(r"[a-z']+", text.lower().replace("’", "'"))
+
+
+def record_tokens(kind: str, record: dict) -> list[str]:
+    text = " ".join(str(record.get(f) or "") for f in KINDS[kind]["fields"])
+    tokens = tokenize(text)
+    feedback = str(record.get("feedback_on_financial_products") or "").lower()
+    if kind == "social" and feedback:
+        tokens.append(f"feedback:{feedback}")
+    return tokens
+
+
+def lexicon_score(tokens: list[str]) -> tuple[float, int]:
+    # (score in [-1, 1], number of sentiment words), a negation flips the
+    # next three words, an intensifier makes the next word count 1.5x
+    total = 0.0
+    hits = 0
+    negated = 0
+    boost = 1.0
+    for token in tokens:
+        weight = LEXICON.get(token)
+        if token.startswith("feedback:"):
+            weight = FEEDBACK.get(token[9:])
+        if weight is not None:
+            total += weight * boost * (-1 if negated else 1)
+            hits += 1
+        if token in NEGATIONS or token.endswith("n't"):
+            negated = 3
+        elif negated:
+            negated -= 1
+        boost = 1.5 if token in INTENSIFIERS else 1.0
+    return float(np.tanh(total / 2)), hits
+
+
+def rule_score(kind: str, tokens: list[str]) -> tuple[float, int]:
+    # lexicon_score, with social posts that aren't about money counted as
+    # neutral with the evidence of two sentiment words
+    if kind == "social" and not any(
+        t in FINANCE_TERMS or t in ("feedback:positive", "feedback:negative")
+        for t in tokens
+    ):
+        return 0.0, 2
+    return lexicon_score(tokens)
+
+
+def hashed_features(tokens: list[str], lexicon: float) -> tuple[np.ndarray, np.ndarray]:
+    # (indexes, values) of the unigram + bigram features and the rule score
+    grams = tokens + [f"{a} {b}" for a, b in zip(tokens, tokens[1:])]
+    counts = Counter(zlib.crc32(g.encode()) % FEATURES for g in grams)
+    norm = np.sqrt(len(grams)) if grams else 1.0
+    indexes = np.fromiter([*counts, FEATURES], dtype=np.int64)
+    values = np.fromiter([c / norm for c in counts.values()] + [lexicon], dtype=float)
+    return indexes, values
+
+
+def fit_ridge(
+    rows: list[tuple[np.ndarray, np.ndarray]], labels: np.ndarray, l2=1.0, steps=100
+) -> tuple[np.ndarray, float]:
+    # (X^T X + l2 I) w = X^T (y - mean) solved by conjugate gradient on the
+    # sparse rows, so memory stays linear in the number of records
+    row_ids = np.concatenate([np.full(len(i), n) for n, (i, _) in enumerate(rows)])
+    col_ids = np.concatenate([i for i, _ in rows])
+    vals = np.concatenate([v for _, v in rows])
+    bias = float(labels.mean())
+    target = labels - bias
+
+    def apply(w):
+        xw = np.bincount(row_ids, weights=vals * w[col_ids], minlength=len(rows))
+        return (
+            np.bincount(col_ids, weights=vals * xw[row_ids], minlength=FEATURES + 1)
+            + l2 * w
+        )
+
+    b = np.bincount(col_ids, weights=vals * target[row_ids], minlength=FEATURES + 1)
+    w = np.zeros(FEATURES + 1)
+    r = b - apply(w)
+    p = r.copy()
+    rr = r @ r
+    for _ in range(steps):
+        if rr < 1e-10:
+            break
+        ap = apply(p)
+        alpha = rr / (p @ ap)
+        w += alpha * p
+        r -= alpha * ap
+        rr, rr_old = r @ r, rr
+        p = r + (rr / rr_old) * p
+    return w, bias
+
+
+class LocalSentiment:
+    def __init__(self, weights: dict | None = None):
+        # kind -> (weights, bias), kinds without a trained model use the
+        # rules on their own
+        self.weights = weights or {}
+
+    def predict(self, kind: str, record: dict) -> tuple[float, float]:
+        # (score in [-1, 1], confidence in [0, 1])
+        tokens = record_tokens(kind, record)
+        lexicon, hits = rule_score(kind, tokens)
+        if kind not in self.weights:
+            return round(lexicon, 2), min(1.0, hits / 3) * 0.8
+
+        w, bias = self.weights[kind]
+        indexes, values = hashed_features(tokens, lexicon)
+        score = float(np.clip(w[indexes] @ values + bias, -1, 1))
+        agreement = 1 - min(1.0, abs(score - lexicon))
+        confidence = agreement * min(1.0, (hits + 1) / 2)
+        return round(score, 2), confidence
+
+    @classmethod
+    def train(cls, data: dict[str, list[dict]]) -> "LocalSentiment":
+        # kind -> labelled records, records without a numeric label are skipped
+        weights = {}
+        for kind, records in data.items():
+            rows, labels = labelled(kind, records)
+            if len(rows) >= 2:
+                weights[kind] = fit_ridge(rows, labels)
+        return cls(weights)
+
+    def save(self, path=MODEL_PATH):
+        arrays = {}
+        for kind, (w, bias) in self.weights.items():
+            arrays[f"{kind}_weights"] = w
+            arrays[f"{kind}_bias"] = np.array(bias)
+        np.savez(path, **arrays)
+
+    @classmethod
+    def load(cls, path=MODEL_PATH) -> "LocalSentiment":
+        weights = {}
+        if os.path.exists(path):
+            with np.load(path) as arrays:
+                for kind in KINDS:
+                    if f"{kind}_weights" in arrays:
+                        weights[kind] = (
+                            arrays[f"{kind}_weights"],
+                            float(arrays[f"{kind}_bias"]),
+                        )
+        return cls(weights)
+
+
+def labelled(kind: str, records: list[dict]) -> tuple[list, np.ndarray]:
+    rows, labels = [], []
+    for record in records:
+        try:
+            label = float(record.get(KINDS[kind]["label"]))
+        except (TypeError, ValueError):
+            continue
+        tokens = record_tokens(kind, record)
+        rows.append(hashed_features(tokens, rule_score(kind, tokens)[0]))
+        labels.append(label)
+    return rows, np.array(labels)
+
+
+_model: LocalSentiment | None = None
+_model_lock = threading.Lock()
+
+
+def get_local_model() -> LocalSentiment:
+    # loaded on first use, rules only until python local_sentiment.py has
+    # trained a model
+    global _model
+    with _model_lock:
+        if _model is None:
+            _model = LocalSentiment.load()
+        return _model
+
+
+def agreement_report(kind: str, records: list[dict], folds=5):
+    # k-fold: every record is scored by a model that never saw it and
+    # compared with the sentiment the LLM gave it
+    records = [r for r in records if labelled(kind, [r])[0]]
+    if len(records) < folds:
+        print(f"{kind}: only {len(records)} labelled records, nothing to report")
+        return
+
+    order = np.random.default_rng(0).permutation(len(records))
+    results = {"rules": [], "model": []}
+    for fold in range(folds):
+        held_out = set(order[fold::folds])
+        test = [records[i] for i in held_out]
+        train = [records[i] for i in order if i not in held_out]
+        models = {
+            "rules": LocalSentiment(),
+            "model": LocalSentiment.train({kind: train}),
+        }
+        for name, model in models.items():
+            for record in test:
+                score, confidence = model.predict(kind, record)
+                label = float(record[KINDS[kind]["label"]])
+                results[name].append((score, confidence, label))
+
+    print(f"{kind}: {len(records)} records, {folds}-fold")
+    for name, rows in results.items():
+        scores, confidences, labels = map(np.array, zip(*rows))
+        confident = confidences >= LOCAL_CONFIDENCE
+        same_sign = sentiment_class(scores) == sentiment_class(labels)
+        errors = np.abs(scores - labels)
+        print(
+            f"  {name:8} mean abs error {errors.mean():.3f}, same sign {same_sign.mean():.0%}, "
+            f"confident {confident.mean():.0%}"
+            + (
+                f" (mean abs error {errors[confident].mean():.3f}, "
+                f"same sign {same_sign[confident].mean():.0%})"
+                if confident.any()
+                else ""
+            )
+        )
+
+    model = LocalSentiment.train({kind: records})
+    start = time.perf_counter()
+    for record in records:
+        model.predict(kind, record)
+    elapsed = (time.perf_counter() - start) / len(records)
+    print(f"  {elapsed * 1e6:.0f}us per record")
+
+
+def sentiment_class(scores: np.ndarray) -> np.ndarray:
+    # negative / neutral / positive, |score| < 0.15 counts as neutral
+    return np.sign(np.where(np.abs(scores) < 0.15, 0, scores))
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(
+        description="Train the local sentiment model on the scored records in the store"
+    )
+    parser.add_argument(
+        "--folds",
+        type=int,
+        default=5,
+        required=False,
+        help="Folds of the agreement report",
+    )
+    parser.add_argument(
+        "--model",
+        type=str,
+        default=MODEL_PATH,
+        required=False,
+        help="Where to save the model",
+    )
+    args = parser.parse_args()
+
+    store = get_store()
+    data = {kind: store.get_table(spec["table"]) for kind, spec in KINDS.items()}
+    for kind, records in data.items():
+        agreement_report(kind, records, args.folds)
+
+    LocalSentiment.train(data).save(args.model)
+    print(f"Saved model to {args.model}")
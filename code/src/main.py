@@ -1,94 +1,86 @@
 import argparse
-import csv
+import hashlib
 import json
-import os
+import time
+import traceback
+from concurrent.futures import ThreadPoolExecutor
 
-import pandas as pd
+from context_builder import build_context, count_tokens
+from customer_store import get_store
+from llm_client import get_cache
 from param_mapper import cust_map
-from utils import (
-    load_product_list,
-    mahalanobis_dist,
-    send_request,
-    weighted_vector_dist_passive,
-)
+from product_index import RANKINGS, get_product_index
+from schemas import fix_record, loads
+from utils import StageTimer, send_request
 
 
 def get_cust_info(customer_id: str) -> dict:
     cust_info = {"persona": {}, "transactions": [], "posts": [], "supports": []}
-    output_dir = "./data"
-    if not os.path.exists(output_dir):
-        os.makedirs(output_dir)
-
-    customer_file = os.path.join(output_dir, "customer_profile.csv")
-    transactions_file = os.path.join(output_dir, "customer_purchase.csv")
-    social_media_file = os.path.join(output_dir, "social_media_record.csv")
-    support_file = os.path.join(output_dir, "customer_support_record.csv")
-
-    with open(customer_file, "r", newline="") as file:
-        rows = csv.DictReader(file)
-        for row in rows:
-            if row["customer_id"] == customer_id:
-                cust_info["persona"] = {
-                    "customer_id": row.get("customer_id", ""),
-                    "age": row.get("age", ""),
-                    "gender": row.get("gender", ""),
-                    "education": row.get("education", ""),
-                    "is_married": row.get("is_married", ""),
-                    "num_of_children": row.get("num_of_children", ""),
-                    "location": row.get("location", ""),
-                    "income": row.get("income", ""),
-                    "job": row.get("job", ""),
-                    "goals": row.get("goals", ""),
-                    "credit_score": row.get("credit_score", ""),
-                    "preferred_payment_method": row.get("preferred_payment_method", ""),
-                    "balance": row.get("balance", ""),
-                    "loan_amts": row.get("loan_amts", ""),
-                    "monthly_spending": row.get("monthly_spending", ""),
-                    "main_purchase_cat": row.get("main_purchase_cat", ""),
-                    "support_interaction_count": row.get(
-                        "support_interaction_count", ""
-                    ),
-                    "satisfaction": row.get("satisfaction", ""),
-                }
-                cust_info["previous"] = {
-                    "cust_input_params": row.get("input_params", "{}"),
-                    "cust_output_params": row.get("output_params", "{}"),
-                    "top_n_products": row.get("top_n_products", ""),
-                    "top_n_passive_products": row.get("top_n_passive_products", ""),
-                }
-                break
-
-    with open(transactions_file, "r", newline="") as file:
-        rows = csv.DictReader(file)
-        for row in rows:
-            if row["customer_id"] == customer_id:
-                cust_info["transactions"].append(row)
-
-    with open(social_media_file, "r", newline="") as file:
-        rows = csv.DictReader(file)
-        for row in rows:
-            if row["customer_id"] == customer_id:
-                cust_info["posts"].append(row)
-
-    with open(support_file, "r", newline="") as file:
-        rows = csv.DictReader(file)
-        for row in rows:
-            if row["customer_id"] == customer_id:
-                cust_info["supports"].append(row)
+    store = get_store()
+
+    row = store.get_profile(customer_id)
+    if row:
+        cust_info["persona"] = {
+            "customer_id": row.get("customer_id", ""),
+            "age": row.get("age", ""),
+            "gender": row.get("gender", ""),
+            "education": row.get("education", ""),
+            "is_married": row.get("is_married", ""),
+            "num_of_children": row.get("num_of_children", ""),
+            "location": row.get("location", ""),
+            "income": row.get("income", ""),
+            "job": row.get("job", ""),
+            "goals": row.get("goals", ""),
+            "credit_score": row.get("credit_score", ""),
+            "preferred_payment_method": row.get("preferred_payment_method", ""),
+            "balance": row.get("balance", ""),
+            "loan_amts": row.get("loan_amts", ""),
+            "monthly_spending": row.get("monthly_spending", ""),
+            "main_purchase_cat": row.get("main_purchase_cat", ""),
+            "support_interaction_count": row.get("support_interaction_count", ""),
+            "satisfaction": row.get("satisfaction", ""),
+        }
+        cust_info["previous"] = {
+            "cust_input_params": row.get("input_params", "{}"),
+            "cust_output_params": row.get("output_params", "{}"),
+            "top_n_products": row.get("top_n_products", ""),
+            "top_n_passive_products": row.get("top_n_passive_products", ""),
+        }
+
+    cust_info["transactions"] = store.get_transactions(customer_id)
+    cust_info["posts"] = store.get_posts(customer_id)
+    cust_info["supports"] = store.get_supports(customer_id)
+    cust_info["context"] = build_context(cust_info)
 
     return cust_info
 
 
-def generate_cust_input_params(cust_info: dict):
-    prompt = f"""
+def describe_customer(cust_info: dict) -> str:
+    context = cust_info.get("context") or build_context(cust_info)
+    return f"""
     Given a customer of a popular U.S. bank with the following persona
-    Persona: {cust_info["persona"]} (The list of loans, monthly spending, and balances are from older to newer)
-    They have made the following transactions over the past 12 months
-    Transactions: {cust_info["transactions"]}
+    Persona (The list of loans, monthly spending, and balances are from older to newer):
+{context["persona"]}
+    They have made the following transactions over the past 12 months (one per line, columns as in the first line)
+    Transactions:
+{context["transactions"]}
     They have made the following social media posts
-    Posts: {cust_info["posts"]}
+    Posts:
+{context["posts"]}
     They have made the following support queries to the bank's support system
-    Support Queries: {cust_info["supports"]}
+    Support Queries:
+{context["supports"]}
+"""
+
+
+def report_prompt(cust_info: dict, stage: str, prompt: str):
+    customer_id = cust_info["persona"].get("customer_id", "")
+    print(f"{customer_id} {stage} prompt: ~{count_tokens(prompt)} tokens")
+
+
+def generate_cust_input_params(cust_info: dict, force: bool = False):
+    # force skips the response cache, a forced run asks the model again
+    prompt = describe_customer(cust_info) + """
     Analyze the data and give a json with the following properties
 
     chance_of_leaving: The chance of the customer leaving the bank (Type: Float, 0 means no chance of leaving, 0 negative sentiment support queries
@@ -117,8 +109,9 @@ def generate_cust_input_params(cust_info: dict):
         "argument": "",
     }
 
+    report_prompt(cust_info, "input params", prompt)
     try:
-        response = send_request(prompt)
+        response = send_request(prompt, use_cache=not force)
     except:
         return None
 
@@ -127,37 +120,32 @@ def generate_cust_input_params(cust_info: dict):
 
         try:
             response_text = response_data["choices"][0]["message"]["content"]
-            response_text = response_text.strip().lstrip("```json").rstrip("```")
-
-            response_data = json.loads(response_text)
-
-            print(response_data)
-            cust_input_params["churn_rate"] = response_data["chance_of_leaving"]
-            cust_input_params["profit_generated"] = response_data["profit_generated"]
-            cust_input_params["risk_appetite"] = response_data["risk_appetite"]
-            cust_input_params["financial_acumen"] = response_data["financial_acumen"]
-            cust_input_params["argument"] = response_data["argument"]
-            return cust_input_params
+            response_data = loads(response_text)
         except:
             print("Could not parse JSON from response:", response_data)
             return None
+
+        # missing or invalid values are asked for again on their own
+        response_data = fix_record("input_params", response_data)
+        if response_data is None:
+            print("Invalid input params in response:", response_text)
+            return None
+
+        print(response_data)
+        cust_input_params["churn_rate"] = response_data["chance_of_leaving"]
+        cust_input_params["profit_generated"] = response_data["profit_generated"]
+        cust_input_params["risk_appetite"] = response_data["risk_appetite"]
+        cust_input_params["financial_acumen"] = response_data["financial_acumen"]
+        cust_input_params["argument"] = response_data["argument"]
+        return cust_input_params
     else:
         print(f"Error: {response.status_code}")
         print(response.text)
         return None
 
 
-def sort_products(cust_info: dict, products: list[dict]):
-    prompt = f"""
-    Given a customer of a popular U.S. bank with the following persona
-    Persona: {cust_info["persona"]} (The list of loans, monthly spending, and balances are from older to newer)
-    They have made the following transactions over the past 12 months
-    Transactions: {cust_info["transactions"]}
-    They have made the following social media posts
-    Posts: {cust_info["posts"]}
-    They have made the following support queries to the bank's support system
-    Support Queries: {cust_info["supports"]}
-    
+def sort_products(cust_info: dict, products: list[dict], force: bool = False):
+    prompt = describe_customer(cust_info) + f"""
     We have selected some financial products which we want to recommend to them, the list is as follows:
     Products: {products}
     Using the data, the customer's interest etc. sort the products list based on what they would want more.
@@ -166,8 +154,9 @@ def sort_products(cust_info: dict, products: list[dict]):
     Conent should only the list of product_id (as a comma separated string) of the sorted products in terms of customer interest highest to lowest,
     Do not give any reasoning etc. just a comma separated string of product ids
         """
+    report_prompt(cust_info, "sort products", prompt)
     try:
-        response = send_request(prompt)
+        response = send_request(prompt, use_cache=not force)
     except:
         return None
 
@@ -188,130 +177,442 @@ def sort_products(cust_info: dict, products: list[dict]):
         return ""
 
 
-def main(customer_id: str):
-    cust_info = get_cust_info(customer_id)
+def parse_product_ids(value, products: list[dict]) -> str | None:
+    # a list or comma separated string of ids, only ids of the given products
+    if isinstance(value, str):
+        value = value.split(",")
+    if not isinstance(value, list):
+        return None
+    known = {i["product_id"] for i in products}
+    product_ids = [str(i).strip() for i in value if str(i).strip() in known]
+    return ",".join(dict.fromkeys(product_ids)) or None
+
+
+def sort_products_combined(
+    cust_info: dict,
+    products: list[dict],
+    passive_products: list[dict],
+    force: bool = False,
+) -> tuple[str, str] | None:
+    # both product lists sorted in one request, None if the answer can't be used
+    prompt = describe_customer(cust_info) + f"""
+    We have selected two lists of financial products which we want to recommend to them:
+    Products: {products}
+    Passive Products: {passive_products}
+    Using the data, the customer's interest etc. sort each list separately based on what they would want more.
 
-    print("Generating input params")
-    cust_input_params = generate_cust_input_params(cust_info)
-    if not cust_input_params:
-        cust_input_params = json.loads(cust_info["previous"]["cust_input_params"])
-        if not cust_input_params:
-            cust_input_params = {
-                "churn_rate": 5,  # 0-10
-                "profit_generated": 5,
-                "risk_appetite": 5,
-                "financial_acumen": 5,
-                "argument": "",
-            }
+    Return a JSON with two keys: "products" and "passive_products", each an array of the product_id of that list
+    sorted in terms of customer interest highest to lowest (example {{"products": ["PROD_1", "PROD_54"], "passive_products": ["PROD_2"]}})
+    Do not give any reasoning etc. just a JSON
+        """
+    report_prompt(cust_info, "sort products (combined)", prompt)
+    try:
+        response = send_request(prompt, use_cache=not force)
+    except:
+        return None
 
-    cust_output_params = cust_map(cust_input_params)
-    print("got params")
+    if response.status_code != 200:
+        print(f"Error: {response.status_code}")
+        print(response.text)
+        return None
+
+    try:
+        response_text = response.json()["choices"][0]["message"]["content"]
+        response_data = loads(response_text)
+    except:
+        print("Could not parse JSON from response:", response.text)
+        return None
+
+    # a missing or mistyped list is asked for again on its own
+    response_data = fix_record("combined_sort", response_data)
+    if response_data is None:
+        print("Invalid combined sort in response:", response_text)
+        return None
+    sorted_products = parse_product_ids(response_data["products"], products)
+    sorted_passive = parse_product_ids(
+        response_data["passive_products"], passive_products
+    )
+
+    if not sorted_products or not sorted_passive:
+        return None
+    return sorted_products, sorted_passive
+
+
+DEFAULT_INPUT_PARAMS = {
+    "churn_rate": 5,  # 0-10
+    "profit_generated": 5,
+    "risk_appetite": 5,
+    "financial_acumen": 5,
+    "argument": "",
+}
+
+# customers scored (and saved) together in batch mode
+BATCH_CHUNK_SIZE = 50
+
+# multi sorts the active and passive lists with one request each, combined
+# sorts both in one request and falls back to multi if its answer is unusable
+PIPELINES = ["multi", "combined"]
+
+PASSIVE_WEIGHTS = {
+    "risk_customer": 0.0,
+    "value_customer": 0.2,
+    "profit_margin": 0.2,
+    "risk_bank": 0.0,
+    "retention_value": 0.6,
+}  # weights should sum to 1
+
+
+def resolve_input_params(cust_info: dict, cust_input_params: dict | None) -> dict:
+    if not cust_input_params:
+        # the previous params, customers never scored have "" stored
+        try:
+            cust_input_params = json.loads(cust_info["previous"]["cust_input_params"])
+        except (KeyError, TypeError, ValueError):
+            cust_input_params = {}
+        if not isinstance(cust_input_params, dict):
+            cust_input_params = {}
+        cust_input_params = {**DEFAULT_INPUT_PARAMS, **cust_input_params}
+    return cust_input_params
 
-    cust_financial_products_path = "./data/financial_products.json"
-    product_list = load_product_list(cust_financial_products_path)
 
+def ranking_vector(cust_input_params: dict, cust_output_params: dict) -> dict:
     if not (
         cust_input_params["churn_rate"] > 8
         and cust_input_params["profit_generated"] > 9
     ):
-        top_n_products = mahalanobis_dist(cust_output_params, product_list, 12)
+        return cust_output_params
     elif cust_input_params["churn_rate"] < 1.5:
         # FIX: focus more on bank, if customer has less chance of leaving
-        top_n_products = mahalanobis_dist(
-            {
-                **cust_output_params,
-                "value_customer": (cust_output_params["value_customer"] - 1),
-            },
-            product_list,
-            12,
-        )
+        return {
+            **cust_output_params,
+            "value_customer": (cust_output_params["value_customer"] - 1),
+        }
     elif cust_input_params["churn_rate"] > 8:
         # FIX: focus slightly more on customer but not as much as case 1 as profit generated not that high
-        top_n_products = mahalanobis_dist(
-            {
-                **cust_output_params,
-                "value_customer": (cust_output_params["value_customer"] + 1),
-            },
-            product_list,
-            12,
-        )
-
+        return {
+            **cust_output_params,
+            "value_customer": (cust_output_params["value_customer"] + 1),
+        }
     else:
-        top_n_products = mahalanobis_dist(
-            {**cust_output_params, "risk_bank": (cust_output_params["risk_bank"] + 1)},
-            product_list,
-            12,
-        )
+        return {
+            **cust_output_params,
+            "risk_bank": (cust_output_params["risk_bank"] + 1),
+        }
+
 
-    weights = {
-        "risk_customer": 0.0,
-        "value_customer": 0.2,
-        "profit_margin": 0.2,
-        "risk_bank": 0.0,
-        "retention_value": 0.6,
-    }  # weights should sum to 1
-    top_n_passive_products = weighted_vector_dist_passive(
-        cust_output_params, product_list, weights, 8
+def product_summary(product: dict) -> dict:
+    return {
+        "product_id": product["product_id"],
+        "category": product["category"],
+        "subcategory": product["subcategory"],
+        "tier": product["tier"],
+        "name": product["name"],
+        "description": product["description"],
+        "details": product["details"],
+    }
+
+
+def rank_products(
+    cust_input_params_list: list[dict], product_index, ranking: str = "exact"
+) -> list[tuple[dict, list[dict], list[dict]]]:
+    # (output params, top products, top passive products) per customer, all
+    # customers are ranked against the catalog in one vectorized call each
+    cust_output_params_list = [cust_map(p) for p in cust_input_params_list]
+    active_vectors = product_index.customer_vectors(
+        [
+            ranking_vector(i, o)
+            for i, o in zip(cust_input_params_list, cust_output_params_list)
+        ]
     )
+    passive_vectors = product_index.customer_vectors(cust_output_params_list)
 
-    top_n_products = [
-        {
-            "product_id": product_list[i["index"]]["product_id"],
-            "category": product_list[i["index"]]["category"],
-            "subcategory": product_list[i["index"]]["subcategory"],
-            "tier": product_list[i["index"]]["tier"],
-            "name": product_list[i["index"]]["name"],
-            "description": product_list[i["index"]]["description"],
-            "details": product_list[i["index"]]["details"],
-        }
-        for i in top_n_products
-    ]
-    top_n_passive_products = [
-        {
-            "product_id": product_list[i["index"]]["product_id"],
-            "category": product_list[i["index"]]["category"],
-            "subcategory": product_list[i["index"]]["subcategory"],
-            "tier": product_list[i["index"]]["tier"],
-            "name": product_list[i["index"]]["name"],
-            "description": product_list[i["index"]]["description"],
-            "details": product_list[i["index"]]["details"],
-        }
-        for i in top_n_passive_products
+    top_n_products = product_index.mahalanobis_dist_batch(active_vectors, 12, ranking)
+    top_n_passive_products = product_index.weighted_vector_dist_passive_batch(
+        passive_vectors, PASSIVE_WEIGHTS, 8, ranking
+    )
+
+    product_list = product_index.products
+    return [
+        (
+            cust_output_params,
+            [product_summary(product_list[i["index"]]) for i in active],
+            [product_summary(product_list[i["index"]]) for i in passive],
+        )
+        for cust_output_params, active, passive in zip(
+            cust_output_params_list, top_n_products, top_n_passive_products
+        )
     ]
-    print("Got products")
 
-    print("Sorting products")
-    sorted_products = sort_products(cust_info, top_n_products)
-    if sorted_products == "":
-        sorted_products = cust_info["previous"]["top_n_products"]
+
+def resolve_sorted_products(
+    sorted_products: str | None, previous: str, products: list[dict]
+) -> str:
+    if not sorted_products:
+        sorted_products = previous
         if not sorted_products or len(sorted_products) == 0:
-            sorted_products = ",".join([i["product_id"] for i in top_n_products])
-
-    sorted_passive_products = sort_products(cust_info, top_n_passive_products)
-    if sorted_passive_products == "":
-        sorted_passive_products = cust_info["previous"]["top_n_passive_products"]
-        if not sorted_passive_products or len(sorted_passive_products) == 0:
-            sorted_passive_products = ",".join(
-                [i["product_id"] for i in top_n_passive_products]
+            sorted_products = ",".join([i["product_id"] for i in products])
+    return sorted_products
+
+
+def input_fingerprint(cust_info: dict) -> str:
+    # hash of everything the LLM prompts are built from
+    content = json.dumps(
+        {k: cust_info[k] for k in ("persona", "transactions", "posts", "supports")},
+        sort_keys=True,
+    )
+    return hashlib.sha256(content.encode("utf-8")).hexdigest()
+
+
+def carry_over_order(previous: str, products: list[dict]) -> str:
+    # the new top products in the previously sorted order, products that
+    # weren't sorted before go last in ranking order
+    product_ids = [i["product_id"] for i in products]
+    kept = [i for i in dict.fromkeys(previous.split(",")) if i in product_ids]
+    return ",".join(kept + [i for i in product_ids if i not in kept])
+
+
+def guarded(customer_id: str, fn):
+    # fn, returning None instead of raising so one customer failing doesn't
+    # fail the rest of the batch
+    def call(*args, **kwargs):
+        try:
+            return fn(*args, **kwargs)
+        except Exception:
+            print(f"Failed for {customer_id}:")
+            traceback.print_exc()
+            return None
+
+    return call
+
+
+def run_customers(
+    customer_ids: list[str],
+    ranking: str = "exact",
+    concurrency: int = 4,
+    timer: StageTimer | None = None,
+    force: bool = False,
+    pipeline: str = "multi",
+    save: bool = True,
+) -> dict[str, dict]:
+    timer = timer or StageTimer()
+    if not customer_ids:
+        return {}
+
+    with timer.stage("load"):
+        cust_infos = {}
+        for customer_id in customer_ids:
+            cust_info = guarded(customer_id, get_cust_info)(customer_id)
+            if cust_info is not None and "previous" not in cust_info:
+                print(f"Skipping unknown customer {customer_id}")
+            elif cust_info is not None:
+                cust_infos[customer_id] = cust_info
+        # customers that failed to load are left out of the run
+        customer_ids = list(cust_infos)
+        cust_infos = list(cust_infos.values())
+        fingerprints = [input_fingerprint(cust_info) for cust_info in cust_infos]
+        stored = get_store().get_fingerprints(customer_ids)
+        product_index = get_product_index("./data/financial_products.json")
+
+    # customers whose inputs didn't change since their last results skip the
+    # LLM stages, they are only re-ranked if the catalog changed
+    fresh, rerank = [], []
+    for i, customer_id in enumerate(customer_ids):
+        previous = stored.get(customer_id)
+        if force or not previous or previous["input_fingerprint"] != fingerprints[i]:
+            fresh.append(i)
+        elif previous["catalog_version"] != product_index.version:
+            rerank.append(i)
+    skipped = len(customer_ids) - len(fresh) - len(rerank)
+    if skipped:
+        print(f"Skipping {skipped} unchanged customers")
+    if rerank:
+        print(f"Re-ranking {len(rerank)} customers for the new product catalog")
+    todo = fresh + rerank
+    if not todo:
+        return {}
+
+    print("Generating input params")
+    with timer.stage("input_params"):
+        with ThreadPoolExecutor(concurrency) as pool:
+            generated = pool.map(
+                lambda i: guarded(customer_ids[i], generate_cust_input_params)(
+                    cust_infos[i], force=force
+                ),
+                fresh,
             )
+            generated = dict(zip(fresh, generated))
+        cust_input_params_list = [
+            resolve_input_params(cust_infos[i], generated.get(i)) for i in todo
+        ]
+    print("got params")
 
-    print("writing to csv")
+    with timer.stage("ranking"):
+        ranked = rank_products(cust_input_params_list, product_index, ranking)
+        ranked = dict(zip(todo, ranked))
+    print("Got products")
 
-    columns = [
-        "input_params",
-        "output_params",
-        "top_n_products",
-        "top_n_passive_products",
-    ]
-    new_values = [
-        json.dumps(cust_input_params),
-        json.dumps(cust_output_params),
-        sorted_products,
-        sorted_passive_products,
-    ]
-    df = pd.read_csv("./data/customer_profile.csv")
-    df.loc[df["customer_id"] == customer_id, columns] = new_values
-    df.to_csv("./data/customer_profile.csv", index=False)
+    print("Sorting products")
+    with timer.stage("sort_products"):
+        sorted_active, sorted_passive = {}, {}
+        with ThreadPoolExecutor(concurrency) as pool:
+            multi = fresh
+            if pipeline == "combined":
+                sort_combined = timer.timed("sort_combined", sort_products_combined)
+                combined = pool.map(
+                    lambda i, *args: guarded(customer_ids[i], sort_combined)(
+                        *args, force=force
+                    ),
+                    fresh,
+                    [cust_infos[i] for i in fresh],
+                    [ranked[i][1] for i in fresh],
+                    [ranked[i][2] for i in fresh],
+                )
+                multi = []
+                for i, sorted_both in zip(fresh, combined):
+                    if sorted_both:
+                        sorted_active[i], sorted_passive[i] = sorted_both
+                    else:
+                        multi.append(i)
+                if multi:
+                    print(
+                        f"Combined sort failed for {len(multi)} customers, "
+                        "sorting their lists one request each"
+                    )
+
+            # a customer's active and passive lists don't depend on each other,
+            # both requests are submitted together and run side by side
+            sort_active = timer.timed("sort_active", sort_products)
+            sort_passive = timer.timed("sort_passive", sort_products)
+            futures = {
+                i: (
+                    pool.submit(
+                        guarded(customer_ids[i], sort_active),
+                        cust_infos[i],
+                        ranked[i][1],
+                        force=force,
+                    ),
+                    pool.submit(
+                        guarded(customer_ids[i], sort_passive),
+                        cust_infos[i],
+                        ranked[i][2],
+                        force=force,
+                    ),
+                )
+                for i in multi
+            }
+            for i, (active, passive) in futures.items():
+                sorted_active[i], sorted_passive[i] = active.result(), passive.result()
+
+    results = {}
+    for i, cust_input_params in zip(todo, cust_input_params_list):
+        try:
+            cust_output_params, top_n_products, top_n_passive_products = ranked[i]
+            previous = cust_infos[i]["previous"]
+            if i in sorted_active:
+                top_n_products = resolve_sorted_products(
+                    sorted_active[i], previous["top_n_products"], top_n_products
+                )
+                top_n_passive_products = resolve_sorted_products(
+                    sorted_passive[i],
+                    previous["top_n_passive_products"],
+                    top_n_passive_products,
+                )
+                # customers with a failed LLM stage are retried on the next run
+                succeeded = generated[i] and sorted_active[i] and sorted_passive[i]
+                fingerprint = fingerprints[i] if succeeded else ""
+            else:
+                top_n_products = carry_over_order(
+                    previous["top_n_products"], top_n_products
+                )
+                top_n_passive_products = carry_over_order(
+                    previous["top_n_passive_products"], top_n_passive_products
+                )
+                fingerprint = fingerprints[i]
+
+            results[customer_ids[i]] = {
+                "input_params": json.dumps(cust_input_params),
+                "output_params": json.dumps(cust_output_params),
+                "top_n_products": top_n_products,
+                "top_n_passive_products": top_n_passive_products,
+                "input_fingerprint": fingerprint,
+                "catalog_version": product_index.version,
+            }
+        except Exception:
+            # one customer's bad data doesn't fail the rest of the batch
+            print(f"Failed to score {customer_ids[i]}:")
+            traceback.print_exc()
+
+    if save:
+        print("saving results")
+        with timer.stage("save"):
+            # every customer of the run (one chunk in batch mode) is
+            # committed in one transaction
+            get_store().save_results(results)
+
+    return results
+
+
+def main(
+    customer_id: str,
+    ranking: str = "exact",
+    force: bool = False,
+    pipeline: str = "multi",
+) -> dict:
+    # "scored", or "skipped" if nothing changed since the customer's last
+    # results, raises if the customer couldn't be scored
+    if get_store().get_profile(customer_id) is None:
+        raise ValueError(f"Customer {customer_id} not found")
+    timer = StageTimer()
+    results = run_customers(
+        [customer_id], ranking, timer=timer, force=force, pipeline=pipeline
+    )
+    print(f"Stage timings: {timer.report()}")
+    if customer_id in results:
+        return {"customer_id": customer_id, "status": "scored"}
+
+    stored = get_store().get_fingerprints([customer_id]).get(customer_id)
+    fingerprint = input_fingerprint(get_cust_info(customer_id))
+    if force or not stored or stored["input_fingerprint"] != fingerprint:
+        raise RuntimeError(f"Could not score {customer_id}")
+    print(f"{customer_id} is unchanged since its last results, skipped")
+    return {
+        "customer_id": customer_id,
+        "status": "skipped",
+        "reason": "unchanged, skipped",
+    }
+
+
+def main_batch(
+    customer_ids: list[str],
+    ranking: str = "exact",
+    concurrency: int = 4,
+    force: bool = False,
+    pipeline: str = "multi",
+):
+    timer = StageTimer()
+    start = time.perf_counter()
+    scored = 0
+    # results are committed chunk by chunk, a crash or ctrl-c late in a long
+    # run keeps what was scored before it
+    for offset in range(0, len(customer_ids), BATCH_CHUNK_SIZE):
+        chunk = customer_ids[offset : offset + BATCH_CHUNK_SIZE]
+        try:
+            results = run_customers(chunk, ranking, concurrency, timer, force, pipeline)
+            scored += len(results)
+        except Exception:
+            print(f"Failed to score customers {chunk[0]} to {chunk[-1]}:")
+            traceback.print_exc()
+        print(f"Done {offset + len(chunk)}/{len(customer_ids)} customers")
+    elapsed = time.perf_counter() - start
+
+    # skipped (unchanged) and failed customers don't count towards throughput
+    print(
+        f"Scored {scored} of {len(customer_ids)} customers in {elapsed:.2f}s "
+        f"({scored / elapsed:.2f} customers/sec), "
+        f"{len(customer_ids) - scored} skipped or failed"
+    )
+    print(f"Stage timings: {timer.report()}")
+    print(f"LLM cache: {get_cache().stats()}")
 
 
 if __name__ == "__main__":
@@ -325,5 +626,83 @@ if __name__ == "__main__":
         required=False,
         help="Number of individual customers",
     )
+    parser.add_argument(
+        "--all",
+        action="store_true",
+        help="Re-score every customer",
+    )
+    parser.add_argument(
+        "--ids_file",
+        "--ids-file",
+        type=str,
+        default=None,
+        required=False,
+        help="Re-score the customer ids listed in this file, one per line",
+    )
+    parser.add_argument(
+        "--since",
+        type=str,
+        default=None,
+        required=False,
+        help="Re-score customers with transactions, posts or support queries on or after this date (YYYY-MM-DD)",
+    )
+    parser.add_argument(
+        "--concurrency",
+        type=int,
+        default=4,
+        required=False,
+        help="Max number of LLM requests in flight in batch mode",
+    )
+    parser.add_argument(
+        "--ranking",
+        type=str,
+        default="exact",
+        choices=RANKINGS,
+        required=False,
+        help="Product ranking backend, kdtree is approximate but scales to large catalogs",
+    )
+    parser.add_argument(
+        "--no_cache",
+        "--no-cache",
+        action="store_true",
+        help="Ignore cached LLM responses and ask the model again",
+    )
+    parser.add_argument(
+        "--force",
+        action="store_true",
+        help="Re-score customers even if nothing changed since their last results",
+    )
+    parser.add_argument(
+        "--pipeline",
+        type=str,
+        default="multi",
+        choices=PIPELINES,
+        required=False,
+        help="LLM requests per customer, combined sorts both product lists in one request",
+    )
     args = parser.parse_args()
-    main(args.customer_id)
+
+    if args.no_cache:
+        get_cache().bypass = True
+
+    if args.all or args.ids_file or args.since:
+        # batch mode, load every customer's history once up front
+        store = get_store(cached=True)
+        if args.ids_file:
+            with open(args.ids_file, "r") as file:
+                customer_ids = [line.strip() for line in file if line.strip()]
+        elif args.since:
+            customer_ids = store.customers_active_since(args.since)
+        else:
+            customer_ids = store.get_customer_ids()
+
+        known = set(store.get_customer_ids())
+        for customer_id in customer_ids:
+            if customer_id not in known:
+                print(f"Skipping unknown customer {customer_id}")
+        customer_ids = [c for c in customer_ids if c in known]
+        main_batch(
+            customer_ids, args.ranking, args.concurrency, args.force, args.pipeline
+        )
+    else:
+        main(args.customer_id, args.ranking, args.force, args.pipeline)
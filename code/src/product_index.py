@@ -0,0 +1,193 @@
+import hashlib
+import json
+import os
+import threading
+import time
+
+import numpy as np
+from ann import DEFAULT_MAX_LEAVES, KDTree
+from utils import (
+    mahalanobis_dist_batch,
+    weighted_vector_dist_passive_batch,
+    whitening_transform,
+)
+
+PRODUCT_PARAMS = [
+    "risk_customer",
+    "value_customer",
+    "profit_margin",
+    "risk_bank",
+    "retention_value",
+]
+
+RANKINGS = ["exact", "kdtree"]
+
+
+class ProductIndex:
+    def __init__(self, product_list: list[dict], version: str = ""):
+        self.products = product_list
+        self.version = version
+
+        self.vectors = np.ascontiguousarray(
+            [[p[k] for k in PRODUCT_PARAMS] for p in product_list], dtype=np.float32
+        ).reshape(len(product_list), len(PRODUCT_PARAMS))
+        self.whitening = whitening_transform(self.vectors.astype(np.float64))
+
+        self.product_ids = np.array([p["product_id"] for p in product_list])
+        self.categories = np.array([p["category"] for p in product_list])
+        self.positions = {pid: i for i, pid in enumerate(self.product_ids.tolist())}
+
+        # KD-trees are only built when an approximate ranking is first asked for
+        self._trees: dict[tuple, KDTree] = {}
+
+    def __len__(self) -> int:
+        return len(self.products)
+
+    def customer_vectors(self, vectors: list[dict]) -> np.ndarray:
+        return np.array(
+            [[v[k] for k in PRODUCT_PARAMS] for v in vectors], dtype=np.float64
+        ).reshape(len(vectors), len(PRODUCT_PARAMS))
+
+    def kdtree(
+        self, transform: np.ndarray, weights: np.ndarray | None = None
+    ) -> KDTree:
+        # tree over the attributes mapped through transform (a 5x5 matrix),
+        # with per dimension distance weights
+        key = (transform.tobytes(), None if weights is None else weights.tobytes())
+        if key not in self._trees:
+            self._trees[key] = KDTree(self.vectors @ transform, weights)
+        return self._trees[key]
+
+    def mahalanobis_dist_batch(
+        self,
+        customer_vectors: np.ndarray,
+        top_n=10,
+        ranking="exact",
+        max_leaves=DEFAULT_MAX_LEAVES,
+    ) -> list[list[dict]]:
+        if ranking == "exact":
+            return mahalanobis_dist_batch(
+                customer_vectors, self.vectors, top_n, whitening=self.whitening
+            )
+        if ranking != "kdtree":
+            raise ValueError(f"Unknown ranking: {ranking}")
+
+        # Mahalanobis distance is euclidean distance in the whitened space
+        tree = self.kdtree(self.whitening)
+        chosen_products = []
+        for x in np.atleast_2d(customer_vectors) @ self.whitening:
+            indices, dist = tree.query(x, top_n, max_leaves)
+            chosen_products.append(
+                [{"index": int(i), "dist": float(d)} for i, d in zip(indices, dist)]
+            )
+        return chosen_products
+
+    def mahalanobis_dist(
+        self, v1: dict[str, float], top_n=10, ranking="exact"
+    ) -> list[dict]:
+        return self.mahalanobis_dist_batch(self.customer_vectors([v1]), top_n, ranking)[
+            0
+        ]
+
+    def weighted_vector_dist_passive_batch(
+        self,
+        customer_vectors: np.ndarray,
+        weights: dict,
+        top_n=10,
+        ranking="exact",
+        max_leaves=DEFAULT_MAX_LEAVES,
+    ) -> list[list[dict]]:
+        if ranking == "exact":
+            return weighted_vector_dist_passive_batch(
+                customer_vectors, self.vectors, weights, PRODUCT_PARAMS, top_n
+            )
+        if ranking != "kdtree":
+            raise ValueError(f"Unknown ranking: {ranking}")
+
+        w = np.array([weights[k] for k in PRODUCT_PARAMS], dtype=np.float64)
+        tree = self.kdtree(np.eye(len(PRODUCT_PARAMS)), w)
+        rc = PRODUCT_PARAMS.index("risk_customer")
+        rb = PRODUCT_PARAMS.index("risk_bank")
+
+        chosen_products = []
+        for v in np.atleast_2d(customer_vectors):
+            # same eligibility rule as the exact scorer, as upper limits
+            upper = np.full(len(PRODUCT_PARAMS), np.inf)
+            upper[rc], upper[rb] = v[rc] + 1, v[rb] + 1
+            indices, dist = tree.query(v, top_n, max_leaves, upper)
+            chosen_products.append(
+                [{"index": int(i), "dist": float(d)} for i, d in zip(indices, dist)]
+            )
+        return chosen_products
+
+    def weighted_vector_dist_passive(
+        self, v1: dict[str, float], weights: dict, top_n=10, ranking="exact"
+    ) -> list[dict]:
+        return self.weighted_vector_dist_passive_batch(
+            self.customer_vectors([v1]), weights, top_n, ranking
+        )[0]
+
+
+class _CatalogEntry:
+    def __init__(self, index: ProductIndex, mtime_ns: int, size: int):
+        self.index = index
+        self.mtime_ns = mtime_ns
+        self.size = size
+        self.checked_at = time.monotonic()
+
+
+_catalogs: dict[str, _CatalogEntry] = {}
+_catalogs_lock = threading.Lock()
+
+
+def _build_index(file_path: str) -> _CatalogEntry | None:
+    stat = os.stat(file_path)
+    with open(file_path, "rb") as file:
+        content = file.read()
+
+    try:
+        product_list = json.loads(content)
+    except json.JSONDecodeError:
+        return None
+    if not product_list:
+        return None
+
+    version = hashlib.sha256(content).hexdigest()
+    return _CatalogEntry(
+        ProductIndex(product_list, version), stat.st_mtime_ns, stat.st_size
+    )
+
+
+def get_product_index(
+    file_path: str = "./data/financial_products.json", check_interval: float = 5.0
+) -> ProductIndex:
+    # One index per catalog file, rebuilt only when the file content changes.
+    # The file is not touched at all within check_interval seconds of the last check
+    key = os.path.abspath(file_path)
+
+    with _catalogs_lock:
+        entry = _catalogs.get(key)
+        if entry and time.monotonic() - entry.checked_at < check_interval:
+            return entry.index
+
+        if entry:
+            stat = os.stat(file_path)
+            if stat.st_mtime_ns == entry.mtime_ns and stat.st_size == entry.size:
+                entry.checked_at = time.monotonic()
+                return entry.index
+
+        new_entry = _build_index(file_path)
+        if new_entry is None:
+            if entry is None:
+                raise ValueError(f"Could not load product catalog {file_path}")
+            # catalog is mid-write or broken, keep serving the last good version
+            print(f"Could not reload product catalog {file_path}, keeping old one")
+            entry.checked_at = time.monotonic()
+            return entry.index
+
+        if entry and new_entry.index.version == entry.index.version:
+            # touched but unchanged, keep the already built index
+            new_entry.index = entry.index
+
+        _catalogs[key] = new_entry
+        return new_entry.index
@@ -0,0 +1,407 @@
+import json
+import re
+
+from llm_client import send_prompt
+
+# Schemas of everything the LLM is asked to return. Every field is a
+# (check, description) pair: check(value) -> (value, error) coerces what is
+# unambiguous ("7.5" -> 7.5, "True" -> True, 2024-03-01 -> 01/03/2024) and
+# reports the rest as "invalid" (or "missing"), the description is what the
+# fix request asks for instead.
+# Schemas are compiled into one validator function each on import.
+
+
+def text(nullable=False):
+    def check(value):
+        if value is None and nullable:
+            return value, None
+        if isinstance(value, (dict, list)) or value is None:
+            return value, "invalid"
+        return value if isinstance(value, str) else str(value), None
+
+    return check, "String or null" if nullable else "String"
+
+
+def listing():
+    # comma separated string, a JSON list is kept as it is
+    def check(value):
+        if isinstance(value, (str, list)):
+            return value, None
+        return value, "invalid"
+
+    return check, "Comma separated String"
+
+
+def number(lo=None, hi=None, integer=False):
+    kind = "Integer" if integer else "Float"
+    if lo is not None and hi is not None:
+        kind += f", {lo} to {hi}"
+    elif lo is not None:
+        kind += f", {lo} and above"
+
+    def check(value):
+        if isinstance(value, str):
+            digits = value.replace(",", "").replace("$", "").strip()
+            try:
+                value = int(digits) if digits.lstrip("-").isdigit() else float(digits)
+            except ValueError:
+                return value, "invalid"
+        if isinstance(value, bool) or not isinstance(value, (int, float)):
+            return value, "invalid"
+        if integer:
+            if value != int(value):
+                return value, "invalid"
+            value = int(value)
+        if (lo is not None and value < lo) or (hi is not None and value > hi):
+            return value, "invalid"
+        return value, None
+
+    return check, kind
+
+
+def boolean():
+    words = {"true": True, "yes": True, "false": False, "no": False}
+
+    def check(value):
+        if isinstance(value, str) and value.strip().lower() in words:
+            value = words[value.strip().lower()]
+        if not isinstance(value, bool):
+            return value, "invalid"
+        return value, None
+
+    return check, "Boolean"
+
+
+def option(*values):
+    lookup = {v.lower(): v for v in values}
+
+    def check(value):
+        if isinstance(value, str) and value.strip().lower() in lookup:
+            return lookup[value.strip().lower()], None
+        return value, "invalid"
+
+    return check, f"String, Options: {'/'.join(values)}"
+
+
+DATE = re.compile(r"\d{1,2}/\d{1,2}/(\d{2}|\d{4})")
+ISO_DATE = re.compile(r"(\d{4})-(\d{1,2})-(\d{1,2})")
+
+
+def date():
+    def check(value):
+        if not isinstance(value, str):
+            return value, "invalid"
+        value = value.strip()
+        iso = ISO_DATE.fullmatch(value)
+        if iso:
+            value = f"{int(iso[3]):02d}/{int(iso[2]):02d}/{iso[1]}"
+        if not DATE.fullmatch(value):
+            return value, "invalid"
+        return value, None
+
+    return check, "Date, DD/MM/YYYY"
+
+
+SCHEMAS = {
+    "persona": {
+        "age": number(0, 120, integer=True),
+        "gender": option("Male", "Female", "Other"),
+        "education": option("Primary", "Secondary", "Graduate"),
+        "is_married": boolean(),
+        "num_of_children": number(0, integer=True),
+        "location": text(),
+        "income": number(0),
+        "job": text(),
+        "goals": listing(),
+        "credit_score": number(300, 850, integer=True),
+        "preferred_payment_method": text(),
+        "balance": listing(),
+        "loan_amts": listing(),
+        "monthly_spending": listing(),
+        "main_purchase_cat": listing(),
+        "support_interaction_count": number(0, integer=True),
+        "satisfaction": number(-1, 1),
+    },
+    "complaint": {
+        "date": date(),
+        "transcript": text(),
+        "main_concerns": text(),
+        "is_repeating_issue": boolean(),
+        "was_issue_resolved": boolean(),
+        "sentiment": number(-1, 1),
+    },
+    "transaction": {
+        "date": date(),
+        "platform": text(),
+        "payment_method": text(),
+        "amt": number(0),
+        "location": text(),
+        "item_category": text(),
+        "item_sub_category": text(),
+        "item_brand": text(),
+    },
+    "post": {
+        "date": date(),
+        "platform": option("Online", "Offline"),
+        "image_url": text(nullable=True),
+        "text_content": text(),
+        "topics_of_interest": listing(),
+        "feedback_on_financial_products": option("Positive", "Negative", "Neutral"),
+        "sentiment_score": number(-1, 1),
+        "engagement_level": number(-1, 1),
+        "brands_liked": listing(),
+    },
+    "input_params": {
+        "chance_of_leaving": number(0, 10),
+        "profit_generated": number(0, 10),
+        "risk_appetite": number(0, 10),
+        "financial_acumen": number(0, 10),
+        "argument": text(),
+    },
+    "combined_sort": {
+        "products": listing(),
+        "passive_products": listing(),
+    },
+    "support_sentiment": {
+        "sentiment": number(-1, 1),
+    },
+    "social_sentiment": {
+        "sentiment_score": number(-1, 1),
+        "engagement_level": number(-1, 1),
+        "brands_liked": listing(),
+    },
+    "org_persona": {
+        "company_name": text(),
+        "industry": text(),
+        "size": text(),
+        "annual_revenue": number(0),
+        "years_in_business": number(0, integer=True),
+        "location": text(),
+        "business_model": text(),
+        "growth_stage": text(),
+        "risk_tolerance": option("Low", "Medium", "High"),
+        "credit_rating": text(),
+        "preferred_payment_method": text(),
+        "avg_account_balance": number(),
+        "loan_count": number(0, integer=True),
+        "total_loan_amt": number(0),
+        "avg_monthly_spending": number(0),
+        "main_expense_categories": listing(),
+        "support_interaction_count": number(0, integer=True),
+    },
+    "org_transaction": {
+        "date": date(),
+        "platform": text(),
+        "payment_method": text(),
+        "amount": number(),
+        "location": text(),
+        "expense_category": text(),
+        "expense_sub_category": text(),
+        "vendor": text(),
+        "transaction_type": text(),
+    },
+    "org_support": {
+        "date": date(),
+        "transcript": text(),
+        "issue_type": text(),
+        "priority": option("Low", "Medium", "High", "Critical"),
+        "is_repeating_issue": boolean(),
+        "was_issue_resolved": boolean(),
+        "resolution_time": text(),
+        "sentiment": number(-1, 1),
+    },
+    "org_post": {
+        "date": date(),
+        "platform": text(),
+        "image_url": text(nullable=True),
+        "text_content": text(),
+        "topics_of_interest": listing(),
+        "feedback_on_financial_services": option(
+            "Positive", "Negative", "Neutral", "Not Applicable"
+        ),
+        "sentiment_score": number(0, 10),
+        "engagement_level": number(0, 10),
+        "partners_mentioned": listing(),
+        "post_type": text(),
+    },
+}
+
+
+def compile_schema(fields: dict):
+    checks = [(name, check) for name, (check, _) in fields.items()]
+
+    def validator(record) -> tuple[dict, dict[str, str]]:
+        if not isinstance(record, dict):
+            return {}, {name: "missing" for name, _ in checks}
+        record = dict(record)
+        errors = {}
+        for name, check in checks:
+            if name not in record:
+                errors[name] = "missing"
+                continue
+            record[name], error = check(record[name])
+            if error:
+                errors[name] = error
+        return record, errors
+
+    return validator
+
+
+VALIDATORS = {name: compile_schema(fields) for name, fields in SCHEMAS.items()}
+
+
+def validate(schema: str, record) -> tuple[dict, dict[str, str]]:
+    # (coerced record, field -> error), no errors means the record is valid
+    return VALIDATORS[schema](record)
+
+
+LITERALS = {"True": "true", "False": "false", "None": "null"}
+
+
+def repair_json(text: str) -> str:
+    # fixes what LLMs commonly get wrong without asking again: ```json
+    # fences, text around the JSON, 'single quoted' strings, Python
+    # True/False/None and trailing commas
+    fence = re.search(r"```(?:json)?\s*(.*?)(?:```|$)", text, re.S)
+    if fence:
+        text = fence.group(1)
+    starts = [i for i in (text.find("["), text.find("{")) if i >= 0]
+    if starts:
+        text = text[min(starts) :]
+
+    out = []
+    i = 0
+    while i < len(text):
+        c = text[i]
+        if c in "\"'":
+            # copy the string, re-quoted with " if it was '...'
+            j = i + 1
+            chars = []
+            while j < len(text) and text[j] != c:
+                if text[j] == "\\" and j + 1 < len(text):
+                    chars.append(text[j : j + 2])
+                    j += 2
+                    continue
+                chars.append('\\"' if text[j] == '"' else text[j])
+                j += 1
+            content = "".join(chars)
+            if c == "'":
+                content = content.replace("\\'", "'")
+            out.append(f'"{content}"')
+            i = j + 1
+        elif c == ",":
+            rest = text[i + 1 :].lstrip()
+            if not rest or rest[0] not in "]}":
+                out.append(c)
+            i += 1
+        elif c.isalpha():
+            word = re.match(r"[A-Za-z_]+", text[i:]).group(0)
+            out.append(LITERALS.get(word, word))
+            i += len(word)
+        else:
+            out.append(c)
+            i += 1
+
+    text = "".join(out).strip()
+    end = max(text.rfind("]"), text.rfind("}"))
+    return text[: end + 1] if end >= 0 else text
+
+
+def loads(text: str):
+    # json.loads, with repair_json as the fallback, raises ValueError
+    try:
+        return json.loads(text)
+    except json.JSONDecodeError:
+        return json.loads(repair_json(text))
+
+
+def ask(prompt: str, model: str | None = None) -> str:
+    try:
+        # never cached, the fix is asked for because an answer was unusable
+        response = send_prompt(prompt, model, use_cache=False)
+    except Exception as e:
+        print(f"Fix request failed: {e}")
+        return ""
+    if response.status_code != 200:
+        print(f"Error: {response.status_code}")
+        return ""
+    return response.json()["choices"][0]["message"]["content"]
+
+
+def fix_prompt(schema: str, invalid: dict[int, tuple[dict, dict]], context="") -> str:
+    fields = SCHEMAS[schema]
+    items = [
+        {
+            "index": index,
+            "record": record,
+            "fix": {
+                name: f"{fields[name][1]} ({error})" for name, error in errors.items()
+            },
+        }
+        for index, (record, errors) in invalid.items()
+    ]
+    return f"""
+    {context}
+    The following records have fields that are missing or invalid, "fix" lists those fields with
+    the type they need to have and what is wrong with them:
+    {json.dumps(items, ensure_ascii=False, default=str)}
+
+    Return a JSON array with one object per record, holding "index" and only the fields listed in its "fix",
+    with values that fit the rest of the record. Do not give any reasoning etc. just a JSON
+    """
+
+
+def validate_and_fix(
+    schema: str, records: list, model: str | None = None, context=""
+) -> list[tuple[dict, dict[str, str]]]:
+    # (record, errors) of every record after one fix request; the invalid
+    # ones go back to the LLM in a single request asking only for their bad
+    # fields
+    checked = [validate(schema, record) for record in records]
+    invalid = {i: (r, e) for i, (r, e) in enumerate(checked) if e}
+    if not invalid:
+        return checked
+
+    print(f"Fixing {len(invalid)}/{len(records)} {schema} records")
+    try:
+        fixes = loads(ask(fix_prompt(schema, invalid, context), model))
+    except ValueError:
+        fixes = []
+    if isinstance(fixes, dict):
+        fixes = [fixes]
+
+    for fix in fixes if isinstance(fixes, list) else []:
+        if not isinstance(fix, dict) or fix.get("index") not in invalid:
+            continue
+        record, errors = invalid[fix["index"]]
+        record = {**record, **{k: v for k, v in fix.items() if k in errors}}
+        checked[fix["index"]] = validate(schema, record)
+    return checked
+
+
+def fix_records(
+    schema: str, records: list, model: str | None = None, context=""
+) -> list[dict]:
+    # every record, validated and fixed; fields still invalid after the fix
+    # request are left blank rather than dropping the record, callers index
+    # the list by position
+    fixed = []
+    blanked = 0
+    for record, errors in validate_and_fix(schema, records, model, context):
+        if errors:
+            blanked += 1
+            record = {**record, **dict.fromkeys(errors, "")}
+        fixed.append(record)
+    if blanked:
+        print(f"Blanked invalid fields of {blanked}/{len(records)} {schema} records")
+    return fixed
+
+
+def fix_record(
+    schema: str, record, model: str | None = None, context=""
+) -> dict | None:
+    # one record validated and fixed as in fix_records, None if it stays invalid
+    if not isinstance(record, dict):
+        return None
+    record, errors = validate_and_fix(schema, [record], model, context)[0]
+    return None if errors else record
@@ -1,67 +1,272 @@
-from utils import send_request
+import argparse
 import json
+import os
+import threading
+
+from customer_store import TABLES, get_store
+from llm_client import send_prompts
+from local_sentiment import LOCAL_CONFIDENCE, get_local_model
+from requests import Response
+from schemas import SCHEMAS, loads, validate
+from utils import send_request
+
+# records per request when scoring in batches
+SENTIMENT_BATCH_SIZE = int(os.getenv("SENTIMENT_BATCH_SIZE", "40"))
+
+
+def local_support_history(data: dict) -> str | None:
+    # sentiment from the local model, None when it isn't confident enough
+    score, confidence = get_local_model().predict("support", data)
+    if confidence < LOCAL_CONFIDENCE:
+        return None
+    print("Local::update support history is::", score)
+    return str(score)
+
 
+def local_social_media_history(data: dict) -> float | None:
+    # sentiment_score from the local model, None when it isn't confident
+    # enough. engagement_level and brands_liked always come from the LLM
+    score, confidence = get_local_model().predict("social", data)
+    if confidence < LOCAL_CONFIDENCE:
+        return None
+    print("Local::update social media is::", score)
+    return score
 
-def update_support_history(data: dict) -> str:
-    # update sentiment
-    prompt = f"""
-        Given a customer support query {data} to a major U.S. bank, give the sentiment value
+
+def support_batch_prompt(items: str) -> str:
+    return f"""
+        Given the following customer support queries to a major U.S. bank, give the sentiment value of every query
         -1 means very negative comment/sentiment towards the bank by the customer
         1 means a very positive comment/sentiment
         0 means a neutral comment (Could be a person inquiring for a bank feature or a simple question)
 
-        Return only the sentiment value (Type: Float), do not return anything else
-        example return 0.1
-    """
-    response = send_request(prompt)
-
-    sentiment = "0"
-
-    if response.status_code == 200:
-        response_data = response.json()
-        sentiment = response_data["choices"][0]["message"]["content"].strip()
-        print("AI::update support history is::", sentiment)
+        Queries: {items}
 
-    return sentiment
+        Return a JSON array with one object per query: {{"id": id of the query, "sentiment": Sentiment value (Type: Float)}}
+        Dont output anything else.
+    """
 
 
-def update_social_media_history(data: dict) -> dict:
-    # update sentiment
-    prompt = f"""
-        Given a customer's social media message {data}, give the sentiment_score 
+def social_batch_prompt(items: str) -> str:
+    return f"""
+        Given the following social media messages of bank customers, give the sentiment_score of every message
         -1.0 means very negative comment/sentiment towards the bank by the customer
         1.0 means a very positive comment/sentiment
         0 means a neutral comment (Possibly not related to financial topic)
 
-        Output:
+        Messages: {items}
+
+        Return a JSON array with one object per message with the following keys:
+        - id: id of the message
         - sentiment_score: Sentiment Score (Type: float, between -1.0 to 1.0)
         - engagement_level: Engagement level towards the bank (Type: float, between -1.0(No engagement) to 1.0(Engagement))
         - brands_liked: Brands Liked or talked about in the post (Type: Comma separated string of brand names)
-        
-        Return the output as a JSON object. Dont output anything else.
+        Dont output anything else.
     """
-    response = send_request(prompt)
 
-    output = {"sentiment_score": "", "engagement_level": "", "brands_liked": ""}
 
-    if response.status_code == 200:
-        response_data = response.json()
-        response_text = response_data["choices"][0]["message"]["content"]
+# kind -> table, fields sent per record, prompt, schema of the answer and
+# the values a record gets when it can't be scored
+BATCH_KINDS = {
+    "support": {
+        "table": "customer_support_record",
+        "fields": ["transcript", "main_concerns"],
+        "prompt": support_batch_prompt,
+        "schema": "support_sentiment",
+        "default": {"sentiment": "0"},
+    },
+    "social": {
+        "table": "social_media_record",
+        "fields": [
+            "platform",
+            "text_content",
+            "topics_of_interest",
+            "feedback_on_financial_products",
+        ],
+        "prompt": social_batch_prompt,
+        "schema": "social_sentiment",
+        "default": {"sentiment_score": "", "engagement_level": "", "brands_liked": ""},
+    },
+}
+
+
+class BatchScorer:
+    # Scores many records per request. Records get ids 1..n within their
+    # request and answers are matched back by id, so a reordered or partial
+    # answer still lands on the right records. Records missing from an answer
+    # are sent again on their own batch, a batch whose answer can't be used
+    # at all is split in half, down to single records. Records that still
+    # couldn't be scored get the defaults, or None without fill_default.
+    # The first request of every batch goes out together through
+    # llm_client.send_prompts, at most workers at a time; the follow-up
+    # requests of a batch are sent one by one.
+
+    def __init__(
+        self, kind: str, batch_size=SENTIMENT_BATCH_SIZE, workers=1, fill_default=True
+    ):
+        self.spec = BATCH_KINDS[kind]
+        self.batch_size = max(1, batch_size)
+        self.workers = workers
+        self.fill_default = fill_default
+        self.requests = 0
+        self._lock = threading.Lock()
+
+    def score(self, records: list[dict]) -> list[dict | None]:
+        # scores in the order of records
+        results: list[dict | None] = [None] * len(records)
+        batches = [
+            list(range(start, min(start + self.batch_size, len(records))))
+            for start in range(0, len(records), self.batch_size)
+        ]
+        prompts = [self._prompt([records[i] for i in batch]) for batch in batches]
+        with self._lock:
+            self.requests += len(prompts)
+        responses = send_prompts(prompts, max_concurrency=self.workers)
+        for batch, response in zip(batches, responses):
+            scores = self._parse(response, len(batch))
+            self._resolve(records, batch, scores, results)
+        return results
+
+    def _score(self, records: list[dict], indexes: list[int], results: list):
+        scores = self._request([records[i] for i in indexes])
+        self._resolve(records, indexes, scores, results)
+
+    def _resolve(
+        self, records: list[dict], indexes: list[int], scores: dict, results: list
+    ):
+        # scores of the records at indexes into results, the rest sent again
+        for position, i in enumerate(indexes):
+            if position in scores:
+                results[i] = scores[position]
+        missing = [i for position, i in enumerate(indexes) if position not in scores]
+
+        if not missing:
+            return
+        if len(missing) < len(indexes):
+            self._score(records, missing, results)
+        elif len(indexes) > 1:
+            print(f"Unusable answer for {len(indexes)} records, splitting the batch")
+            half = len(indexes) // 2
+            self._score(records, indexes[:half], results)
+            self._score(records, indexes[half:], results)
+        elif self.fill_default:
+            results[indexes[0]] = dict(self.spec["default"])
+
+    def _prompt(self, records: list[dict]) -> str:
+        items = [
+            {"id": n + 1, **{f: record.get(f, "") for f in self.spec["fields"]}}
+            for n, record in enumerate(records)
+        ]
+        return self.spec["prompt"](json.dumps(items, ensure_ascii=False))
+
+    def _request(self, records: list[dict]) -> dict[int, dict]:
+        # position in records -> validated scores
+        with self._lock:
+            self.requests += 1
+        try:
+            response = send_request(self._prompt(records))
+        except Exception as e:
+            response = e
+        return self._parse(response, len(records))
+
+    def _parse(self, response: Response | Exception, count: int) -> dict[int, dict]:
+        # position in the batch of count records -> validated scores, a failed
+        # request gives its exception
+        if isinstance(response, Exception):
+            print(f"Sentiment request failed: {response}")
+            return {}
+        if response.status_code != 200:
+            print(f"Error: {response.status_code}")
+            return {}
+
         try:
-            response_text = response_text.strip().lstrip("```json").rstrip("```")
+            answer = loads(response.json()["choices"][0]["message"]["content"])
+        except (ValueError, KeyError, IndexError, TypeError):
+            # not JSON, or a 200 carrying an error object instead of choices
+            print("Could not parse sentiment response:", response.text[:200])
+            return {}
+        if isinstance(answer, dict):
+            answer = [answer]
 
-            response_data = json.loads(response_text)
+        schema = self.spec["schema"]
+        scores = {}
+        for item in answer if isinstance(answer, list) else []:
+            if not isinstance(item, dict):
+                continue
+            try:
+                position = int(item.get("id")) - 1
+            except (TypeError, ValueError):
+                continue
+            record, errors = validate(schema, item)
+            if errors or not 0 <= position < count:
+                continue
+            scores[position] = {
+                key: (
+                    ",".join(map(str, value)) if isinstance(value, list) else str(value)
+                )
+                for key, value in record.items()
+                if key in SCHEMAS[schema]
+            }
+        return scores
 
-            print("AI::update social media is::", response_data)
-            output["sentiment_score"] = response_data["sentiment_score"]
-            output["engagement_level"] = response_data["engagement_level"]
-            output["brands_liked"] = response_data["brands_liked"]
-        except:
-            print("Could not parse JSON from response:", response_data)
 
-    return output
+def rescore_table(kind: str, batch_size: int, workers: int, missing_only=False):
+    # scores the table in the store, rows the LLM couldn't score keep what
+    # they had
+    store = get_store()
+    table = BATCH_KINDS[kind]["table"]
+    id_column = TABLES[table]["id_column"]
+    scored_columns = list(BATCH_KINDS[kind]["default"])
+    todo = [
+        row
+        for row in store.get_table(table)
+        if not missing_only or any(row.get(c) in ("", None) for c in scored_columns)
+    ]
+
+    scorer = BatchScorer(kind, batch_size, workers, fill_default=False)
+    failed = 0
+    for row, score in zip(todo, scorer.score(todo)):
+        if score is None:
+            failed += 1
+            continue
+        store.update_record(table, row[id_column], score)
+    print(
+        f"Scored {len(todo) - failed}/{len(todo)} rows of {table} "
+        f"with {scorer.requests} requests"
+    )
+
 
 if __name__ == "__main__":
-    print(update_support_history({
-        "transcript": "hate the bank"}))
-    print(update_social_media_history({}))
+    parser = argparse.ArgumentParser(
+        description="Re-score the sentiment columns of the support or social media table in the store"
+    )
+    parser.add_argument(
+        "--table",
+        type=str,
+        default="support",
+        choices=list(BATCH_KINDS),
+        required=False,
+        help="support (customer_support_record) or social (social_media_record)",
+    )
+    parser.add_argument(
+        "--batch_size",
+        type=int,
+        default=SENTIMENT_BATCH_SIZE,
+        required=False,
+        help="Records per LLM request",
+    )
+    parser.add_argument(
+        "--workers",
+        type=int,
+        default=1,
+        required=False,
+        help="Batches scored concurrently (requests stay within LLM_REQUESTS_PER_MINUTE)",
+    )
+    parser.add_argument(
+        "--missing_only",
+        action="store_true",
+        help="Only score rows whose sentiment columns are empty",
+    )
+    args = parser.parse_args()
+
+    rescore_table(args.table, args.batch_size, args.workers, args.missing_only)
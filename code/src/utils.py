@@ -1,37 +1,48 @@
 import json
-import os
+import threading
+import time
+from contextlib import contextmanager
 
 import numpy as np
-import requests
+from llm_client import send_prompt
 from requests import Response
-from dotenv import load_dotenv
-from numpy.lib import math
 
 
-def send_request(prompt: str) -> Response:
-    load_dotenv()
+class StageTimer:
+    # wall clock seconds per named stage, safe to use from worker threads
+    def __init__(self):
+        self.timings: dict[str, float] = {}
+        self._lock = threading.Lock()
 
-    OPEN_ROUTER_KEY = os.getenv("OPEN_ROUTER_KEY")
-    OPEN_ROUTER_URL = "https://openrouter.ai/api/v1/chat/completions"
-    MODEL = os.getenv("MODEL")
+    @contextmanager
+    def stage(self, name: str):
+        start = time.perf_counter()
+        try:
+            yield
+        finally:
+            elapsed = time.perf_counter() - start
+            with self._lock:
+                self.timings[name] = self.timings.get(name, 0.0) + elapsed
 
-    headers = {
-        "Authorization": f"Bearer {OPEN_ROUTER_KEY}",
-        "Content-Type": "application/json",
-    }
+    def timed(self, name: str, fn):
+        # fn with every call added to the name stage, calls running in
+        # parallel add up so this can exceed the enclosing stage
+        def call(*args, **kwargs):
+            with self.stage(name):
+                return fn(*args, **kwargs)
 
-    payload = {"model": MODEL, "messages": [{"role": "user", "content": prompt}]}
-    response = requests.post(OPEN_ROUTER_URL, headers=headers, data=json.dumps(payload))
-    return response
+        return call
 
+    def report(self) -> str:
+        return ", ".join(f"{name}: {t:.2f}s" for name, t in self.timings.items())
+
+
+def send_request(prompt: str, use_cache: bool = False) -> Response:
+    return send_prompt(prompt, use_cache=use_cache)
 
-def mahalanobis_dist(
-    v1: dict[str, int], product_list: list[dict], top_n=10
-) -> list[dict]:
-    params = list(v1.keys())
-    product_vectors = np.array([[p[k] for k in params] for p in product_list])
-    X = np.array([v1[k] for k in params])
 
+def whitening_transform(product_vectors: np.ndarray) -> np.ndarray:
+    # W such that ||(x - y) @ W|| is the Mahalanobis distance between x and y
     cov = np.cov(product_vectors, rowvar=False)
 
     try:
@@ -39,47 +50,123 @@ def mahalanobis_dist(
     except np.linalg.LinAlgError:
         inv_cov = np.linalg.pinv(cov)
 
-    dist = []
+    try:
+        return np.linalg.cholesky(inv_cov)
+    except np.linalg.LinAlgError:
+        # singular / not positive definite, fall back to the eigen decomposition
+        eig_vals, eig_vecs = np.linalg.eigh(inv_cov)
+        return eig_vecs * np.sqrt(np.clip(eig_vals, 0, None))
+
+
+def top_n_indices(dist: np.ndarray, top_n: int) -> np.ndarray:
+    # indices of the top_n smallest distances per row, closest first.
+    # distances are rounded so products with identical attributes tie exactly
+    # and fall back to index order, like the stable sort this replaces
+    dist = np.round(np.atleast_2d(dist), 9)
+    top_n = min(top_n, dist.shape[1])
+    if top_n <= 0:
+        return np.empty((dist.shape[0], 0), dtype=np.intp)
+
+    if top_n < dist.shape[1]:
+        kth = np.partition(dist, top_n - 1, axis=1)[:, top_n - 1 : top_n]
+        # everything closer than the kth distance, then ties on the kth
+        # distance in index order until each row has exactly top_n products
+        closer = dist < kth
+        ties = dist == kth
+        needed = top_n - closer.sum(axis=1, keepdims=True)
+        chosen = closer | (ties & (np.cumsum(ties, axis=1) <= needed))
+        candidates = np.nonzero(chosen)[1].reshape(dist.shape[0], top_n)
+    else:
+        candidates = np.broadcast_to(np.arange(dist.shape[1]), dist.shape)
+
+    candidate_dist = np.take_along_axis(dist, candidates, axis=1)
+    order = np.lexsort((candidates, candidate_dist), axis=1)
+    return np.take_along_axis(candidates, order, axis=1)
+
+
+def mahalanobis_dist_batch(
+    customer_vectors: np.ndarray,
+    product_vectors: np.ndarray,
+    top_n=10,
+    whitening: np.ndarray | None = None,
+) -> list[list[dict]]:
+    customer_vectors = np.atleast_2d(np.asarray(customer_vectors, dtype=np.float64))
+    product_vectors = np.asarray(product_vectors, dtype=np.float64)
+    if whitening is None:
+        whitening = whitening_transform(product_vectors)
+
+    # in the whitened space Mahalanobis distance is plain euclidean distance
+    wc = customer_vectors @ whitening
+    wp = product_vectors @ whitening
+    sq_dist = (
+        np.einsum("ij,ij->i", wc, wc)[:, None]
+        + np.einsum("ij,ij->i", wp, wp)[None, :]
+        - 2 * (wc @ wp.T)
+    )
+    dist = np.sqrt(np.clip(sq_dist, 0, None))
+
+    top = top_n_indices(dist, top_n)
+    return [
+        [{"index": int(i), "dist": float(dist[row, i])} for i in top[row]]
+        for row in range(len(top))
+    ]
+
 
-    for i in range(len(product_vectors)):
-        distance = np.sqrt(
-            np.matmul(
-                np.matmul(np.transpose(X - product_vectors[i]), inv_cov),
-                (X - product_vectors[i]),
-            )
-        )
-        dist.append({"index": i, "dist": distance})
+def mahalanobis_dist(
+    v1: dict[str, int], product_list: list[dict], top_n=10
+) -> list[dict]:
+    params = list(v1.keys())
+    product_vectors = np.array([[p[k] for k in params] for p in product_list])
+    X = np.array([v1[k] for k in params])
 
-    chosen_products = sorted(dist, key=lambda d: d["dist"], reverse=False)[:top_n]
-    return chosen_products
+    return mahalanobis_dist_batch(X, product_vectors, top_n)[0]
+
+
+def weighted_vector_dist_passive_batch(
+    customer_vectors: np.ndarray,
+    product_vectors: np.ndarray,
+    weights: dict,
+    params: list[str],
+    top_n=10,
+) -> list[list[dict]]:
+    customer_vectors = np.atleast_2d(np.asarray(customer_vectors, dtype=np.float64))
+    product_vectors = np.asarray(product_vectors, dtype=np.float64)
+    w = np.array([weights[k] for k in params], dtype=np.float64)
+
+    # products riskier than the customer / bank can take are never eligible
+    rc, rb = params.index("risk_customer"), params.index("risk_bank")
+    eligible = (customer_vectors[:, rc, None] - product_vectors[None, :, rc] > -1) & (
+        customer_vectors[:, rb, None] - product_vectors[None, :, rb] > -1
+    )
+
+    sq_dist = (
+        ((customer_vectors**2) @ w)[:, None]
+        + ((product_vectors**2) @ w)[None, :]
+        - 2 * ((customer_vectors * w) @ product_vectors.T)
+    )
+    dist = np.where(eligible, np.sqrt(np.clip(sq_dist, 0, None)), np.inf)
+
+    top = top_n_indices(dist, top_n)
+    return [
+        [
+            {"index": int(i), "dist": float(dist[row, i])}
+            for i in top[row]
+            if eligible[row, i]
+        ]
+        for row in range(len(top))
+    ]
 
 
 def weighted_vector_dist_passive(
     v1: dict[str, int], product_list: list[dict], weights: dict, top_n=10
 ) -> list[dict]:
     params = list(v1.keys())
-    chosen_products = []
-
-    for j in range(len(product_list)):
-        if (v1["risk_customer"] - product_list[j]["risk_customer"]) <= -1 or (
-            v1["risk_bank"] - product_list[j]["risk_bank"]
-        ) <= -1:
-            continue
-        dist = math.sqrt(
-            sum(
-                [
-                    weights[params[i]]
-                    * math.pow((v1[params[i]] - product_list[j][params[i]]), 2)
-                    for i in range(len(params))
-                ]
-            )
-        )
-        chosen_products.append({"index": j, "dist": dist})
-
-    chosen_products = sorted(chosen_products, key=lambda d: d["dist"], reverse=False)[
-        :top_n
-    ]
-    return chosen_products
+    product_vectors = np.array([[p[k] for k in params] for p in product_list])
+    X = np.array([v1[k] for k in params])
+
+    return weighted_vector_dist_passive_batch(
+        X, product_vectors, weights, params, top_n
+    )[0]
 
 
 def load_product_list(file_path: str = "./data/financial_products.json") -> list[dict]:
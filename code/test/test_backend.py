@@ -0,0 +1,98 @@
+import os
+import shutil
+import sys
+
+import pytest
+
+SRC = os.path.join(os.path.dirname(os.path.abspath(__file__)), "..", "src")
+sys.path.insert(0, SRC)
+
+
+class RecordingWorker:
+    # stands in for the EnrichmentWorker so no LLM request is made
+    def __init__(self):
+        self.submitted = []
+
+    def submit(self, table, record_id):
+        self.submitted.append((table, record_id))
+
+
+@pytest.fixture(scope="module")
+def backend(tmp_path_factory):
+    # the backend works on ./data, run it on a copy of the csv files
+    root = tmp_path_factory.mktemp("backend")
+    os.makedirs(root / "data")
+    for name in os.listdir(os.path.join(SRC, "data")):
+        if name.endswith((".csv", ".json")):
+            shutil.copy(os.path.join(SRC, "data", name), root / "data")
+
+    cwd = os.getcwd()
+    os.chdir(root)
+    try:
+        import backend
+
+        backend._enrichment = RecordingWorker()
+        yield backend
+    finally:
+        os.chdir(cwd)
+
+
+def test_post_support_query_is_saved_pending(backend):
+    client = backend.app.test_client()
+    response = client.post(
+        "/customer_support_history?customer_id=CUST_1",
+        json={
+            "customer_id": "CUST_1",
+            "date": "01/03/2025",
+            "transcript": "My card was declined twice today",
+            "main_concerns": "card declined",
+            "is_repeating_issue": True,
+            "was_issue_resolved": False,
+            "sentiment": 1,
+        },
+    )
+    assert response.status_code == 200
+    body = response.get_json()
+    assert body["enrichment_status"] == "pending"
+    assert ("customer_support_record", body["complaint_id"]) in (
+        backend._enrichment.submitted
+    )
+
+    row = backend.store.get_record("customer_support_record", body["complaint_id"])
+    assert row["enrichment_status"] == "pending"
+    assert row["sentiment"] in ("", None)
+
+    supports = client.get("/customer_support_history?customer_id=CUST_1").get_json()
+    posted = [s for s in supports if s["complaint_id"] == body["complaint_id"]]
+    assert posted[0]["sentiment"] is None
+
+
+def test_post_social_media_post_is_saved_pending(backend):
+    client = backend.app.test_client()
+    response = client.post(
+        "/customer_social_media_history?customer_id=CUST_1",
+        json={
+            "date": "01/03/2025",
+            "platform": "Online",
+            "image_url": "",
+            "text_content": "Loving the new savings account",
+            "topics_of_interest": "savings",
+            "sentiment_score": 1,
+            "engagement_level": 1,
+            "brands_liked": "Client Sent",
+        },
+    )
+    assert response.status_code == 200
+    body = response.get_json()
+    assert body["enrichment_status"] == "pending"
+    assert ("social_media_record", body["post_id"]) in backend._enrichment.submitted
+
+    row = backend.store.get_record("social_media_record", body["post_id"])
+    assert row["enrichment_status"] == "pending"
+    # scored by the enrichment worker, never taken from the client
+    assert row["brands_liked"] in ("", None)
+
+    posts = client.get("/customer_social_media_history?customer_id=CUST_1").get_json()
+    posted = [p for p in posts if p["post_id"] == body["post_id"]]
+    assert posted[0]["sentiment_score"] is None
+    assert posted[0]["engagement_level"] is None